@@ -46,3 +46,4 @@ CREATE TABLE break (
 
 
 
+-- NOTE: This is the version-0 schema. Indexes, triggers and later tables are added by the migrations in flow.py.
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+#
+# Benchmarks for the model layer. Generates synthetic databases with a given number of tasks (cached in bench_data/,
+# keyed by size and seed, so every run and every commit measures the same data), times the hot paths on each, and
+# writes a JSON report. `--compare` prints the change against an earlier report, e.g. one made before a change:
+#
+#   python3 bench.py --tasks 1000,100000 --output before.json
+#   (change something)
+#   python3 bench.py --tasks 1000,100000 --compare before.json
+#
+
+import sys
+from os import path
+import os
+import time
+import json
+import math
+import random
+import argparse
+import datetime
+import itertools
+import platform
+import sqlite3
+import subprocess
+import tempfile
+
+import flow
+
+
+bench_data_dir = path.join(path.dirname(path.abspath(__file__)), "bench_data")
+
+
+#
+# Data generator: task names are dotted paths over a few areas and projects; each task has a geometric number of work
+# sessions (log-normal lengths, exponential gaps), breaks at a Poisson-ish rate, notes on some sessions, and a few
+# `#reminder`s. Most old tasks are closed. Everything is drawn from a seeded RNG and loaded with the bulk importer.
+#
+
+name_areas = ("work", "home", "school", "oss", "health", "admin", "writing", "misc")
+name_words = ("alpha", "beta", "gamma", "delta", "report", "review", "design", "bugfix", "refactor", "docs", "deploy",
+              "study", "lab", "essay", "taxes", "garden", "paint", "plan", "email", "budget", "trip", "meetup")
+
+gen_first_dt = datetime.datetime(2021, 1, 1)
+gen_span_sec = 5 * 365 * 24 * 3600
+gen_mean_sessions = 6
+gen_max_sessions = 200
+gen_median_session_sec = 40 * 60
+gen_mean_breaks = 0.8
+gen_mean_break_sec = 5 * 60
+gen_note_prob = 0.4
+gen_reminder_prob = 0.02
+
+
+def gen_records(num_tasks, seed):
+    # Yields `(line_num, record)`s in the bulk importer's format.
+    rng = random.Random(seed)
+    num_projects = max(1, int(math.sqrt(num_tasks) / 2))
+    work_id = 0
+    line_num = 0
+    for task_id in range(num_tasks):
+        name = (f"{rng.choice(name_areas)}.p{rng.randrange(num_projects)}."
+                f"{rng.choice(name_words)}-{task_id}")
+        beg_dt = gen_first_dt + datetime.timedelta(seconds=rng.randrange(gen_span_sec))
+        age = 1 - (beg_dt - gen_first_dt).total_seconds() / gen_span_sec
+        status = flow.IN_PROGRESS_TASK_STATUS
+        if rng.random() < age:
+            status = flow.ABANDONED_TASK_STATUS if rng.random() < 0.1 else flow.COMPLETE_TASK_STATUS
+        line_num += 1
+        yield line_num, {"type": "task", "id": task_id, "name": name, "beg_dt": flow.dt_to_str(beg_dt),
+                         "status": status, "user_text": f"Synthetic task {task_id}."}
+
+        session_dt = beg_dt
+        num_sessions = min(int(rng.expovariate(1 / gen_mean_sessions)) + 1, gen_max_sessions)
+        for _ in range(num_sessions):
+            session_dt += datetime.timedelta(seconds=int(rng.expovariate(1 / (2 * 24 * 3600))))
+            duration_sec = int(rng.lognormvariate(math.log(gen_median_session_sec), 0.6)) + 1
+            breaks = []
+            for _ in range(int(rng.expovariate(1 / gen_mean_breaks))):
+                break_beg_dt = session_dt + datetime.timedelta(seconds=rng.randrange(duration_sec))
+                breaks.append({"beg_dt": flow.dt_to_str(break_beg_dt),
+                               "duration_sec": int(rng.expovariate(1 / gen_mean_break_sec))})
+            work_id += 1
+            line_num += 1
+            yield line_num, {"type": "work", "id": work_id, "task_id": task_id, "beg_dt": flow.dt_to_str(session_dt),
+                             "duration_sec": duration_sec, "breaks": breaks}
+            if rng.random() < gen_note_prob:
+                line_num += 1
+                note_dt = session_dt + datetime.timedelta(seconds=duration_sec)
+                yield line_num, {"type": "note", "task_id": task_id, "work_id": work_id,
+                                 "timestamp": flow.dt_to_str(note_dt), "user_text": f"Worked on {name}.",
+                                 "flow_text": "end-work"}
+            session_dt += datetime.timedelta(seconds=duration_sec)
+
+        if rng.random() < gen_reminder_prob:
+            line_num += 1
+            yield line_num, {"type": "note", "task_id": task_id, "timestamp": flow.dt_to_str(session_dt),
+                             "user_text": f"#reminder Follow up on {name}.", "flow_text": ""}
+
+
+def bench_db_path(num_tasks, seed):
+    return path.join(bench_data_dir, f"flow-{num_tasks}-{seed}.db")
+
+
+def open_bench_db(num_tasks, seed):
+    # Points `flow` at the (generated on first use) database for this size and seed.
+    flow.disconnect()
+    flow._task_trie = None
+    db_path = bench_db_path(num_tasks, seed)
+    if not path.isfile(db_path):
+        os.makedirs(bench_data_dir, exist_ok=True)
+        tmp_db_path = db_path + ".tmp"
+        if path.isfile(tmp_db_path):
+            os.remove(tmp_db_path)
+        print(f"Generating {num_tasks} tasks into '{db_path}'...", file=sys.stderr)
+        beg_sec = time.perf_counter()
+        flow.db_path = tmp_db_path
+        flow.db_init()
+        counts = flow.bulk_import_records(gen_records(num_tasks, seed), defer_indexes=True)
+        flow.disconnect()
+        os.replace(tmp_db_path, db_path)
+        print(f"Generated {counts} in {time.perf_counter() - beg_sec:.1f}s.", file=sys.stderr)
+    flow.db_path = db_path
+    flow.db_init()
+
+
+#
+# Benchmarks: each takes `(cursor, rng)` and returns a list of samples, in seconds, of one operation each. Inputs are
+# drawn from `rng` (seeded), so runs on the same data time the same calls.
+#
+
+def timed(fn, *args):
+    beg_sec = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - beg_sec
+
+
+def sample_task_rows(cursor, rng, num):
+    max_id = cursor.execute("SELECT MAX(id) FROM task").fetchone()[0]
+    task_ids = [rng.randint(1, max_id) for _ in range(num)]
+    return [row for task_id in task_ids
+            for row in cursor.execute("SELECT id, name FROM task WHERE id=?", (task_id,)).fetchall()]
+
+
+def bench_name_search(cursor, rng):
+    # The fragments a user types: whole names, whole chunks, chunk prefixes, 2 letters (too short for the trigram
+    # index), and misses. Only the first screenful of results is read, as the UI does.
+    fragments = []
+    for _, name in sample_task_rows(cursor, rng, 20):
+        chunk = rng.choice(name.split("."))
+        fragments += (name, chunk, chunk[:3], chunk[:2], chunk + "zq")
+
+    def search(fragment):
+        list(itertools.islice(flow.Task.name_search(fragment, False, cursor), 20))
+
+    return [timed(search, fragment) for fragment in fragments]
+
+
+def bench_name_search_page(cursor, rng):
+    fragments = [rng.choice(name.split("."))[:4] for _, name in sample_task_rows(cursor, rng, 50)]
+    return [timed(flow.Task.name_search_page, fragment, False, None, 20, cursor) for fragment in fragments]
+
+
+def bench_print_to_html(cursor, rng):
+    # Half random tasks, half the ones with the most sessions.
+    task_ids = [task_id for task_id, _ in sample_task_rows(cursor, rng, 10)]
+    task_ids += [task_id for task_id, in cursor.execute("SELECT task_id FROM task_stats "
+                                                        "ORDER BY num_sessions DESC LIMIT 10")]
+    with tempfile.TemporaryDirectory() as dir_path:
+        file_path = path.join(dir_path, "report.html")
+        return [timed(lambda: flow.Task.get(task_id, cursor).print_to_html(file_path, cursor)) for task_id in task_ids]
+
+
+def bench_search_reminders(cursor, _):
+    return [timed(flow.Task.search_reminders, cursor) for _ in range(5)]
+
+
+def bench_work_save(cursor, rng):
+    # Autosave latency: one `Work.save` and its commit, as a running session does. The session is deleted afterwards
+    # and the task's totals restored, leaving the data as generated.
+    task_id, _ = sample_task_rows(cursor, rng, 1)[0]
+    stats_row = cursor.execute("SELECT * FROM task_stats WHERE task_id=?", (task_id,)).fetchone()
+    with flow.transaction() as save_cursor:
+        work = flow.Work.new(task_id, datetime.datetime.now(), save_cursor)
+    samples = []
+    try:
+        for _ in range(200):
+            beg_sec = time.perf_counter()
+            with flow.transaction() as save_cursor:
+                work.save(datetime.datetime.now(), save_cursor)
+            samples.append(time.perf_counter() - beg_sec)
+    finally:
+        with flow.transaction() as save_cursor:
+            save_cursor.execute("DELETE FROM work WHERE id=?", (work.id,))
+            save_cursor.execute(f"REPLACE INTO task_stats VALUES ({','.join('?' * len(stats_row))})", stats_row)
+    return samples
+
+
+def bench_task_get(cursor, rng):
+    # Uncached: the model caches are emptied (untimed) before each lookup, which would otherwise hit whatever the
+    # earlier lookups (and benchmarks) left in them.
+    samples = []
+    for task_id, _ in sample_task_rows(cursor, rng, 2000):
+        flow.model_caches_clear()
+        samples.append(timed(flow.Task.get, task_id, cursor))
+    return samples
+
+
+def bench_task_get_repeat(cursor, rng):
+    # Navigation: the same few tasks looked up over and over, from empty caches, so mostly cache hits.
+    task_ids = [task_id for task_id, _ in sample_task_rows(cursor, rng, 50)]
+    flow.model_caches_clear()
+    return [timed(flow.Task.get, task_id, cursor) for _ in range(40) for task_id in task_ids]
+
+
+def bench_str_to_dt(cursor, _):
+    # One sample per 10k parses.
+    dt_strs = [dt_str for dt_str, in cursor.execute("SELECT cache_beg_dt FROM work LIMIT 100000")]
+    return [timed(lambda: [flow.str_to_dt(s) for s in dt_strs[i:i + 10000]]) for i in range(0, len(dt_strs), 10000)]
+
+
+benchmarks = (
+    ("name_search", bench_name_search),
+    ("name_search_page", bench_name_search_page),
+    ("print_to_html", bench_print_to_html),
+    ("search_reminders", bench_search_reminders),
+    ("work_save", bench_work_save),
+    ("task_get", bench_task_get),
+    ("task_get_repeat", bench_task_get_repeat),
+    ("str_to_dt_10k", bench_str_to_dt),
+)
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {"n": 0}
+    return {
+        "n": len(samples),
+        "total_ms": sum(samples) * 1000,
+        "mean_ms": sum(samples) / len(samples) * 1000,
+        "median_ms": samples[len(samples) // 2] * 1000,
+        "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+        "min_ms": samples[0] * 1000,
+        "max_ms": samples[-1] * 1000,
+    }
+
+
+#
+# Reports
+#
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=path.dirname(path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, seed, only):
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "dt": flow.dt_to_str(datetime.datetime.now()),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "seed": seed,
+        },
+        "results": {},
+    }
+    for num_tasks in sizes:
+        open_bench_db(num_tasks, seed)
+        results = report["results"][str(num_tasks)] = {}
+        for name, bench_fn in benchmarks:
+            if only and name not in only:
+                continue
+            with flow.transaction() as cursor:
+                results[name] = summarize(bench_fn(cursor, random.Random(f"{seed}-{name}")))
+            print(f"{num_tasks:>8} tasks  {name:<18} median {results[name].get('median_ms', 0):10.3f} ms  "
+                  f"p95 {results[name].get('p95_ms', 0):10.3f} ms", file=sys.stderr)
+    flow.disconnect()
+    return report
+
+
+def compare(old_report, new_report):
+    lines = [f"{old_report['meta']['commit']} -> {new_report['meta']['commit']} (median ms)"]
+    for size, results in new_report["results"].items():
+        for name, new_stats in results.items():
+            old_stats = old_report["results"].get(size, {}).get(name)
+            if not old_stats or not old_stats.get("n") or not new_stats.get("n"):
+                continue
+            old_ms, new_ms = old_stats["median_ms"], new_stats["median_ms"]
+            speedup = old_ms / new_ms if new_ms else float("inf")
+            lines.append(f"{size:>8} tasks  {name:<18} {old_ms:10.3f} -> {new_ms:10.3f}  ({speedup:.2f}x)")
+    return "\n".join(lines)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Time flow's model layer on synthetic databases.")
+    parser.add_argument("--tasks", default="1000,10000",
+                        help="comma-separated database sizes, in tasks (e.g. 1000,100000,1000000)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--only", default=None, help="comma-separated benchmarks to run (default: all)")
+    parser.add_argument("--output", default="bench_output.json", help="where to write the JSON report")
+    parser.add_argument("--compare", default=None, help="an earlier report to compare this run against")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.tasks.split(",")]
+    only = set(args.only.split(",")) if args.only else None
+    report = run(sizes, args.seed, only)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote '{args.output}'.", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(json.load(f), report))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,12 +1,23 @@
 import sys
 from os import path
-from typing import *
 import re
 import time
 import os
-import subprocess
 import sqlite3
 import datetime
+import itertools
+import array
+import bisect
+import collections
+import operator
+import atexit
+import contextlib
+import functools
+import html
+import json
+
+# NOTE: Heavier modules (asyncio, concurrent.futures, csv, subprocess, ...) are imported where they are used, so that
+# one-shot CLI commands start fast.
 
 #
 #
@@ -88,10 +99,35 @@ def dt_to_str(dt):
     return dt.strftime(dt_fmt_str)
 
 
+# Date-times are also available from the DB as integer epoch seconds (the naive local time read as if it were UTC; see
+# the `*_epoch` columns), which decode with a single addition.
+epoch_dt = datetime.datetime(1970, 1, 1)
+
+str_to_dt_cache_size = 1 << 16
+
+
+@functools.lru_cache(maxsize=str_to_dt_cache_size)
 def str_to_dt(s):
+    # `dt_fmt_str` is ISO 8601, which `fromisoformat` parses far faster than `strptime` (kept for anything else).
+    if len(s) == 19 and s[10] == " " and s[13] == s[16] == ":":
+        return datetime.datetime.fromisoformat(s)
     return datetime.datetime.strptime(s, dt_fmt_str)
 
 
+def epoch_to_dt(sec):
+    return epoch_dt + datetime.timedelta(seconds=sec)
+
+
+def dt_to_epoch(dt):
+    return int((dt - epoch_dt).total_seconds())
+
+
+def db_dt(epoch, dt_str):
+    # Decodes a date-time column read along with its epoch column; legacy text that SQLite can't read falls back to
+    # the (memoized) parser.
+    return epoch_to_dt(epoch) if epoch is not None else str_to_dt(dt_str)
+
+
 #
 # Validators:
 #
@@ -118,6 +154,15 @@ def date_time_validator(s):
         )
 
 
+def optional_date_validator(s):
+    # Empty, a date (YYYY-MM-DD) or a date-time.
+    try:
+        note_search_dt_bound(s, False)
+    except ValueError as e:
+        return ResultFail(str(e))
+    return ResultOk()
+
+
 def int_validator(s):
     if re.match(r"([0-9_]+)", s):
         return ResultOk()
@@ -126,7 +171,7 @@ def int_validator(s):
 
 
 def task_name_validator(task_name):
-    if re.match(task_name_validator_re, task_name):
+    if re.fullmatch(task_name_validator_re, task_name):
         return ResultOk()
     else:
         return ResultFail("The string entered is not a correctly formatted task name.\n"
@@ -139,8 +184,8 @@ def new_task_name_validator(new_task_name, cursor):
     if not res:
         return res
 
-    cursor.execute("SELECT COUNT(*) FROM task WHERE name=?", (new_task_name,))
-    if cursor.fetchone()[0] == 0:
+    # (Archived tasks' names are taken too.)
+    if Task.get_by_name(new_task_name, cursor) is None:
         return ResultOk()
     else:
         return ResultFail(f"A task named {repr(new_task_name)} already exists!")
@@ -194,17 +239,823 @@ def db_init():
         with open(db_reset_sql_path) as db_reset:
             init_sql = db_reset.read()
 
-        with connect() as connection:
-            cursor = connection.cursor()
+        with transaction() as cursor:
             for command in init_sql.split(';'):
                 cursor.execute(command)
 
+    # Upgrading the schema in place (a no-op when up-to-date):
+    db_migrate()
+
+    # Closing the work sessions of processes that died mid-session:
+    session_journal_recover()
+
+
+#
+# Schema migrations: reset.sql holds the base schema (version 0). Each entry of `db_migrations` upgrades the DB by one
+# version; `db_migrate` applies the pending ones in order, each in its own transaction, and records them in
+# `schema_version`. Never edit a released migration: append a new one instead.
+#
+
+# Task-name search index: a trigram FTS5 table over `task.name`, so that any fragment of 3+ characters is an indexed
+# lookup rather than a `LIKE '%...%'` scan. Kept in sync with `task` by triggers, so creations and renames from any code
+# path are picked up. (Triggers contain semicolons, so these cannot live in reset.sql.)
+task_search_index_sql = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS task_search USING fts5("
+    "name, content='task', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS task_search_ai AFTER INSERT ON task BEGIN "
+    "INSERT INTO task_search (rowid, name) VALUES (new.id, new.name); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS task_search_ad AFTER DELETE ON task BEGIN "
+    "INSERT INTO task_search (task_search, rowid, name) VALUES ('delete', old.id, old.name); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS task_search_au AFTER UPDATE OF name ON task BEGIN "
+    "INSERT INTO task_search (task_search, rowid, name) VALUES ('delete', old.id, old.name); "
+    "INSERT INTO task_search (rowid, name) VALUES (new.id, new.name); "
+    "END",
+    "INSERT INTO task_search (task_search) VALUES ('rebuild')",
+)
+
+# Trigram matching needs at least this many characters; shorter fragments fall back to a (parameterized) LIKE.
+task_search_min_fts_len = 3
+
+# Per-task totals, materialized in `task_stats` and maintained incrementally by triggers on `task`, `work`, `break` and
+# `note`, so that reports and task lists read them in O(1) rather than re-aggregating every session and break.
+# `task_stats_expected_sql` recomputes them from scratch; see `task_stats_verify` and `task_stats_rebuild`.
+task_stats_expected_sql = (
+    "SELECT task.id, COALESCE(w.net_sec, 0), COALESCE(w.num, 0), COALESCE(b.num, 0), COALESCE(b.dur_sec, 0), "
+    "MAX(COALESCE(task.cache_beg_dt, ''), COALESCE(w.last_dt, ''), COALESCE(b.last_dt, ''), COALESCE(n.last_dt, '')) "
+    "FROM task "
+    "LEFT JOIN (SELECT task_id, SUM(cache_duration_sec) AS net_sec, COUNT(*) AS num, MAX(cache_end_dt) AS last_dt "
+    "FROM work GROUP BY task_id) AS w ON w.task_id = task.id "
+    "LEFT JOIN (SELECT task_id, COUNT(*) AS num, SUM(duration_sec) AS dur_sec, MAX(end_dt) AS last_dt "
+    "FROM break GROUP BY task_id) AS b ON b.task_id = task.id "
+    "LEFT JOIN (SELECT task_id, MAX(timestamp) AS last_dt FROM note GROUP BY task_id) AS n ON n.task_id = task.id"
+)
+
+task_stats_sql = (
+    "CREATE TABLE IF NOT EXISTS task_stats ("
+    "task_id INTEGER PRIMARY KEY, "
+    "net_duration_sec INTEGER NOT NULL DEFAULT 0, "
+    "num_sessions INTEGER NOT NULL DEFAULT 0, "
+    "num_breaks INTEGER NOT NULL DEFAULT 0, "
+    "break_duration_sec INTEGER NOT NULL DEFAULT 0, "
+    "last_activity_dt TEXT NOT NULL DEFAULT '', "
+    "FOREIGN KEY (task_id) REFERENCES task(id))",
+    "CREATE TRIGGER IF NOT EXISTS task_stats_task_ai AFTER INSERT ON task BEGIN "
+    "INSERT INTO task_stats (task_id, last_activity_dt) VALUES (new.id, COALESCE(new.cache_beg_dt, '')); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS task_stats_task_bd BEFORE DELETE ON task BEGIN "
+    "DELETE FROM task_stats WHERE task_id = old.id; "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS task_stats_work_ai AFTER INSERT ON work BEGIN "
+    "UPDATE task_stats SET net_duration_sec = net_duration_sec + new.cache_duration_sec, "
+    "num_sessions = num_sessions + 1, "
+    "last_activity_dt = MAX(last_activity_dt, COALESCE(new.cache_end_dt, '')) "
+    "WHERE task_id = new.task_id; "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS task_stats_work_au AFTER UPDATE OF task_id, cache_end_dt, cache_duration_sec ON work "
+    "BEGIN "
+    "UPDATE task_stats SET net_duration_sec = net_duration_sec - old.cache_duration_sec, "
+    "num_sessions = num_sessions - 1 "
+    "WHERE task_id = old.task_id; "
+    "UPDATE task_stats SET net_duration_sec = net_duration_sec + new.cache_duration_sec, "
+    "num_sessions = num_sessions + 1, "
+    "last_activity_dt = MAX(last_activity_dt, COALESCE(new.cache_end_dt, '')) "
+    "WHERE task_id = new.task_id; "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS task_stats_work_ad AFTER DELETE ON work BEGIN "
+    "UPDATE task_stats SET net_duration_sec = net_duration_sec - old.cache_duration_sec, "
+    "num_sessions = num_sessions - 1 "
+    "WHERE task_id = old.task_id; "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS task_stats_break_ai AFTER INSERT ON break BEGIN "
+    "UPDATE task_stats SET num_breaks = num_breaks + 1, "
+    "break_duration_sec = break_duration_sec + new.duration_sec, "
+    "last_activity_dt = MAX(last_activity_dt, new.end_dt) "
+    "WHERE task_id = new.task_id; "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS task_stats_break_au AFTER UPDATE OF task_id, end_dt, duration_sec ON break BEGIN "
+    "UPDATE task_stats SET num_breaks = num_breaks - 1, "
+    "break_duration_sec = break_duration_sec - old.duration_sec "
+    "WHERE task_id = old.task_id; "
+    "UPDATE task_stats SET num_breaks = num_breaks + 1, "
+    "break_duration_sec = break_duration_sec + new.duration_sec, "
+    "last_activity_dt = MAX(last_activity_dt, new.end_dt) "
+    "WHERE task_id = new.task_id; "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS task_stats_break_ad AFTER DELETE ON break BEGIN "
+    "UPDATE task_stats SET num_breaks = num_breaks - 1, "
+    "break_duration_sec = break_duration_sec - old.duration_sec "
+    "WHERE task_id = old.task_id; "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS task_stats_note_ai AFTER INSERT ON note BEGIN "
+    "UPDATE task_stats SET last_activity_dt = MAX(last_activity_dt, COALESCE(new.timestamp, '')) "
+    "WHERE task_id = new.task_id; "
+    "END",
+    "DELETE FROM task_stats",
+    "INSERT INTO task_stats " + task_stats_expected_sql,
+)
+
+# Note tags: every `#tag` in a note's text (lower-cased), indexed in `note_tag`, so reminders and other tag queries are
+# index range scans whatever the size of the note history. Rows are added by `Note.new` (and the importer) rather than
+# by triggers, since extracting the tags needs a regex; `note_tag_rebuild` recomputes them all.
+note_tag_re = re.compile(r"(?<![\w&#])#([a-zA-Z0-9_\-]+)")
+
+note_tag_reminder = "reminder"
+
+note_tag_sql = (
+    "CREATE TABLE IF NOT EXISTS note_tag ("
+    "tag TEXT NOT NULL, "
+    "task_id INTEGER NOT NULL, "
+    "note_id INTEGER NOT NULL, "
+    "PRIMARY KEY (tag, task_id, note_id), "
+    "FOREIGN KEY (task_id) REFERENCES task(id), "
+    "FOREIGN KEY (note_id) REFERENCES note(id)) WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS note_tag_note_idx ON note_tag (note_id)",
+    "CREATE TRIGGER IF NOT EXISTS note_tag_note_ad AFTER DELETE ON note BEGIN "
+    "DELETE FROM note_tag WHERE note_id = old.id; "
+    "END",
+)
+
+
+# Note search: an FTS5 index over `note.user_text` and `note.flow_text` (words, stemmed), kept in sync by triggers.
+# Results are ranked by BM25 (user text weighing more than flow text) and shown as highlighted snippets.
+note_search_index_sql = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS note_search USING fts5("
+    "user_text, flow_text, content='note', content_rowid='id', tokenize='porter unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS note_search_ai AFTER INSERT ON note BEGIN "
+    "INSERT INTO note_search (rowid, user_text, flow_text) VALUES (new.id, new.user_text, new.flow_text); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS note_search_ad AFTER DELETE ON note BEGIN "
+    "INSERT INTO note_search (note_search, rowid, user_text, flow_text) "
+    "VALUES ('delete', old.id, old.user_text, old.flow_text); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS note_search_au AFTER UPDATE OF user_text, flow_text ON note BEGIN "
+    "INSERT INTO note_search (note_search, rowid, user_text, flow_text) "
+    "VALUES ('delete', old.id, old.user_text, old.flow_text); "
+    "INSERT INTO note_search (rowid, user_text, flow_text) VALUES (new.id, new.user_text, new.flow_text); "
+    "END",
+    "INSERT INTO note_search (note_search) VALUES ('rebuild')",
+)
+
+note_search_snippet_tokens = 12
+note_search_highlight = ("[", "]")
+
+# How many matches the search screen lists (one page, with room for "Return...").
+note_search_ui_limit = 35
+
+
+def note_search_match_str(search_str):
+    # Each word becomes a quoted FTS5 phrase, so punctuation is never parsed as query syntax; the phrases are ANDed.
+    phrases = []
+    for word in search_str.split():
+        is_prefix = word.endswith("*") and len(word) > 1
+        word = word.rstrip("*")
+        if word:
+            phrases.append('"' + word.replace('"', '""') + '"' + ("*" if is_prefix else ""))
+    return " ".join(phrases)
+
+
+def note_search_dt_bound(s, is_end):
+    # Accepts a date-time or a date; an end date includes the whole day. Returns None for an empty string.
+    s = s.strip()
+    if not s:
+        return None
+    if re.fullmatch(r"\d\d\d\d-\d\d-\d\d", s):
+        dt = datetime.datetime.strptime(s, "%Y-%m-%d")
+        return dt_to_str(dt + datetime.timedelta(days=1) if is_end else dt)
+    elif re.fullmatch(dt_fmt_str_re, s):
+        return s
+    raise ValueError(f"{repr(s)} is neither a date (YYYY-MM-DD) nor a date-time (YYYY-MM-DD HH:MM:SS).")
+
+
+def note_tags(user_text):
+    return {tag.lower() for tag in note_tag_re.findall(user_text or "")}
+
+
+def note_tag_rows(note_id, task_id, user_text):
+    return [(tag, task_id, note_id) for tag in note_tags(user_text)]
+
+
+def note_tag_rebuild(cursor):
+    cursor.execute("DELETE FROM note_tag")
+    res = cursor.connection.execute("SELECT id, task_id, user_text FROM note WHERE user_text LIKE '%#%'")
+    cursor.executemany("INSERT INTO note_tag (tag, task_id, note_id) VALUES (?,?,?)",
+                       (tag_row for note_id, task_id, user_text in fetch_iter(res)
+                        for tag_row in note_tag_rows(note_id, task_id, user_text)))
+
+
+# Epoch columns: every date-time column gets an integer twin (`*_epoch`), generated by SQLite from the text. They are
+# virtual, so they cost no space in the tables, but their indexes store the integers: range queries are integer index
+# scans, and rows are read without any date parsing in Python (see `db_dt`).
+epoch_columns_sql = tuple(
+    f"ALTER TABLE {table} ADD COLUMN {epoch_column} INTEGER "
+    f"GENERATED ALWAYS AS (CAST(strftime('%s', {dt_column}) AS INTEGER)) VIRTUAL"
+    for table, epoch_column, dt_column in (
+        ("task", "beg_epoch", "cache_beg_dt"),
+        ("work", "beg_epoch", "cache_beg_dt"),
+        ("work", "end_epoch", "cache_end_dt"),
+        ("break", "beg_epoch", "beg_dt"),
+        ("break", "end_epoch", "end_dt"),
+        ("note", "epoch", "timestamp"),
+    )
+) + (
+    "CREATE INDEX IF NOT EXISTS task_beg_epoch_idx ON task (beg_epoch)",
+    "CREATE INDEX IF NOT EXISTS work_beg_epoch_idx ON work (beg_epoch, end_epoch)",
+    "CREATE INDEX IF NOT EXISTS break_beg_epoch_idx ON break (beg_epoch, end_epoch)",
+    "CREATE INDEX IF NOT EXISTS note_epoch_idx ON note (epoch)",
+    # Superseded by `note_epoch_idx`:
+    "DROP INDEX IF EXISTS note_timestamp_idx",
+)
+
+# Change log, for syncing replicas (see `sync_pull`): every row of `task`, `work`, `break` and `note` gets a global id
+# (`sync_guid`: its creating replica's id and its id there), and the triggers record each insert or update in
+# `changelog`, one entry per row: an update replaces the row's entry with one at the end of the log, so the log holds
+# each changed row once, in the order of its latest change, stamped with that change's (UTC) time and replica. A row may
+# have several global ids (see `sync_apply`); the first one given to it is the one sent. Nothing logs deletes, as the
+# only rows deleted are the archived ones, which have not changed. The triggers stand aside while
+# `sync_replica.applying` is set, when the changes applied log themselves with their original time and replica.
+sync_tables = (
+    # (table, {foreign key column: table referenced}, columns synced), parents first.
+    ("task", {}, ("name", "cache_beg_dt", "cache_status_code")),
+    ("work", {"task_id": "task"}, ("task_id", "cache_beg_dt", "cache_end_dt", "cache_duration_sec")),
+    ("break", {"task_id": "task", "work_id": "work"}, ("task_id", "work_id", "beg_dt", "end_dt", "duration_sec")),
+    ("note", {"task_id": "task", "opt_work_id": "work"},
+     ("timestamp", "task_id", "opt_work_id", "user_text", "flow_text")),
+)
+
+sync_now_sql = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+
+def sync_backfill(cursor):
+    # Gives the rows written while the triggers were absent (before they were added, or in a bulk import with
+    # `defer_indexes`) their global ids and change-log entries, archived rows included.
+    schemas = ("main", "archive") if archive_attached(cursor) else ("main",)
+    for table, _, _ in sync_tables:
+        for schema in schemas:
+            cursor.execute(f"INSERT OR IGNORE INTO sync_guid (tbl, row_id, guid) "
+                           f"SELECT '{table}', t.id, r.id || ':' || t.id FROM {schema}.{table} AS t, sync_replica AS r "
+                           f"WHERE NOT EXISTS (SELECT 1 FROM sync_guid WHERE tbl = '{table}' AND row_id = t.id)")
+            cursor.execute(f"INSERT OR IGNORE INTO changelog (tbl, row_id, change_dt, origin) "
+                           f"SELECT '{table}', t.id, {sync_now_sql}, r.id "
+                           f"FROM {schema}.{table} AS t, sync_replica AS r")
+
+
+sync_sql = (
+    "CREATE TABLE IF NOT EXISTS sync_replica (id TEXT NOT NULL, applying INTEGER NOT NULL DEFAULT 0)",
+    "INSERT INTO sync_replica (id) SELECT lower(hex(randomblob(8))) WHERE NOT EXISTS (SELECT 1 FROM sync_replica)",
+    "CREATE TABLE IF NOT EXISTS sync_guid ("
+    "tbl TEXT NOT NULL, "
+    "row_id INTEGER NOT NULL, "
+    "guid TEXT NOT NULL, "
+    "UNIQUE (tbl, guid))",
+    "CREATE INDEX IF NOT EXISTS sync_guid_row_idx ON sync_guid (tbl, row_id)",
+    "CREATE TABLE IF NOT EXISTS changelog ("
+    "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "tbl TEXT NOT NULL, "
+    "row_id INTEGER NOT NULL, "
+    "change_dt TEXT NOT NULL, "
+    "origin TEXT NOT NULL, "
+    "UNIQUE (tbl, row_id))",
+    "CREATE INDEX IF NOT EXISTS changelog_tbl_seq_idx ON changelog (tbl, seq)",
+    # The last `seq` pulled from each replica:
+    "CREATE TABLE IF NOT EXISTS sync_peer (replica_id TEXT PRIMARY KEY, pulled_seq INTEGER NOT NULL)",
+    *(sql for table, _, _ in sync_tables for sql in (
+        f"CREATE TRIGGER IF NOT EXISTS changelog_{table}_ai AFTER INSERT ON {table} "
+        f"WHEN (SELECT applying FROM sync_replica) = 0 BEGIN "
+        f"INSERT OR IGNORE INTO sync_guid (tbl, row_id, guid) SELECT '{table}', new.id, id || ':' || new.id "
+        f"FROM sync_replica; "
+        # (A row copied back from the archive keeps its entry.)
+        f"INSERT OR IGNORE INTO changelog (tbl, row_id, change_dt, origin) "
+        f"SELECT '{table}', new.id, {sync_now_sql}, id FROM sync_replica; "
+        f"END",
+        f"CREATE TRIGGER IF NOT EXISTS changelog_{table}_au AFTER UPDATE ON {table} "
+        f"WHEN (SELECT applying FROM sync_replica) = 0 BEGIN "
+        f"INSERT OR REPLACE INTO changelog (tbl, row_id, change_dt, origin) "
+        f"SELECT '{table}', new.id, {sync_now_sql}, id FROM sync_replica; "
+        f"END",
+    )),
+    sync_backfill,
+)
+
+db_migrations = (
+    # 1: Covering indexes for the per-task report (work/break totals, notes by time), the per-work break listing and
+    #    the reminder scan.
+    (
+        "CREATE INDEX IF NOT EXISTS work_task_idx ON work (task_id, cache_beg_dt, cache_duration_sec)",
+        "CREATE INDEX IF NOT EXISTS break_work_idx ON break (work_id, beg_dt, duration_sec)",
+        "CREATE INDEX IF NOT EXISTS break_task_idx ON break (task_id, duration_sec)",
+        "CREATE INDEX IF NOT EXISTS note_task_idx ON note (task_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS note_timestamp_idx ON note (timestamp)",
+    ),
+    # 2: Task-name search index.
+    task_search_index_sql,
+    # 3: Materialized per-task totals.
+    task_stats_sql,
+    # 4: Note tags, back-filled from the existing notes.
+    (*note_tag_sql, note_tag_rebuild),
+    # 5: Note full-text search index.
+    note_search_index_sql,
+    # 6: Integer epoch columns, indexed.
+    epoch_columns_sql,
+    # 7: Indexes on the foreign keys still without one, so that deleting a work session or task (see `archive_tasks`)
+    #    finds the rows referencing it without scanning `note` or `note_tag`.
+    (
+        "CREATE INDEX IF NOT EXISTS note_work_idx ON note (opt_work_id)",
+        "CREATE INDEX IF NOT EXISTS note_tag_task_idx ON note_tag (task_id)",
+    ),
+    # 8: Change log, for syncing replicas.
+    sync_sql,
+)
+
+
+def task_stats_verify(cursor):
+    # Returns the ids of the tasks whose materialized totals disagree with the ones recomputed from scratch.
+    cursor.execute(f"SELECT task_id FROM (SELECT * FROM task_stats EXCEPT {task_stats_expected_sql}) "
+                   f"UNION SELECT id FROM ({task_stats_expected_sql} EXCEPT SELECT * FROM task_stats) "
+                   f"ORDER BY 1")
+    return [task_id for task_id, in cursor.fetchall()]
+
+
+def task_stats_rebuild(cursor):
+    cursor.execute("DELETE FROM task_stats")
+    cursor.execute("INSERT INTO task_stats " + task_stats_expected_sql)
+
+
+def db_schema_version(cursor):
+    cursor.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, applied_dt TEXT)")
+    cursor.execute("SELECT MAX(version) FROM schema_version")
+    version = cursor.fetchone()[0]
+    return version if version else 0
+
+
+def db_migrate():
+    connection = connect()
+    cursor = connection.cursor()
+    with connection:
+        version = db_schema_version(cursor)
+
+    for next_version, migration in enumerate(db_migrations[version:], start=version + 1):
+        # NOTE: DDL does not open a transaction implicitly in `sqlite3`, so we open one ourselves to apply each
+        # migration atomically. It takes the write lock up front, and the version is read again under it, as another
+        # process (e.g. a second CLI command started at the same time) may have applied the migration meanwhile.
+        with connection:
+            cursor.execute("BEGIN IMMEDIATE")
+            if db_schema_version(cursor) >= next_version:
+                continue
+            for command in migration:
+                # Steps that need Python (e.g. back-fills) are callables taking the cursor.
+                if callable(command):
+                    command(cursor)
+                else:
+                    cursor.execute(command)
+            cursor.execute("INSERT INTO schema_version (version, applied_dt) VALUES (?,?)",
+                           (next_version, dt_to_str(datetime.datetime.now())))
+
+
+#
+# Connections: the process holds a single connection, opened on first use and tuned once, instead of opening (and
+# fsync-ing on close) a new one for every UI step. WAL lets a reader (e.g. a report) run while a work session writes.
+#
+
+db_cache_size_kib = 16 * 1024
+db_wal_timeout_sec = 5.0
+
+_connection = None
+
+
+def db_enable_wal(connection, schema="main"):
+    # Switching to WAL needs the file to itself, and SQLite answers `SQLITE_BUSY` at once rather than waiting out the
+    # busy timeout, so processes opening a new DB together (e.g. to migrate it) retry. The mode persists in the file,
+    # so this only contends on the first open.
+    deadline_sec = time.monotonic() + db_wal_timeout_sec
+    while True:
+        try:
+            connection.execute(f"PRAGMA {schema}.journal_mode=WAL")
+            return
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) or time.monotonic() >= deadline_sec:
+                raise
+            time.sleep(0.01)
+
 
 def connect():
-    return sqlite3.connect(db_path)
+    global _connection
+    if _connection is None:
+        # NOTE: A running work session saves from a worker thread (see `WorkSession`); all access is serialized.
+        _connection = sqlite3.connect(db_path, check_same_thread=False,
+                                      factory=TracedConnection if _tracer else sqlite3.Connection)
+        if _tracer:
+            _tracer.attach(_connection)
+        db_enable_wal(_connection)
+        _connection.execute("PRAGMA synchronous=NORMAL")
+        _connection.execute("PRAGMA foreign_keys=ON")
+        _connection.execute(f"PRAGMA cache_size=-{db_cache_size_kib}")
+        if path.exists(archive_path()):
+            archive_attach(_connection)
+        archive_views(_connection)
+        atexit.register(disconnect)
+    return _connection
+
+
+def disconnect():
+    global _connection
+    if _connection is not None:
+        _connection.close()
+        _connection = None
+
+
+_after_commit = []
+
+
+def after_commit(fn):
+    # Calls `fn` once the current transaction commits, or never if it rolls back: for side effects outside the DB (e.g.
+    # journal lines) that must not outlive writes rolled back.
+    _after_commit.append(fn)
+
+
+@contextlib.contextmanager
+def transaction():
+    # Commits on success and rolls back on error, like `with connection:`, but hands out a cursor.
+    global _task_trie
+
+    connection = connect()
+    model_caches_sync(connection)
+    try:
+        with connection:
+            yield connection.cursor()
+    except BaseException:
+        # Cached models (and the task-name tree) may hold the writes just rolled back.
+        model_caches_clear()
+        _task_trie = None
+        _after_commit.clear()
+        raise
+    callbacks = _after_commit[:]
+    _after_commit.clear()
+    for fn in callbacks:
+        fn()
+
+
+def connect_read_only(check_same_thread=True):
+    # A separate, read-only connection (e.g. for worker processes), independent of the process-wide one.
+    import urllib.parse
+
+    uri = "file:" + urllib.parse.quote(path.abspath(db_path)) + "?mode=ro"
+    connection = sqlite3.connect(uri, uri=True, check_same_thread=check_same_thread)
+    connection.execute(f"PRAGMA cache_size=-{db_cache_size_kib}")
+    if path.exists(archive_path()):
+        archive_attach(connection, read_only=True)
+    archive_views(connection)
+    return connection
+
+
+def task_name_prefix_bounds(prefix):
+    # Names strictly under `prefix` are those in `[lo, hi)`, a range the UNIQUE index on `task.name` can scan.
+    # ('/' is the character right after '.')
+    return prefix + ".", prefix + "/"
+
+
+#
+# Model cache: a bounded LRU identity map per model class, so that repeated lookups (e.g. a screen re-reading its task
+# on every loop) return the same object without reading the DB. Our own writes update the cached objects in place (or
+# add new ones), and a rollback empties the caches. Commits by other connections bump `PRAGMA data_version`, which
+# `transaction` checks (in memory, without touching the file) as it begins, emptying the caches if it changed. Only
+# lookups on the process-wide connection are cached.
+#
+
+model_cache_size = 4096
+
+
+class ModelCache(object):
+    __slots__ = ("entries", "max_size")
+
+    def __init__(self, max_size=model_cache_size):
+        super().__init__()
+        self.entries = collections.OrderedDict()
+        self.max_size = max_size
+
+    @staticmethod
+    def valid(cursor):
+        # Whether the caches apply to `cursor`.
+        return cursor.connection is _connection
+
+    def get(self, id_):
+        entity = self.entries.get(id_)
+        if entity is not None:
+            self.entries.move_to_end(id_)
+        return entity
+
+    def put(self, entity):
+        self.entries[entity.id] = entity
+        self.entries.move_to_end(entity.id)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return entity
+
+    def intern(self, entity):
+        # Returns the cached object for `entity`'s id, refreshed from `entity` (just read), or caches `entity`.
+        cached = self.entries.get(entity.id)
+        if cached is None:
+            return self.put(entity)
+        for slot in type(entity).__slots__:
+            setattr(cached, slot, getattr(entity, slot))
+        self.entries.move_to_end(entity.id)
+        return cached
+
+    def update(self, entity):
+        # After a write through `entity`: a different cached object with its id is superseded by it.
+        cached = self.entries.get(entity.id)
+        if cached is not None and cached is not entity:
+            self.entries[entity.id] = entity
+
+    def clear(self):
+        self.entries.clear()
+
+
+task_cache = ModelCache()
+work_cache = ModelCache()
+
+
+_model_caches_data_version = None
+
+
+def model_caches_clear():
+    task_cache.clear()
+    work_cache.clear()
+
+
+def model_caches_sync(connection):
+    global _model_caches_data_version
+    data_version = connection.execute("PRAGMA data_version").fetchone()[0]
+    if data_version != _model_caches_data_version:
+        model_caches_clear()
+        _model_caches_data_version = data_version
+
+
+#
+# Query tracing (opt-in: set FLOW_TRACE, or pass --trace FILE). Every statement run on `connect()`'s connection is
+# counted (by the trace callback, which also sees implicit BEGIN/COMMITs and trigger re-entries) and timed (by the
+# cursor), with a latency histogram, the virtual-machine steps it took (sampled by the progress handler, so rows read
+# by later fetches count too) and a slow-query log. Calls to the model methods (`Task.*`, `Work.*`, `Note.*`) are timed
+# as well, along with how many statements each one executed: an N+1 shows up as a large "stmts/call". The report is
+# shown by the hidden debug screen ('!' in the main menu) and written at exit to the FLOW_TRACE (or --trace) file; as
+# JSON if its name ends in '.json'. (FLOW_TRACE=1 traces without writing a file.)
+#
+
+trace_slow_query_ms = 50
+trace_num_slow_queries = 100
+trace_progress_steps = 1000
+trace_report_limit = 25
+
+_tracer = None
+
+
+@functools.lru_cache(maxsize=4096)
+def trace_normalize_sql(sql):
+    # Literals (as expanded by the trace callback) become '?', so every run of a statement lands in the same entry.
+    sql = re.sub(r"'(?:[^']|'')*'|-?\b\d+(?:\.\d+)?\b|\bNULL\b", "?", sql)
+    return " ".join(sql.split())
+
+
+class LatencyHistogram(object):
+    # Counts per power-of-two bucket of microseconds: bucket `i` holds latencies in [2^(i-1), 2^i) us.
+    num_buckets = 40
+
+    def __init__(self):
+        super().__init__()
+        self.buckets = [0] * self.num_buckets
+        self.count = 0
+        self.total_sec = 0.0
+        self.max_sec = 0.0
+
+    def add(self, sec):
+        self.buckets[min(int(sec * 1e6).bit_length(), self.num_buckets - 1)] += 1
+        self.count += 1
+        self.total_sec += sec
+        self.max_sec = max(self.max_sec, sec)
+
+    def percentile_ms(self, q):
+        # Approximate: the upper bound of the bucket holding the `q`-quantile.
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return (1 << i) / 1000
+        return 0.0
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total_ms": self.total_sec * 1000,
+            "mean_ms": self.total_sec * 1000 / self.count if self.count else 0.0,
+            "p50_ms": self.percentile_ms(0.5),
+            "p99_ms": self.percentile_ms(0.99),
+            "max_ms": self.max_sec * 1000,
+            "buckets_us": {str(1 << i): n for i, n in enumerate(self.buckets) if n},
+        }
+
+
+class TraceEntry(object):
+    def __init__(self):
+        super().__init__()
+        self.num_traced = 0
+        self.num_steps = 0
+        self.num_statements = 0
+        self.latency = LatencyHistogram()
+
+
+class QueryTracer(object):
+    model_classes = ("Task", "Work", "Note")
+
+    def __init__(self, dump_path=None):
+        import threading
+
+        super().__init__()
+        self.dump_path = dump_path
+        self.beg_dt = datetime.datetime.now()
+        self.statements = collections.defaultdict(TraceEntry)
+        self.calls = collections.defaultdict(TraceEntry)
+        self.slow_queries = collections.deque(maxlen=trace_num_slow_queries)
+        self.num_statements = 0
+        self.current_sql = None
+        self.local = threading.local()
+
+    def call_stack(self):
+        if not hasattr(self.local, "call_stack"):
+            self.local.call_stack = []
+        return self.local.call_stack
+
+    def attach(self, connection):
+        connection.set_trace_callback(self.on_trace)
+        connection.set_progress_handler(self.on_progress, trace_progress_steps)
+
+    def on_trace(self, sql):
+        self.current_sql = trace_normalize_sql(sql)
+        self.statements[self.current_sql].num_traced += 1
+
+    def on_progress(self):
+        if self.current_sql is not None:
+            self.statements[self.current_sql].num_steps += trace_progress_steps
+        return 0
+
+    def on_execute(self, sql, sec):
+        entry = self.statements[trace_normalize_sql(sql)]
+        entry.num_statements += 1
+        entry.latency.add(sec)
+        self.num_statements += 1
+        if sec * 1000 >= trace_slow_query_ms:
+            call_stack = self.call_stack()
+            self.slow_queries.append((dt_to_str(datetime.datetime.now()), sec * 1000, trace_normalize_sql(sql),
+                                      call_stack[-1] if call_stack else None))
+
+    def wrap(self, name, fn):
+        import inspect
+
+        # Generators are timed inside each `next`, not while their consumer runs (nor are its statements counted).
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def traced_generator(*args, **kwargs):
+                gen = fn(*args, **kwargs)
+                sec = 0.0
+                try:
+                    while True:
+                        beg_sec = time.perf_counter()
+                        try:
+                            item = next(gen)
+                        except StopIteration:
+                            return
+                        finally:
+                            sec += time.perf_counter() - beg_sec
+                        yield item
+                finally:
+                    self.calls[name].latency.add(sec)
+
+            return traced_generator
+
+        @functools.wraps(fn)
+        def traced(*args, **kwargs):
+            call_stack = self.call_stack()
+            call_stack.append(name)
+            num_statements = self.num_statements
+            beg_sec = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                entry = self.calls[name]
+                entry.latency.add(time.perf_counter() - beg_sec)
+                entry.num_statements += self.num_statements - num_statements
+                call_stack.pop()
+
+        return traced
+
+    def instrument(self):
+        for cls in (globals()[class_name] for class_name in self.model_classes):
+            for attr_name, attr in list(vars(cls).items()):
+                if attr_name.startswith("__"):
+                    continue
+                name = f"{cls.__name__}.{attr_name}"
+                if isinstance(attr, staticmethod):
+                    setattr(cls, attr_name, staticmethod(self.wrap(name, attr.__func__)))
+                elif callable(attr):
+                    setattr(cls, attr_name, self.wrap(name, attr))
+
+    def to_dict(self):
+        def entry_dict(entry):
+            return {"statements": entry.num_statements, "traced": entry.num_traced, "vm_steps": entry.num_steps,
+                    "latency": entry.latency.to_dict()}
+
+        return {
+            "beg_dt": dt_to_str(self.beg_dt),
+            "statements": {sql: entry_dict(entry) for sql, entry in self.statements.items()},
+            "calls": {name: entry_dict(entry) for name, entry in self.calls.items()},
+            "slow_queries": [{"dt": dt_str, "ms": ms, "sql": sql, "call": call}
+                             for dt_str, ms, sql, call in self.slow_queries],
+        }
+
+    def report_lines(self, limit=trace_report_limit):
+        by_total = operator.attrgetter("latency.total_sec")
+        lines = [f"= Model calls since {dt_to_str(self.beg_dt)} (by total time) =",
+                 f"{'calls':>8} {'total ms':>10} {'p50 ms':>8} {'p99 ms':>8} {'stmts/call':>10}  call"]
+        for name, entry in sorted(self.calls.items(), key=lambda item: by_total(item[1]), reverse=True)[:limit]:
+            latency = entry.latency
+            stmts_per_call = entry.num_statements / latency.count if latency.count else 0
+            lines.append(f"{latency.count:>8} {latency.total_sec * 1000:>10.1f} {latency.percentile_ms(0.5):>8.3f} "
+                         f"{latency.percentile_ms(0.99):>8.3f} {stmts_per_call:>10.1f}  {name}")
+
+        lines += [f"= Statements ({self.num_statements} run, by total time) =",
+                  f"{'runs':>8} {'total ms':>10} {'p50 ms':>8} {'p99 ms':>8} {'vm steps':>10}  sql"]
+        for sql, entry in sorted(self.statements.items(), key=lambda item: by_total(item[1]), reverse=True)[:limit]:
+            latency = entry.latency
+            lines.append(f"{max(entry.num_statements, entry.num_traced):>8} {latency.total_sec * 1000:>10.1f} "
+                         f"{latency.percentile_ms(0.5):>8.3f} {latency.percentile_ms(0.99):>8.3f} "
+                         f"{entry.num_steps:>10}  {sql[:120]}")
+
+        lines.append(f"= Slow queries (>= {trace_slow_query_ms} ms, most recent last) =")
+        for dt_str, ms, sql, call in self.slow_queries:
+            lines.append(f"[{dt_str}] {ms:.1f} ms in {call or '-'}: {sql[:120]}")
+        return lines
+
+    def dump(self, file_path=None):
+        file_path = file_path or self.dump_path
+        with open(file_path, "w", encoding="utf-8") as f:
+            if file_path.lower().endswith(".json"):
+                json.dump(self.to_dict(), f, indent=2)
+            else:
+                f.write("\n".join(self.report_lines(limit=None)))
+                f.write("\n")
+
+
+class TracedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        beg_sec = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _tracer.on_execute(sql, time.perf_counter() - beg_sec)
+
+    def executemany(self, sql, seq_of_parameters):
+        beg_sec = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _tracer.on_execute(sql, time.perf_counter() - beg_sec)
+
+
+class TracedConnection(sqlite3.Connection):
+    # Routes `connection.execute` shortcuts through a `TracedCursor` too.
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def trace_enable(dump_path=None):
+    # Must run before the first `connect()`.
+    global _tracer
+    assert _connection is None
+    if _tracer is None:
+        _tracer = QueryTracer(dump_path)
+        _tracer.instrument()
+    if dump_path:
+        _tracer.dump_path = dump_path
+        atexit.register(_tracer.dump)
+    return _tracer
+
+
+def trace_enable_from_env():
+    value = os.environ.get("FLOW_TRACE")
+    if value:
+        trace_enable(None if value == "1" else value)
 
 
 class Note(object):
+    __slots__ = ("id", "create_dt", "task_id", "opt_work_id", "user_text", "flow_text")
+
     def __init__(self, id_, create_dt, task_id, opt_work_id, user_text, flow_text):
         super().__init__()
         self.id = id_
@@ -224,42 +1075,57 @@ class Note(object):
         assert isinstance(task_id, (type(None), int))
         assert isinstance(user_text, str)
         assert isinstance(flow_text, str)
-        cursor.execute("INSERT INTO note (timestamp, task_id, opt_work_id, user_text, flow_text) VALUES (?,?,?,?,?)",
-                       (dt_to_str(create_dt), task_id, opt_work_id, user_text, flow_text))
+        archive_insert("INSERT INTO note (timestamp, task_id, opt_work_id, user_text, flow_text) VALUES (?,?,?,?,?)",
+                       (dt_to_str(create_dt), task_id, opt_work_id, user_text, flow_text), task_id, cursor)
         note_id = cursor.lastrowid
+        cursor.executemany("INSERT INTO note_tag (tag, task_id, note_id) VALUES (?,?,?)",
+                           note_tag_rows(note_id, task_id, user_text))
 
         return Note(note_id, create_dt, task_id, opt_work_id, user_text, flow_text)
 
+    @staticmethod
+    def search(search_str, prefix, beg_dt_str, end_dt_str, limit, cursor):
+        # The best `limit` matches of the words in `search_str` (all of them; a trailing '*' matches a prefix), in
+        # notes of the tasks under `prefix` written in `[beg_dt_str, end_dt_str)` (each filter is optional). Returns
+        # `[(note_id, timestamp, task_id, task_name, snippet, score)]`, best (lowest score) first.
+        match_str = note_search_match_str(search_str)
+        if not match_str:
+            return []
+        params = {"match": match_str, "limit": limit, "snippet_tokens": note_search_snippet_tokens,
+                  "hl_beg": note_search_highlight[0], "hl_end": note_search_highlight[1]}
+        filter_sql = ""
+        if prefix:
+            params["prefix"] = prefix
+            params["lo"], params["hi"] = task_name_prefix_bounds(prefix)
+            filter_sql += "AND (task.name = :prefix OR (task.name >= :lo AND task.name < :hi)) "
+        if beg_dt_str:
+            params["beg_epoch"] = dt_to_epoch(str_to_dt(beg_dt_str))
+            filter_sql += "AND note.epoch >= :beg_epoch "
+        if end_dt_str:
+            params["end_epoch"] = dt_to_epoch(str_to_dt(end_dt_str))
+            filter_sql += "AND note.epoch < :end_epoch "
+        cursor.execute("SELECT note.id, note.timestamp, task.id, task.name, "
+                       "snippet(note_search, -1, :hl_beg, :hl_end, '...', :snippet_tokens), "
+                       "bm25(note_search, 1.0, 0.25) AS score "
+                       "FROM note_search "
+                       "JOIN note ON note.id = note_search.rowid "
+                       "JOIN task ON task.id = note.task_id "
+                       f"WHERE note_search MATCH :match {filter_sql}"
+                       "ORDER BY score, note.id DESC LIMIT :limit",
+                       params)
+        return cursor.fetchall()
+
     @staticmethod
     def html_print_user_text(user_text):
-        if user_text.startswith("#reminder"):
-            return "<sys><u>#reminder</u></sys>" + user_text[len("#reminder"):]
-        else:
-            return user_text
+        # Tags are found in the raw text, as `note_tags` finds them (so e.g. '&#reminder' is not one), and the text
+        # between them is escaped. (Tags are made of characters that need no escaping.)
+        pieces = note_tag_re.split(user_text)
+        return "".join(f"<sys><u>#{piece}</u></sys>" if i % 2 else html.escape(piece) for i, piece in enumerate(pieces))
 
 
 
 class Task(object):
-    html_beg = """
-    <!DOCTYPE html>
-    <html lang="en">
-        <head>
-            <title>
-    """
-
-    html_mid = """
-            </title>
-            <style>
-                sys {
-                    font-family: "Lucida Console", Monaco, monospace;
-                    font-size: 0.8em;
-                }
-            </style>
-        </head>
-        <body>
-    """
-
-    html_end = "</body></html>"
+    __slots__ = ("id", "name", "beg_dt", "status")
 
     def __init__(self, id_, name, beg_dt, status):
         super().__init__()
@@ -270,12 +1136,27 @@ class Task(object):
 
     @staticmethod
     def get(id_, cursor):
-        res = cursor.execute("SELECT name, cache_beg_dt, cache_status_code FROM task WHERE id=?", (id_,))
-        row = res.fetchone()
+        cached = task_cache.valid(cursor)
+        if cached:
+            task = task_cache.get(id_)
+            if task is not None:
+                return task
+
+        row = fetchone_or_archived("SELECT name, beg_epoch, cache_beg_dt, cache_status_code FROM {schema}.task "
+                                   "WHERE id=?", (id_,), cursor)
+        if row:
+            name, beg_epoch, beg_dt_str, status_code = row
+            beg_dt = db_dt(beg_epoch, beg_dt_str)
+            task = Task(id_, name, beg_dt, status_code)
+            return task_cache.put(task) if cached else task
+
+    @staticmethod
+    def get_by_name(name, cursor):
+        row = fetchone_or_archived("SELECT id, beg_epoch, cache_beg_dt, cache_status_code FROM {schema}.task "
+                                   "WHERE name=?", (name,), cursor)
         if row:
-            name, beg_dt_str, status_code = row
-            beg_dt = str_to_dt(beg_dt_str)
-            return Task(id_, name, beg_dt, status_code)
+            id_, beg_epoch, beg_dt_str, status_code = row
+            return Task.interner(cursor)(Task(id_, name, db_dt(beg_epoch, beg_dt_str), status_code))
 
     @staticmethod
     def new(name, first_msg, cursor):
@@ -295,24 +1176,103 @@ class Task(object):
         # Adding a note to indicate task creation:
         Note.new(task_id, None, beg_dt, first_msg, "new-task,open-task", cursor)
 
-        return Task(task_id, name, beg_dt, status)
+        task = Task(task_id, name, beg_dt, status)
+        if _task_trie is not None:
+            _task_trie.add(task)
+        if task_cache.valid(cursor):
+            task_cache.put(task)
+        return task
 
     @staticmethod
-    def name_search(search_str, only_open, cursor):
-        san_str_content = sql_sanitize_str_content(search_str)
-        sql = f"SELECT id, name, cache_beg_dt, cache_status_code FROM task WHERE (name LIKE '%{san_str_content}%')"
+    def interner(cursor):
+        # A function mapping each `Task` just read from the DB to the cached one with its id (refreshed), if any.
+        return task_cache.intern if task_cache.valid(cursor) else lambda task: task
+
+    @staticmethod
+    def _name_search_query(search_str, only_open):
+        # Returns `(sql, params)` selecting `id, name, beg_epoch, cache_beg_dt, cache_status_code, match_class` for the
+        # matching tasks, where `match_class` ranks the match: whole name (0), whole chunk(s) (1), chunk prefix (2),
+        # anywhere (3).
+        params = {"frag": search_str, "status": IN_PROGRESS_TASK_STATUS}
+        select_sql = ("SELECT task.id AS id, task.name AS name, task.beg_epoch AS beg_epoch, "
+                      "task.cache_beg_dt AS cache_beg_dt, "
+                      "task.cache_status_code AS cache_status_code, CASE"
+                      " WHEN lower(task.name) = lower(:frag) THEN 0"
+                      " WHEN instr('.' || lower(task.name) || '.', '.' || lower(:frag) || '.') THEN 1"
+                      " WHEN instr('.' || lower(task.name), '.' || lower(:frag)) THEN 2"
+                      " ELSE 3 END AS match_class ")
+        if len(search_str) >= task_search_min_fts_len:
+            params["match"] = '"' + search_str.replace('"', '""') + '"'
+            sql = (select_sql + "FROM task_search "
+                   "JOIN task ON task.id = task_search.rowid "
+                   "WHERE (task_search MATCH :match)")
+        else:
+            params["like"] = "%" + re.sub(r"([%_\\])", r"\\\1", search_str) + "%"
+            sql = select_sql + "FROM task WHERE (task.name LIKE :like ESCAPE '\\')"
 
         if only_open:
-            sql += f" AND (cache_status_code = {IN_PROGRESS_TASK_STATUS})"
+            sql += " AND (task.cache_status_code = :status)"
+        return sql, params
 
-        cursor.execute(sql)
+    @staticmethod
+    def name_search(search_str, only_open, cursor):
+        # Results are ranked by match quality, then most recent.
+        sql, params = Task._name_search_query(search_str, only_open)
+        cursor.execute(sql + " ORDER BY match_class, task.cache_beg_dt DESC, task.id DESC", params)
 
+        intern = Task.interner(cursor)
         for sql_tuple in cursor.fetchall():
-            id_, name, beg_dt_str, status = sql_tuple
-            beg_dt = str_to_dt(beg_dt_str)
-            yield Task(id_, name, beg_dt, status)
+            id_, name, beg_epoch, beg_dt_str, status, _ = sql_tuple
+            beg_dt = db_dt(beg_epoch, beg_dt_str)
+            yield intern(Task(id_, name, beg_dt, status))
+
+    @staticmethod
+    def name_search_page(search_str, only_open, after, limit, cursor, inclusive=False):
+        # One page of `name_search`'s matches, ordered by match quality then name, following the `(match_class, name)`
+        # key `after` (or starting at it, if `inclusive`). Keyset pagination: only the page's rows are read and turned
+        # into `Task`s. Returns `[(task, key)]`.
+        # NOTE: Match classes are computed per row, so no index serves this order: for a search string, each call still
+        # matches every task and keeps the best `limit` past `after` (a top-N sort, in memory for `limit` rows only).
+        # `windowed_fetch_page` makes that once per several pages.
+        sql, params = Task._name_search_query(search_str, only_open)
+        params["limit"] = limit
+        op = '>=' if inclusive else '>'
+        if not search_str:
+            # Everything matches equally well, so we can page straight through the UNIQUE index on `task.name`:
+            params["after_name"] = after[1] if after else ""
+            sql = (f"SELECT id, name, beg_epoch, cache_beg_dt, cache_status_code, 3 FROM task "
+                   f"WHERE name {op} :after_name {'AND cache_status_code = :status ' if only_open else ''}"
+                   f"ORDER BY name LIMIT :limit")
+        elif after is None:
+            sql = f"SELECT * FROM ({sql}) ORDER BY match_class, name LIMIT :limit"
+        else:
+            params["after_class"], params["after_name"] = after
+            sql = (f"SELECT * FROM ({sql}) WHERE (match_class, name) {op} (:after_class, :after_name) "
+                   f"ORDER BY match_class, name LIMIT :limit")
+        cursor.execute(sql, params)
+
+        intern = Task.interner(cursor)
+        return [(intern(Task(id_, name, db_dt(beg_epoch, beg_dt_str), status)), (match_class, name))
+                for id_, name, beg_epoch, beg_dt_str, status, match_class in cursor.fetchall()]
+
+    @staticmethod
+    def archived_page(search_str, after, limit, cursor, inclusive=False):
+        # One page of the archived tasks whose names contain `search_str`, in name order, following the name `after`
+        # (or starting at it, if `inclusive`). The archive has no search index: this pages through its names, which is
+        # fine for a listing the user asks for. Returns `[(task, name)]`.
+        if not archive_attached(cursor):
+            return []
+        params = {"like": "%" + re.sub(r"([%_\\])", r"\\\1", search_str) + "%", "after": after or "", "limit": limit}
+        cursor.execute(f"SELECT id, name, beg_epoch, cache_beg_dt, cache_status_code FROM archive.task "
+                       f"WHERE name {'>=' if inclusive else '>'} :after AND name LIKE :like ESCAPE '\\' "
+                       f"AND id NOT IN (SELECT id FROM main.task) ORDER BY name LIMIT :limit", params)
+        return [(Task(id_, name, db_dt(beg_epoch, beg_dt_str), status), name)
+                for id_, name, beg_epoch, beg_dt_str, status in cursor.fetchall()]
 
     def set_status(self, new_status, completion_msg, cursor):
+        # An archived task is copied back to be re-opened (or written to at all):
+        archive_restore(self.id, cursor)
+
         # Adding a completion note:
         now = datetime.datetime.now()
         if new_status == COMPLETE_TASK_STATUS:
@@ -331,113 +1291,110 @@ class Task(object):
         # Changing the task's completion status:
         cursor.execute("UPDATE task SET cache_status_code=? WHERE id=?", (new_status, self.id))
         assert cursor.lastrowid
+        self.status = new_status
+
+        if _task_trie is not None:
+            trie_task = _task_trie.get_task(self.name)
+            if trie_task:
+                trie_task.status = new_status
+        task_cache.update(self)
+
+    def get_totals(self, cursor):
+        # Returns `(net_duration_sec, num_breaks, break_duration_sec)`; time spent working is net time minus breaks.
+        row = fetchone_or_archived("SELECT net_duration_sec, num_breaks, break_duration_sec FROM {schema}.task_stats "
+                                   "WHERE task_id=?", (self.id,), cursor)
+        if row:
+            return row
+        else:
+            return 0, 0, 0
+
+    def status_str(self):
+        if self.status == IN_PROGRESS_TASK_STATUS:
+            return f"IN_PROGRESS ({self.status})"
+        elif self.status == COMPLETE_TASK_STATUS:
+            return f"COMPLETE ({self.status})"
+        elif self.status == ABANDONED_TASK_STATUS:
+            return f"ABANDONED ({self.status})"
+        else:
+            return f"UNKNOWN ({self.status})"
+
+    def export(self, file_path, fmt, cursor):
+        writer_cls = report_writers[fmt]
+        with open(file_path, "w", buffering=report_buffer_size, encoding="utf-8", newline="") as f:
+            writer = writer_cls(f)
+            writer.begin(self, *self.get_totals(cursor))
+            schema = task_schema(self.id, cursor)
+
+            res = cursor.execute(f"SELECT id, timestamp, opt_work_id, user_text, flow_text FROM {schema}.note "
+                                 "WHERE task_id=? "
+                                 "ORDER BY timestamp DESC",
+                                 (self.id,))
+            writer.begin_notes()
+            for note_id, timestamp, opt_work_id, user_text, flow_text in fetch_iter(res):
+                writer.note(note_id, timestamp, opt_work_id, user_text, flow_text)
+            writer.end_notes()
+
+            # A single pass over work joined with its breaks (ordered by work), grouped per work row as it streams:
+            res = cursor.execute("SELECT work.id, work.cache_beg_dt, work.cache_duration_sec, "
+                                 "break.id, break.beg_dt, break.duration_sec "
+                                 f"FROM {schema}.work LEFT JOIN {schema}.break ON break.work_id = work.id "
+                                 "WHERE work.task_id=? "
+                                 "ORDER BY work.cache_beg_dt, work.id, break.id",
+                                 (self.id,))
+            writer.begin_works()
+            for (work_id, beg_dt, net_duration_sec), rows in itertools.groupby(fetch_iter(res), key=lambda r: r[:3]):
+                break_rows = [row[3:] for row in rows if row[3] is not None]
+                writer.work(work_id, beg_dt, net_duration_sec, break_rows)
+            writer.end_works()
+
+            writer.end()
 
     def print_to_html(self, file_path, cursor):
-        with open(file_path, "w") as f:
-            def f_print(*args, **kwargs):
-                assert "file" not in kwargs
-                return print(*args, **kwargs, file=f)
-
-            f_print(Task.html_beg)
-            f_print(self.name)
-            f_print(Task.html_mid)
-
-            f_print(f"<h1><sys>{self.name}</sys></h1>")
-
-            if self.status == IN_PROGRESS_TASK_STATUS:
-                status_str = f"IN_PROGRESS ({self.status})"
-            elif self.status == COMPLETE_TASK_STATUS:
-                status_str = f"COMPLETE ({self.status})"
-            elif self.status == ABANDONED_TASK_STATUS:
-                status_str = f"ABANDONED ({self.status})"
-            else:
-                status_str = f"UNKNOWN ({self.status})"
-            f_print(f"<p><sys>Status: {status_str}</sys></p>")
-
-            row = cursor.execute("SELECT SUM(cache_duration_sec) FROM work WHERE task_id=?", (self.id,))
-            raw_net_duration_sec = row.fetchone()[0]
-            if raw_net_duration_sec:
-                net_duration_sec = int(raw_net_duration_sec)
-            else:
-                net_duration_sec = 0
-
-            row = cursor.execute("SELECT COUNT(*), sum(duration_sec) FROM break WHERE task_id=?", (self.id,))
-            num_breaks, raw_break_duration_sec = row.fetchone()
-            if not num_breaks:
-                num_breaks = 0
-
-            if not raw_break_duration_sec:
-                break_duration_sec = 0
-            else:
-                break_duration_sec = round_sec_to_int(raw_break_duration_sec)
-
-            work_duration_sec = net_duration_sec - break_duration_sec
-            f_print(f"<p>You have spent {sec_to_hms_str(work_duration_sec)} working on this task so far. "
-                    f"That's a total of "
-                    f"{sec_to_hms_str(net_duration_sec)} with "
-                    f"{sec_to_hms_str(break_duration_sec)} spent on {num_breaks} breaks.")
-
-            f_print("<hr/>")
-
-            rows = cursor.execute("SELECT id, timestamp, opt_work_id, user_text, flow_text FROM note "
-                                  "WHERE task_id=? "
-                                  "ORDER BY timestamp DESC",
-                                  (self.id,)).fetchall()
-            f_print("<h2><sys>Notes:<sys></h2>")
-            f_print("<ul>")
-            for note_id, timestamp, opt_work_id, user_text, flow_text in rows:
-                user_text = user_text
-                flow_text = flow_text
-                f_print("<li>")
-                f_print(f"<sys>[{timestamp}]</sys><br/>")
-                f_print(f"{Note.html_print_user_text(user_text)}<br/>")
-                f_print(f"<sys>{flow_text}</sys><br/>")
-                f_print(f"<sys>Note ID: {note_id}</sys><br/>")
-                f_print(f"<sys>Work ID: {opt_work_id}</p>")
-                f_print("</li>")
-            f_print("</ul>")
-
-            f_print("<hr/>")
-
-            f_print("<h2><sys>Work and Breaks:</sys></h2>")
-            f_print("<ul>")
-            res = cursor.execute("SELECT id, cache_beg_dt, cache_duration_sec FROM work WHERE task_id=?", (self.id,))
-            for work_id, beg_dt, net_duration_sec in res:
-                f_print("<li>")
-
-                f_print(f"<sys>[{beg_dt}]</sys><br/>")
-                f_print(f"<sys>Net duration: {sec_to_hms_str(net_duration_sec)}</sys><br/>")
-
-                agg_res = cursor.execute("SELECT COUNT(*), SUM(duration_sec) FROM break WHERE work_id=?", (work_id,))
-                num_breaks, total_break_duration = agg_res.fetchone()
-                f_print(f"<sys>Breaks: {num_breaks} for {total_break_duration}</sys><br/>")
-
-                f_print("<ol>")
-                break_res = cursor.execute("SELECT id, beg_dt, duration_sec FROM break WHERE work_id=?", (work_id,))
-                for break_id, break_beg_dt, break_duration_sec in break_res:
-                    f_print("<li><sys>")
-                    f_print(f"Break ({break_id}) at [{break_beg_dt}] for {sec_to_hms_str(break_duration_sec)}")
-                    f_print("</sys></li>")
-                f_print("</ol>")
-
-            f_print(Task.html_end)
+        self.export(file_path, "html", cursor)
 
     @staticmethod
     def search_reminders(cursor):
-        res = cursor.execute(
-            """SELECT cache_beg_dt, name, id FROM task WHERE id IN 
-                (SELECT task_id FROM note WHERE (user_text LIKE '#reminder%'))
-               ORDER BY cache_beg_dt DESC
-            """)
+        # NOTE: Unlike the `LIKE '#reminder%'` scan this replaced, a task counts as a reminder if any note has the
+        # #reminder tag anywhere in its text (and no longer if a note merely starts with e.g. '#reminders'). Reminders
+        # come newest task first by id rather than by `cache_beg_dt` (the same order, but for imported tasks), so that
+        # each page is one range of `note_tag`.
+        return tuple((f"[{task.beg_dt_str()}] {task.name}", task.id)
+                     for task in Task.tag_search(note_tag_reminder, cursor))
 
-        def _to_reminder_option(row):
-            task_beg_dt_text, task_name, task_id = row
-            return f"[{task_beg_dt_text}] {task_name}", task_id
+    @staticmethod
+    def tag_search(tag, cursor):
+        # Every task with a note tagged `tag`, most recently created first.
+        after = None
+        while True:
+            page = Task.tag_search_page(tag, after, report_fetch_size, cursor)
+            yield from page
+            if len(page) < report_fetch_size:
+                return
+            after = page[-1].id
 
-        return tuple(map(_to_reminder_option, res.fetchall()))
+    @staticmethod
+    def tag_search_page(tag, after, limit, cursor, inclusive=False):
+        # One page of the tasks with a note tagged `tag`, by decreasing id, following the task id `after` (or starting
+        # at it, if `inclusive`). Each page is a range scan of `note_tag`'s primary key.
+        after_sql = "" if after is None else ("AND task_id <= :after " if inclusive else "AND task_id < :after ")
+        res = cursor.execute("SELECT task.id, task.name, task.beg_epoch, task.cache_beg_dt, task.cache_status_code "
+                             "FROM (SELECT DISTINCT task_id FROM note_tag "
+                             f"WHERE tag = :tag {after_sql}"
+                             "ORDER BY task_id DESC LIMIT :limit) AS tagged "
+                             "JOIN task ON task.id = tagged.task_id "
+                             "ORDER BY task.id DESC",
+                             {"tag": tag.lower(), "after": after, "limit": limit})
+        intern = Task.interner(cursor)
+        return [intern(Task(id_, name, db_dt(beg_epoch, beg_dt_str), status))
+                for id_, name, beg_epoch, beg_dt_str, status in res.fetchall()]
+
+    def beg_dt_str(self):
+        return dt_to_str(self.beg_dt)
 
 
 class Work(object):
+    __slots__ = ("id", "task_id", "beg_dt", "end_dt", "duration_sec")
+
     def __init__(self, id_, task_id, beg_py_dt, end_py_dt, duration_sec):
         super().__init__()
         self.id = id_
@@ -450,23 +1407,31 @@ class Work(object):
     def new(task_id, start_dt, cursor):
         end_dt = start_dt
         start_dt_text = dt_to_str(start_dt)
-        cursor.execute(
-            "INSERT INTO work (task_id, cache_beg_dt, cache_end_dt, cache_duration_sec) VALUES (?,?,?,?)",
-            (task_id, start_dt_text, start_dt_text, 0)
-        )
+        archive_insert("INSERT INTO work (task_id, cache_beg_dt, cache_end_dt, cache_duration_sec) VALUES (?,?,?,?)",
+                       (task_id, start_dt_text, start_dt_text, 0), task_id, cursor)
         id_ = cursor.lastrowid
-        return Work(id_, task_id, start_dt, end_dt, 0)
+        work = Work(id_, task_id, start_dt, end_dt, 0)
+        if work_cache.valid(cursor):
+            work_cache.put(work)
+        return work
 
     @staticmethod
     def get(id_, cursor):
-        row = cursor.execute("SELECT id, task_id, cache_beg_dt, cache_end_dt, cache_duration_sec FROM work "
-                             "WHERE id=? "
-                             "ORDER BY cache_beg_dt", (id_,)).fetchone()
+        cached = work_cache.valid(cursor)
+        if cached:
+            work = work_cache.get(id_)
+            if work is not None:
+                return work
+
+        row = cursor.execute("SELECT id, task_id, beg_epoch, cache_beg_dt, end_epoch, cache_end_dt, cache_duration_sec "
+                             "FROM work "
+                             "WHERE id=?", (id_,)).fetchone()
         if row:
-            id_, task_id, beg_dt_text, end_dt_text, duration_sec = row
-            beg_dt = str_to_dt(beg_dt_text)
-            end_dt = str_to_dt(end_dt_text)
-            return Work(id_, task_id, beg_dt, end_dt, duration_sec)
+            id_, task_id, beg_epoch, beg_dt_text, end_epoch, end_dt_text, duration_sec = row
+            beg_dt = db_dt(beg_epoch, beg_dt_text)
+            end_dt = db_dt(end_epoch, end_dt_text)
+            work = Work(id_, task_id, beg_dt, end_dt, duration_sec)
+            return work_cache.put(work) if cached else work
         else:
             return None
 
@@ -475,6 +1440,7 @@ class Work(object):
         self.duration_sec = round_sec_to_int((save_dt - self.beg_dt).total_seconds())
         cursor.execute("UPDATE work SET cache_end_dt=?, cache_duration_sec=? WHERE id=?",
                        (dt_to_str(self.end_dt), self.duration_sec, self.id))
+        work_cache.update(self)
 
     @staticmethod
     def add_break(task_id, work_id, break_start_time, break_end_time, break_duration_sec, cursor):
@@ -486,17 +1452,1990 @@ class Work(object):
         )
 
 
+#
+# Session journal: an append-only text file of heartbeats written by running work sessions, so that a killed process
+# loses at most a heartbeat's worth of tracked time instead of a whole DB autosave interval. Lines are
+# `<kind> <work_id> <pid> <date-time>`, where kind is S(tart), H(eartbeat), P(ause), R(esume) or E(nd). Every line is
+# flushed to the OS as it is written (enough to survive a crash of the process); fsync-ing, for power loss, is batched.
+# On startup, `session_journal_recover` closes the sessions of dead processes at their last heartbeat.
+#
+
+session_journal_fsync_interval_sec = 5
+
+
+def session_journal_path():
+    return path.splitext(db_path)[0] + ".journal"
+
+
+# Sessions started from the CLI (`flow work start`) outlive their process; they are journaled under this pid, and are
+# only ever closed by `flow work stop`.
+session_journal_detached_pid = 0
+
+
+class SessionJournal(object):
+    def __init__(self, work_id, pid=None):
+        super().__init__()
+        self.work_id = work_id
+        self.pid = os.getpid() if pid is None else pid
+        self.f = open(session_journal_path(), "a", encoding="utf-8")
+        self.last_fsync_time = time.monotonic()
+
+    def _append(self, kind, dt):
+        with session_journal_lock(self.f):
+            self.f.write(f"{kind} {self.work_id} {self.pid} {dt_to_str(dt)}\n")
+            self.f.flush()
+
+    def start(self, dt):
+        self._append("S", dt)
+        self.sync()
+        if self.pid == session_journal_detached_pid:
+            self.f.close()
+
+    def heartbeat(self, dt):
+        self._append("H", dt)
+
+    def pause(self, dt):
+        self._append("P", dt)
+        self.sync()
+
+    def resume(self, dt):
+        self._append("R", dt)
+
+    def end(self, dt):
+        self._append("E", dt)
+        self.sync()
+        self.f.close()
+
+    def sync(self):
+        os.fsync(self.f.fileno())
+        self.last_fsync_time = time.monotonic()
+
+    def sync_due(self):
+        return time.monotonic() - self.last_fsync_time >= session_journal_fsync_interval_sec
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@contextlib.contextmanager
+def session_journal_lock(f, shared=False):
+    # An advisory lock on the journal (open as `f`): appends take it exclusively, so that no line goes in while
+    # `session_journal_recover` reads and compacts the file.
+    import fcntl
+
+    fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def session_journal_parse_line(line):
+    # Returns `(kind, work_id, pid, date-time string)`, or None for a line cut short by a crash.
+    parts = line.split(" ", 3)
+    if len(parts) != 4 or not re.fullmatch(dt_fmt_str_re, parts[3].rstrip("\n")):
+        return None
+    kind, work_id_str, pid_str, dt_str = parts
+    return kind, int(work_id_str), int(pid_str), dt_str.rstrip("\n")
+
+
+def session_journal_open_sessions(lines):
+    # Returns the sessions that have not ended, as `{work_id: (pid, last kind, last date-time string)}`.
+    open_sessions = {}
+    for parsed in filter(None, map(session_journal_parse_line, lines)):
+        kind, work_id, pid, dt_str = parsed
+        if kind == "E":
+            open_sessions.pop(work_id, None)
+        else:
+            open_sessions[work_id] = (pid, kind, dt_str)
+    return open_sessions
+
+
+def session_journal_read():
+    journal_path = session_journal_path()
+    if not path.isfile(journal_path):
+        return {}
+    with open(journal_path, encoding="utf-8") as f, session_journal_lock(f, shared=True):
+        return session_journal_open_sessions(f)
+
+
+def session_journal_recover():
+    # Closes the sessions of dead processes, in their own transaction; returns the ids of the work rows recovered. The
+    # journal is then compacted to the lines of the sessions still open. The journal stays locked throughout, so that
+    # no session starts (nor another process recovers) between the read and the compaction.
+    journal_path = session_journal_path()
+    if not path.isfile(journal_path):
+        return []
+
+    with open(journal_path, "r+", encoding="utf-8") as f, session_journal_lock(f):
+        lines = f.readlines()
+        open_sessions = session_journal_open_sessions(lines)
+        recovered_work_ids = []
+        with transaction() as cursor:
+            for work_id, (pid, kind, dt_str) in list(open_sessions.items()):
+                if pid == session_journal_detached_pid or (pid != os.getpid() and _pid_alive(pid)):
+                    continue
+                del open_sessions[work_id]
+
+                # A running session ends at its last heartbeat; a paused one ended when it was paused (the pause is
+                # not work).
+                work = Work.get(work_id, cursor)
+                if work:
+                    end_dt = max(str_to_dt(dt_str), work.end_dt)
+                    work.save(end_dt, cursor)
+                    state_str = "while paused" if kind == "P" else "while running"
+                    Note.new(work.task_id, work.id, end_dt,
+                             f"Recovered a work session interrupted {state_str}; it was closed at its last heartbeat "
+                             f"({dt_to_str(end_dt)}).",
+                             "recover-work,end-work", cursor)
+                    recovered_work_ids.append(work_id)
+
+        # (Other processes append with O_APPEND, so their next lines land after the compacted ones.)
+        kept_lines = [line for line in lines if (session_journal_parse_line(line) or (None, None))[1] in open_sessions]
+        if len(kept_lines) < len(lines):
+            f.seek(0)
+            f.truncate()
+            f.writelines(kept_lines)
+    return recovered_work_ids
+
+
+#
+# Task-name tree: a prefix tree over the dotted task names, built once per process from `task` and kept up to date as
+# tasks are created or change status here (and rebuilt if another connection commits), so subtree queries and prefix
+# autocomplete need no `LIKE` scans.
+#
+
+class TaskTrieNode(object):
+    def __init__(self):
+        super().__init__()
+        self.children = {}
+        self.task = None
+        self.num_tasks = 0
+
+
+class TaskTrie(object):
+    def __init__(self, data_version):
+        super().__init__()
+        self.root = TaskTrieNode()
+        self.data_version = data_version
+        self.work_sec_stamp = None
+        self.work_sec_cache = {}
+
+    @staticmethod
+    def build(cursor):
+        trie = TaskTrie(cursor.execute("PRAGMA data_version").fetchone()[0])
+        res = cursor.execute("SELECT id, name, beg_epoch, cache_beg_dt, cache_status_code FROM task")
+        for id_, name, beg_epoch, beg_dt_str, status in res:
+            trie.add(Task(id_, name, db_dt(beg_epoch, beg_dt_str), status))
+        return trie
+
+    def add(self, task):
+        node = self.root
+        node.num_tasks += 1
+        for chunk in task.name.split("."):
+            node = node.children.setdefault(chunk, TaskTrieNode())
+            node.num_tasks += 1
+        node.task = task
+
+    def find(self, prefix):
+        node = self.root
+        if prefix:
+            for chunk in prefix.split("."):
+                node = node.children.get(chunk)
+                if node is None:
+                    return None
+        return node
+
+    def get_task(self, name):
+        node = self.find(name)
+        return node.task if node else None
+
+    def iter_tasks(self, prefix, only_open=False):
+        # Tasks named `prefix` or under `prefix.`, in name order.
+        node = self.find(prefix)
+        stack = [node] if node else []
+        while stack:
+            node = stack.pop()
+            if node.task and not (only_open and node.task.status != IN_PROGRESS_TASK_STATUS):
+                yield node.task
+            stack.extend(node.children[chunk] for chunk in sorted(node.children, reverse=True))
+
+    def complete(self, fragment):
+        # Returns `(prefix, num_tasks)` for every child of the fragment's parent whose chunk starts with its last chunk,
+        # e.g. 'ucla.f' -> [('ucla.f19', 12), ('ucla.f20', 9)].
+        head, _, tail = fragment.rpartition(".")
+        node = self.find(head)
+        if node is None:
+            return []
+        head_str = f"{head}." if head else ""
+        return [(head_str + chunk, child.num_tasks)
+                for chunk, child in sorted(node.children.items()) if chunk.startswith(tail) and child.num_tasks]
+
+    def subtree_work_sec(self, prefix, cursor):
+        # Total time worked (breaks excluded) on the tasks named `prefix` or under `prefix.`, archived ones included.
+        # Summed lazily per prefix from `task_stats`, over the subtree's range of the name indexes only, and kept until
+        # the next write on this connection (which may have added work) or rebuild.
+        stamp = (cursor.connection, cursor.connection.total_changes)
+        if self.work_sec_stamp != stamp:
+            self.work_sec_cache.clear()
+            self.work_sec_stamp = stamp
+        if prefix not in self.work_sec_cache:
+            lo, hi = task_name_prefix_bounds(prefix)
+            sql = "SELECT COALESCE(SUM(net_duration_sec - break_duration_sec), 0) FROM task_all"
+            if prefix:
+                sql += " WHERE name = :prefix OR (name >= :lo AND name < :hi)"
+            self.work_sec_cache[prefix] = cursor.execute(sql, {"prefix": prefix, "lo": lo, "hi": hi}).fetchone()[0]
+        return self.work_sec_cache[prefix]
+
+
+_task_trie = None
+
+
+def task_trie(cursor):
+    # NOTE: `data_version` only changes for commits made by *other* connections; our own writes update the tree as
+    # they happen (see `Task.new` and `Task.set_status`).
+    global _task_trie
+    if _task_trie is None or _task_trie.data_version != cursor.execute("PRAGMA data_version").fetchone()[0]:
+        _task_trie = TaskTrie.build(cursor)
+    return _task_trie
+
+
+#
+# Report export: `Task.export` streams a task's record into one of the `report_writers`. Rows are pulled with
+# `fetchmany` and written through a large file buffer, so exporting stays in constant memory however long the history.
+#
+
+report_fetch_size = 1024
+report_buffer_size = 1 << 16
+
+
+def fetch_iter(res, size=report_fetch_size):
+    while True:
+        rows = res.fetchmany(size)
+        if not rows:
+            return
+        yield from rows
+
+
+class ReportWriter(object):
+    # Subclasses override the hooks they need; `Task.export` calls them in the order they are defined here.
+    file_ext = None
+
+    def __init__(self, f):
+        super().__init__()
+        self.f = f
+
+    def begin(self, task, net_duration_sec, num_breaks, break_duration_sec):
+        pass
+
+    def begin_notes(self):
+        pass
+
+    def note(self, note_id, timestamp, opt_work_id, user_text, flow_text):
+        pass
+
+    def end_notes(self):
+        pass
+
+    def begin_works(self):
+        pass
+
+    def work(self, work_id, beg_dt, net_duration_sec, break_rows):
+        pass
+
+    def end_works(self):
+        pass
+
+    def end(self):
+        pass
+
+
+class HtmlReportWriter(ReportWriter):
+    file_ext = "html"
+
+    html_beg = """
+    <!DOCTYPE html>
+    <html lang="en">
+        <head>
+            <title>
+    """
+
+    html_mid = """
+            </title>
+            <style>
+                sys {
+                    font-family: "Lucida Console", Monaco, monospace;
+                    font-size: 0.8em;
+                }
+            </style>
+        </head>
+        <body>
+    """
+
+    html_end = "</body></html>\n"
+
+    def begin(self, task, net_duration_sec, num_breaks, break_duration_sec):
+        name = html.escape(task.name)
+        work_duration_sec = net_duration_sec - break_duration_sec
+        self.f.write(f"{self.html_beg}\n{name}\n{self.html_mid}\n"
+                     f"<h1><sys>{name}</sys></h1>\n"
+                     f"<p><sys>Status: {task.status_str()}</sys></p>\n"
+                     f"<p>You have spent {sec_to_hms_str(work_duration_sec)} working on this task so far. "
+                     f"That's a total of "
+                     f"{sec_to_hms_str(net_duration_sec)} with "
+                     f"{sec_to_hms_str(break_duration_sec)} spent on {num_breaks} breaks.</p>\n"
+                     f"<hr/>\n")
+
+    def begin_notes(self):
+        self.f.write("<h2><sys>Notes:</sys></h2>\n<ul>\n")
+
+    def note(self, note_id, timestamp, opt_work_id, user_text, flow_text):
+        self.f.write(f"<li>\n"
+                     f"<sys>[{timestamp}]</sys><br/>\n"
+                     f"{Note.html_print_user_text(user_text)}<br/>\n"
+                     f"<sys>{html.escape(flow_text)}</sys><br/>\n"
+                     f"<sys>Note ID: {note_id}</sys><br/>\n"
+                     f"<sys>Work ID: {opt_work_id}</sys>\n"
+                     f"</li>\n")
+
+    def end_notes(self):
+        self.f.write("</ul>\n<hr/>\n")
+
+    def begin_works(self):
+        self.f.write("<h2><sys>Work and Breaks:</sys></h2>\n<ul>\n")
+
+    def work(self, work_id, beg_dt, net_duration_sec, break_rows):
+        total_break_duration = sum(break_duration_sec for _, _, break_duration_sec in break_rows)
+        self.f.write(f"<li>\n"
+                     f"<sys>[{beg_dt}]</sys><br/>\n"
+                     f"<sys>Net duration: {sec_to_hms_str(net_duration_sec)}</sys><br/>\n"
+                     f"<sys>Breaks: {len(break_rows)} for {sec_to_hms_str(total_break_duration)}</sys><br/>\n"
+                     f"<ol>\n")
+        for break_id, break_beg_dt, break_duration_sec in break_rows:
+            self.f.write(f"<li><sys>Break ({break_id}) at [{break_beg_dt}] for "
+                         f"{sec_to_hms_str(break_duration_sec)}</sys></li>\n")
+        self.f.write("</ol>\n</li>\n")
+
+    def end_works(self):
+        self.f.write("</ul>\n")
+
+    def end(self):
+        self.f.write(self.html_end)
+
+
+class JsonLinesReportWriter(ReportWriter):
+    # One JSON object per line, tagged by "type": a "task" header, then "note"s, then "work"s (with their breaks).
+    file_ext = "jsonl"
+
+    def __init__(self, f):
+        super().__init__(f)
+        self.task_id = None
+
+    def write_record(self, record):
+        self.f.write(json.dumps(record))
+        self.f.write("\n")
+
+    def begin(self, task, net_duration_sec, num_breaks, break_duration_sec):
+        self.task_id = task.id
+        self.write_record({"type": "task", "id": task.id, "name": task.name, "beg_dt": dt_to_str(task.beg_dt),
+                           "status": task.status, "net_duration_sec": net_duration_sec, "num_breaks": num_breaks,
+                           "break_duration_sec": break_duration_sec})
+
+    def note(self, note_id, timestamp, opt_work_id, user_text, flow_text):
+        self.write_record({"type": "note", "id": note_id, "task_id": self.task_id, "timestamp": timestamp,
+                           "work_id": opt_work_id, "user_text": user_text, "flow_text": flow_text})
+
+    def work(self, work_id, beg_dt, net_duration_sec, break_rows):
+        self.write_record({"type": "work", "id": work_id, "task_id": self.task_id, "beg_dt": beg_dt,
+                           "net_duration_sec": net_duration_sec,
+                           "breaks": [{"id": break_id, "beg_dt": break_beg_dt, "duration_sec": break_duration_sec}
+                                      for break_id, break_beg_dt, break_duration_sec in break_rows]})
+
+
+class CsvReportWriter(ReportWriter):
+    # A single table; the "record" column says which row is the task, a note, a work session or a break, and so which
+    # of the other columns are filled in.
+    file_ext = "csv"
+    columns = ("record", "id", "task_id", "work_id", "timestamp", "duration_sec", "name", "status", "user_text",
+               "flow_text")
+
+    def __init__(self, f):
+        super().__init__(f)
+        import csv
+
+        self.csv_writer = csv.writer(f)
+        self.task_id = None
+
+    def begin(self, task, net_duration_sec, num_breaks, break_duration_sec):
+        self.task_id = task.id
+        self.csv_writer.writerow(self.columns)
+        self.csv_writer.writerow(("task", task.id, task.id, None, dt_to_str(task.beg_dt), net_duration_sec,
+                                  task.name, task.status, None, None))
+
+    def note(self, note_id, timestamp, opt_work_id, user_text, flow_text):
+        self.csv_writer.writerow(("note", note_id, self.task_id, opt_work_id, timestamp, None, None, None,
+                                  user_text, flow_text))
+
+    def work(self, work_id, beg_dt, net_duration_sec, break_rows):
+        self.csv_writer.writerow(("work", work_id, self.task_id, work_id, beg_dt, net_duration_sec, None, None, None,
+                                  None))
+        self.csv_writer.writerows(("break", break_id, self.task_id, work_id, break_beg_dt, break_duration_sec,
+                                   None, None, None, None)
+                                  for break_id, break_beg_dt, break_duration_sec in break_rows)
+
+
+report_writers = {
+    "html": HtmlReportWriter,
+    "jsonl": JsonLinesReportWriter,
+    "csv": CsvReportWriter,
+}
+
+
+#
+# Bulk export: renders every task under a name prefix into a directory. Tasks are spread over a process pool whose
+# workers each open their own read-only connection; the parent then writes an index page linking every report.
+#
+
+bulk_export_chunk_size = 64
+
+
+class BulkExportError(Exception):
+    pass
+
+_bulk_export_connection = None
+
+
+def _bulk_export_init(db_path_):
+    global db_path, _bulk_export_connection
+    db_path = db_path_
+    _bulk_export_connection = connect_read_only()
+
+
+def _bulk_export_task(job):
+    task_id, file_path, fmt = job
+    cursor = _bulk_export_connection.cursor()
+    task = Task.get(task_id, cursor)
+    task.export(file_path, fmt, cursor)
+    return task_id
+
+
+def bulk_export(prefix, dir_path, fmt="html", num_workers=None):
+    import urllib.parse
+    from concurrent.futures import ProcessPoolExecutor
+
+    if prefix:
+        lo, hi = task_name_prefix_bounds(prefix)
+        where_sql = "WHERE name=? OR (name >= ? AND name < ?) "
+        params = (prefix, lo, hi)
+    else:
+        where_sql = ""
+        params = ()
+    res = connect().execute("SELECT id, name, cache_status_code, net_duration_sec - break_duration_sec FROM task_all "
+                            f"{where_sql}ORDER BY name",
+                            params)
+    task_rows = res.fetchall()
+
+    os.makedirs(dir_path, exist_ok=True)
+    file_ext = report_writers[fmt].file_ext
+    # Names are quoted (with '/' too) into plain file names, so that none can point outside `dir_path`:
+    file_names = {task_id: f"{urllib.parse.quote(name, safe='')}.{file_ext}" for task_id, name, _, _ in task_rows}
+    jobs = [(task_id, path.join(dir_path, file_name), fmt) for task_id, file_name in file_names.items()]
+
+    # Workers must not share (or inherit) our connection:
+    disconnect()
+    try:
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_bulk_export_init,
+                                 initargs=(db_path,)) as executor:
+            for _ in executor.map(_bulk_export_task, jobs, chunksize=bulk_export_chunk_size):
+                pass
+    except Exception as e:
+        # (Whatever a worker raised, e.g. an `OSError` writing its file, or `BrokenProcessPool` if it died.)
+        raise BulkExportError(f"Exporting failed: {e}") from e
+
+    index_path = path.join(dir_path, "index.html")
+    with open(index_path, "w", buffering=report_buffer_size, encoding="utf-8") as f:
+        title = html.escape(prefix or "All tasks")
+        f.write(f"{HtmlReportWriter.html_beg}\n{title}\n{HtmlReportWriter.html_mid}\n"
+                f"<h1><sys>{title}</sys></h1>\n<ul>\n")
+        for task_id, name, status, work_duration_sec in task_rows:
+            status_str = Task(task_id, name, None, status).status_str()
+            link = urllib.parse.quote(file_names[task_id])
+            f.write(f"<li><a href=\"{link}\">{html.escape(name)}</a> "
+                    f"<sys>{status_str} {sec_to_hms_str(work_duration_sec or 0)}</sys></li>\n")
+        f.write(f"</ul>\n{HtmlReportWriter.html_end}")
+
+    return len(jobs)
+
+
+#
+# Bulk import: loads tasks, work sessions, breaks and notes from another tracker's CSV or JSON Lines export (including
+# our own JSON Lines reports). Each record is one object (or CSV row, with the keys as the header) tagged by "type":
+#   task:  name, [beg_dt], [status], [user_text] (its first note), [id]
+#   work:  task | task_id, beg_dt, end_dt | duration_sec | net_duration_sec, [breaks], [id]
+#   break: task | task_id, [work_id], beg_dt, end_dt | duration_sec   (defaults to the task's last imported work)
+#   note:  task | task_id, timestamp, user_text, [flow_text], [work_id]
+# `task` is a task name (created if new); `task_id` and `work_id` refer to the `id`s of records in the same file.
+# Row ids are assigned here and tasks are resolved through an in-memory map, so rows are inserted with
+# `executemany` in large batches, all in a single transaction. With `defer_indexes`, the indexes and triggers on the
+# core tables are dropped for the load and recreated after it, and the derived tables are rebuilt in one pass.
+#
+
+import_batch_size = 50000
+
+
+class DataImportError(Exception):
+    pass
+
+
+class Importer(object):
+    insert_sqls = (
+        ("task", "INSERT INTO task (id, name, cache_beg_dt, cache_status_code) VALUES (?,?,?,?)"),
+        ("work", "INSERT INTO work (id, task_id, cache_beg_dt, cache_end_dt, cache_duration_sec) VALUES (?,?,?,?,?)"),
+        ("break", "INSERT INTO break (task_id, work_id, beg_dt, end_dt, duration_sec) VALUES (?,?,?,?,?)"),
+        ("note", "INSERT INTO note (id, timestamp, task_id, opt_work_id, user_text, flow_text) VALUES (?,?,?,?,?,?)"),
+        ("note_tag", "INSERT INTO note_tag (tag, task_id, note_id) VALUES (?,?,?)"),
+    )
+
+    def __init__(self, cursor, batch_size=import_batch_size):
+        super().__init__()
+        self.cursor = cursor
+        self.batch_size = batch_size
+        # Archived tasks too: their names are taken, and they are copied back (once) when work is imported to them.
+        self.task_ids = dict(cursor.execute("SELECT name, id FROM task_all"))
+        self.archived_task_ids = set()
+        if archive_attached(cursor):
+            self.archived_task_ids.update(task_id for task_id, in cursor.execute(
+                "SELECT id FROM archive.task WHERE id NOT IN (SELECT id FROM main.task)"))
+        self.next_task_id = self._next_id("task")
+        self.next_work_id = self._next_id("work")
+        self.next_note_id = self._next_id("note")
+        self.file_task_ids = {}
+        self.file_work_ids = {}
+        self.missing_work_lines = {}
+        self.last_work_ids = {}
+        self.rows = {table: [] for table, _ in self.insert_sqls}
+        self.num_pending = 0
+        self.counts = collections.Counter()
+        self.line_num = 0
+
+    def _next_id(self, table):
+        # Past the largest id ever handed out (AUTOINCREMENT never reuses one), not just the largest present.
+        max_id = self.cursor.execute(f"SELECT MAX(id) FROM {table}").fetchone()[0] or 0
+        row = self.cursor.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (table,)).fetchone()
+        return max(max_id, row[0] if row else 0) + 1
+
+    def fail(self, msg):
+        raise DataImportError(f"Line {self.line_num}: {msg}")
+
+    def dt_str(self, record, key):
+        s = record.get(key)
+        if not isinstance(s, str) or not re.fullmatch(dt_fmt_str_re, s):
+            self.fail(f"{repr(key)} must be a date-time formatted as 'YYYY-MM-DD HH:MM:SS'.")
+        return s
+
+    def int_value(self, record, key):
+        try:
+            return int(record[key])
+        except (TypeError, ValueError):
+            self.fail(f"{repr(key)} must be an integer.")
+
+    # NOTE: Strings already checked against `dt_fmt_str_re` are ISO 8601, which this parses far faster than `strptime`.
+    parse_dt = staticmethod(datetime.datetime.fromisoformat)
+
+    def end_and_duration(self, record, beg_dt_str, duration_keys):
+        # Returns `(end_dt_str, duration_sec)` from whichever of the end time or the duration the record has.
+        if record.get("end_dt") is not None:
+            end_dt_str = self.dt_str(record, "end_dt")
+            duration_sec = round_sec_to_int((self.parse_dt(end_dt_str) - self.parse_dt(beg_dt_str)).total_seconds())
+            if duration_sec < 0:
+                self.fail("'end_dt' is before 'beg_dt'.")
+            return end_dt_str, duration_sec
+        for key in duration_keys:
+            if record.get(key) is not None:
+                duration_sec = self.int_value(record, key)
+                end_dt = self.parse_dt(beg_dt_str) + datetime.timedelta(seconds=duration_sec)
+                return end_dt.isoformat(sep=" "), duration_sec
+        self.fail(f"Either 'end_dt' or {repr(duration_keys[0])} is required.")
+
+    def add_row(self, table, row):
+        self.rows[table].append(row)
+        self.counts[table] += 1
+        self.num_pending += 1
+        if self.num_pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        # Parents before children, so every row's task (and work) is already in when it goes in.
+        for table, sql in self.insert_sqls:
+            if self.rows[table]:
+                self.cursor.executemany(sql, self.rows[table])
+                self.rows[table].clear()
+        self.num_pending = 0
+
+    def add_note_row(self, timestamp, task_id, work_id, user_text, flow_text):
+        note_id = self.next_note_id
+        self.next_note_id += 1
+        self.add_row("note", (note_id, timestamp, task_id, work_id, user_text, flow_text))
+        for tag_row in note_tag_rows(note_id, task_id, user_text):
+            self.add_row("note_tag", tag_row)
+
+    def new_task(self, name, beg_dt_str, status, user_text):
+        res = task_name_validator(name)
+        if not res:
+            self.fail(res.msg)
+        task_id = self.next_task_id
+        self.next_task_id += 1
+        self.task_ids[name] = task_id
+        self.add_row("task", (task_id, name, beg_dt_str, status))
+        self.add_note_row(beg_dt_str, task_id, None, user_text, "new-task,open-task,import-task")
+        return task_id
+
+    def task_id(self, record, beg_dt_str):
+        # The live task a work session, break or note goes to.
+        if record.get("task_id") is not None:
+            file_task_id = self.int_value(record, "task_id")
+            if file_task_id not in self.file_task_ids:
+                self.fail(f"No 'task' record with id {file_task_id} precedes this one.")
+            task_id = self.file_task_ids[file_task_id]
+        else:
+            name = record.get("task")
+            if not isinstance(name, str):
+                self.fail("Either 'task' or 'task_id' is required.")
+            task_id = self.task_ids.get(name)
+            if task_id is None:
+                task_id = self.new_task(name, beg_dt_str, IN_PROGRESS_TASK_STATUS, "Imported.")
+        if task_id in self.archived_task_ids:
+            self.archived_task_ids.discard(task_id)
+            archive_restore(task_id, self.cursor)
+        return task_id
+
+    def work_id(self, record, key):
+        # Ids of sessions referenced before (or without) their own record are reserved now, and used when it comes.
+        file_work_id = self.int_value(record, key)
+        work_id = self.file_work_ids.get(file_work_id)
+        if work_id is None:
+            work_id = self.file_work_ids[file_work_id] = self.next_work_id
+            self.next_work_id += 1
+            self.missing_work_lines[file_work_id] = self.line_num
+        return work_id
+
+    def add_task(self, record):
+        name = record.get("name")
+        if not isinstance(name, str):
+            self.fail("'name' is required.")
+        if name in self.task_ids:
+            task_id = self.task_ids[name]
+        else:
+            beg_dt_str = self.dt_str(record, "beg_dt") if record.get("beg_dt") is not None else dt_to_str(
+                datetime.datetime.now())
+            status = self.int_value(record, "status") if record.get("status") is not None else IN_PROGRESS_TASK_STATUS
+            if status not in (IN_PROGRESS_TASK_STATUS, COMPLETE_TASK_STATUS, ABANDONED_TASK_STATUS):
+                self.fail(f"Unknown task status {status}.")
+            task_id = self.new_task(name, beg_dt_str, status, record.get("user_text") or "Imported.")
+        if record.get("id") is not None:
+            self.file_task_ids[self.int_value(record, "id")] = task_id
+
+    def add_work(self, record):
+        beg_dt_str = self.dt_str(record, "beg_dt")
+        task_id = self.task_id(record, beg_dt_str)
+        end_dt_str, duration_sec = self.end_and_duration(record, beg_dt_str, ("duration_sec", "net_duration_sec"))
+        if record.get("id") is not None:
+            file_work_id = self.int_value(record, "id")
+            if file_work_id in self.file_work_ids and file_work_id not in self.missing_work_lines:
+                self.fail(f"A 'work' record with id {file_work_id} precedes this one.")
+            work_id = self.work_id(record, "id")
+            self.missing_work_lines.pop(file_work_id)
+        else:
+            work_id = self.next_work_id
+            self.next_work_id += 1
+        self.last_work_ids[task_id] = work_id
+        self.add_row("work", (work_id, task_id, beg_dt_str, end_dt_str, duration_sec))
+        breaks = record.get("breaks") or []
+        if not isinstance(breaks, list):
+            self.fail("'breaks' must be a list of break records.")
+        for break_record in breaks:
+            self.add_break_row(task_id, work_id, break_record)
+
+    def add_break_row(self, task_id, work_id, record):
+        if not isinstance(record, dict):
+            self.fail("Break records must be objects.")
+        beg_dt_str = self.dt_str(record, "beg_dt")
+        end_dt_str, duration_sec = self.end_and_duration(record, beg_dt_str, ("duration_sec",))
+        self.add_row("break", (task_id, work_id, beg_dt_str, end_dt_str, duration_sec))
+
+    def add_break(self, record):
+        task_id = self.task_id(record, self.dt_str(record, "beg_dt"))
+        if record.get("work_id") is not None:
+            work_id = self.work_id(record, "work_id")
+        elif task_id in self.last_work_ids:
+            work_id = self.last_work_ids[task_id]
+        else:
+            self.fail("A 'break' needs a 'work_id', or a preceding 'work' record of its task.")
+        self.add_break_row(task_id, work_id, record)
+
+    def add_note(self, record):
+        timestamp = self.dt_str(record, "timestamp")
+        task_id = self.task_id(record, timestamp)
+        work_id = self.work_id(record, "work_id") if record.get("work_id") is not None else None
+        user_text = record.get("user_text")
+        if not isinstance(user_text, str):
+            self.fail("'user_text' is required.")
+        flow_text = record.get("flow_text") or ""
+        if not isinstance(flow_text, str):
+            self.fail("'flow_text' must be a string.")
+        self.add_note_row(timestamp, task_id, work_id, user_text, flow_text)
+
+    def add(self, line_num, record):
+        self.line_num = line_num
+        if not isinstance(record, dict):
+            self.fail("Records must be objects.")
+        adder = {
+            "task": self.add_task,
+            "work": self.add_work,
+            "break": self.add_break,
+            "note": self.add_note,
+        }.get(record.get("type"))
+        if adder is None:
+            self.fail(f"Unknown record type {repr(record.get('type'))}.")
+        adder(record)
+
+    def finish(self):
+        # Inserts what is left, once every work session referenced by id has had its record.
+        # NOTE: Otherwise the deferred foreign keys would only fail at COMMIT, with no line to point at.
+        if self.missing_work_lines:
+            file_work_id, self.line_num = min(self.missing_work_lines.items(), key=lambda item: item[1])
+            self.fail(f"No 'work' record with id {file_work_id} in the file.")
+        self.flush()
+
+
+def import_records(file_path, fmt):
+    # Yields `(line_num, record)`. Empty CSV cells count as missing keys.
+    with open(file_path, "r", buffering=report_buffer_size, encoding="utf-8", newline="") as f:
+        if fmt == "csv":
+            import csv
+
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, {key: value for key, value in record.items() if value not in ("", None)}
+        else:
+            for line_num, line in enumerate(f, start=1):
+                if line.strip():
+                    try:
+                        yield line_num, json.loads(line)
+                    except ValueError as e:
+                        raise DataImportError(f"Line {line_num}: {e}")
+
+
+def db_deferrable_schema(cursor):
+    # The indexes and triggers of the core tables, as `(name, sql)`. (Implicit UNIQUE indexes have no SQL; they stay.)
+    cursor.execute("SELECT type, name, sql FROM sqlite_master "
+                   "WHERE type IN ('index', 'trigger') AND sql IS NOT NULL "
+                   "AND tbl_name IN ('task', 'work', 'break', 'note')")
+    return cursor.fetchall()
+
+
+def db_rebuild_derived(cursor):
+    # Recomputes every table derived from the core ones, e.g. after writes that bypassed their triggers.
+    cursor.execute("INSERT INTO task_search (task_search) VALUES ('rebuild')")
+    cursor.execute("INSERT INTO note_search (note_search) VALUES ('rebuild')")
+    task_stats_rebuild(cursor)
+    sync_backfill(cursor)
+
+
+def bulk_import(file_path, fmt=None, defer_indexes=False, batch_size=import_batch_size):
+    if fmt is None:
+        fmt = "csv" if file_path.lower().endswith(".csv") else "jsonl"
+    return bulk_import_records(import_records(file_path, fmt), defer_indexes, batch_size)
+
+
+def bulk_import_records(numbered_records, defer_indexes=False, batch_size=import_batch_size):
+    # Imports `(line_num, record)`s (as yielded by `import_records`) and returns the number of rows added per table.
+    global _task_trie
+
+    connection = connect()
+    cursor = connection.cursor()
+    with connection:
+        # NOTE: As in `db_migrate`, we open the transaction ourselves so that the DDL below is part of it too.
+        cursor.execute("BEGIN")
+        # Notes may name a work session whose record comes later (as in our own reports).
+        cursor.execute("PRAGMA defer_foreign_keys=ON")
+        deferred = db_deferrable_schema(cursor) if defer_indexes else ()
+        for kind, name, _ in deferred:
+            cursor.execute(f"DROP {kind.upper()} {name}")
+
+        importer = Importer(cursor, batch_size)
+        for line_num, record in numbered_records:
+            importer.add(line_num, record)
+        importer.finish()
+
+        for _, _, sql in deferred:
+            cursor.execute(sql)
+        if defer_indexes:
+            db_rebuild_derived(cursor)
+
+    _task_trie = None
+    return dict(importer.counts)
+
+
+#
+# Archive: closed tasks with no recent activity move, with their work sessions, breaks, notes and totals, to
+# `archive.db` (next to the main DB), which is ATTACHed as `archive` whenever it exists. The live tables, and with them
+# the indexes, search indexes and task trie that open-task lookups go through, then hold only current history. A task
+# missing from the live tables is looked up in the archive (`Task.get`, `Task.get_by_name`, `Task.export`), and writing
+# to an archived task (re-opening it, adding a note or a work session) first copies it back.
+# NOTE: With the main DB in WAL mode, a transaction spanning both files is atomic in each of them but not across them.
+# So no transaction deletes a task from one file while writing it to the other: a move copies the tasks to the archive
+# and commits, then deletes them from the live tables, and a task copied back keeps its archive copy. Where a task is in
+# both, the live one is read, and the stale archive copy is purged by the next move.
+#
+
+archive_after_days = 180
+
+archive_tables = (
+    # (table, column holding the task id, columns copied), parents first.
+    ("task", "id", "id, name, cache_beg_dt, cache_status_code"),
+    ("task_stats", "task_id",
+     "task_id, net_duration_sec, num_sessions, num_breaks, break_duration_sec, last_activity_dt"),
+    ("work", "task_id", "id, task_id, cache_beg_dt, cache_end_dt, cache_duration_sec"),
+    ("break", "task_id", "id, task_id, work_id, beg_dt, end_dt, duration_sec"),
+    ("note", "task_id", "id, timestamp, task_id, opt_work_id, user_text, flow_text"),
+)
+
+archive_schema_sql = (
+    "CREATE TABLE IF NOT EXISTS archive.task (id INTEGER PRIMARY KEY, name TEXT UNIQUE, cache_beg_dt TEXT, "
+    "cache_status_code INTEGER, "
+    "beg_epoch INTEGER GENERATED ALWAYS AS (CAST(strftime('%s', cache_beg_dt) AS INTEGER)) VIRTUAL)",
+    "CREATE TABLE IF NOT EXISTS archive.task_stats (task_id INTEGER PRIMARY KEY, net_duration_sec INTEGER, "
+    "num_sessions INTEGER, num_breaks INTEGER, break_duration_sec INTEGER, last_activity_dt TEXT)",
+    "CREATE TABLE IF NOT EXISTS archive.work (id INTEGER PRIMARY KEY, task_id INTEGER, cache_beg_dt TEXT, "
+    "cache_end_dt TEXT, cache_duration_sec INTEGER)",
+    "CREATE TABLE IF NOT EXISTS archive.break (id INTEGER PRIMARY KEY, task_id INTEGER, work_id INTEGER, "
+    "beg_dt TEXT, end_dt TEXT, duration_sec INTEGER)",
+    "CREATE TABLE IF NOT EXISTS archive.note (id INTEGER PRIMARY KEY, timestamp TEXT, task_id INTEGER, "
+    "opt_work_id INTEGER, user_text TEXT, flow_text TEXT)",
+    "CREATE INDEX IF NOT EXISTS archive.work_task_idx ON work (task_id, cache_beg_dt)",
+    "CREATE INDEX IF NOT EXISTS archive.break_work_idx ON break (work_id)",
+    "CREATE INDEX IF NOT EXISTS archive.break_task_idx ON break (task_id)",
+    "CREATE INDEX IF NOT EXISTS archive.note_task_idx ON note (task_id, timestamp)",
+)
+
+# Views over the live and the archived rows together, for the reads that span every task (listings, totals,
+# analytics): (view, table, key, the select from the live schema, the same from the archive, with `{schema}` to fill
+# in). A row in both is read from the live table. They are TEMP views, made per connection by `archive_views`.
+archive_task_all_sql = (
+    "task.id, name, cache_beg_dt, cache_status_code, beg_epoch, net_duration_sec, break_duration_sec, "
+    "last_activity_dt FROM {schema}.task LEFT JOIN {schema}.task_stats ON task_stats.task_id = task.id"
+)
+archive_views_sql = (
+    ("task_all", "task", "id", archive_task_all_sql, archive_task_all_sql),
+    ("work_all", "work", "id",
+     "id, task_id, cache_beg_dt, cache_end_dt, cache_duration_sec, beg_epoch, end_epoch FROM {schema}.work",
+     "id, task_id, cache_beg_dt, cache_end_dt, cache_duration_sec, CAST(strftime('%s', cache_beg_dt) AS INTEGER), "
+     "CAST(strftime('%s', cache_end_dt) AS INTEGER) FROM {schema}.work"),
+    ("break_all", "break", "id",
+     "id, task_id, work_id, beg_dt, end_dt, duration_sec, beg_epoch, end_epoch FROM {schema}.break",
+     "id, task_id, work_id, beg_dt, end_dt, duration_sec, CAST(strftime('%s', beg_dt) AS INTEGER), "
+     "CAST(strftime('%s', end_dt) AS INTEGER) FROM {schema}.break"),
+)
+
+# The live tasks due to be archived, given the `(complete, abandoned, before_dt)` parameters:
+archive_due_sql = ("SELECT task.id FROM main.task JOIN main.task_stats ON task_stats.task_id = task.id "
+                   "WHERE task.cache_status_code IN (?,?) AND task_stats.last_activity_dt < ?")
+
+
+def archive_path(main_db_path=None):
+    # The archive of the main DB at `main_db_path` (by default, ours).
+    return path.join(path.dirname(main_db_path or db_path), "archive.db")
+
+
+def archive_attach(connection, read_only=False, main_db_path=None):
+    # NOTE: ATTACH can't run inside a transaction. A read-only `connection` must have been opened with `uri=True`.
+    if read_only:
+        import urllib.parse
+
+        uri = "file:" + urllib.parse.quote(path.abspath(archive_path(main_db_path))) + "?mode=ro"
+        connection.execute("ATTACH DATABASE ? AS archive", (uri,))
+    else:
+        connection.execute("ATTACH DATABASE ? AS archive", (archive_path(main_db_path),))
+        db_enable_wal(connection, "archive")
+
+
+def archive_views(connection):
+    # (Re)makes the `archive_views_sql` views on `connection`, over the archive too if it is attached.
+    # NOTE: Views are only checked when used, so they can be made before the tables they read exist.
+    attached = archive_attached(connection.cursor())
+    for view, table, key, live_sql, archived_sql in archive_views_sql:
+        sql = f"CREATE TEMP VIEW {view} AS SELECT {live_sql.format(schema='main')}"
+        if attached:
+            sql += (f" UNION ALL SELECT {archived_sql.format(schema='archive')} "
+                    f"WHERE NOT EXISTS (SELECT 1 FROM main.{table} AS live WHERE live.{key} = {table}.{key})")
+        connection.execute(f"DROP VIEW IF EXISTS temp.{view}")
+        connection.execute(sql)
+
+
+def archive_attached(cursor):
+    return cursor.connection.execute("SELECT 1 FROM pragma_database_list WHERE name='archive'").fetchone() is not None
+
+
+def fetchone_or_archived(sql, params, cursor):
+    # Runs `sql`, which names its tables `{schema}.<table>`, on the live tables, then (if it found nothing) on the
+    # archive.
+    row = cursor.execute(sql.format(schema="main"), params).fetchone()
+    if row is None and archive_attached(cursor):
+        row = cursor.execute(sql.format(schema="archive"), params).fetchone()
+    return row
+
+
+def task_schema(task_id, cursor):
+    # The schema holding task `task_id`'s rows: "main", unless it is archived.
+    row = fetchone_or_archived("SELECT '{schema}' FROM {schema}.task WHERE id=?", (task_id,), cursor)
+    return row[0] if row else "main"
+
+
+def archive_tasks(before_dt_str):
+    # Moves the closed tasks with no activity since `before_dt_str` to the archive (created if need be). Returns the
+    # number of tasks moved.
+    global _task_trie
+
+    connection = connect()
+    if not archive_attached(connection.cursor()):
+        archive_attach(connection)
+        archive_views(connection)
+    params = (COMPLETE_TASK_STATUS, ABANDONED_TASK_STATUS, before_dt_str)
+
+    # Copying:
+    with transaction() as cursor:
+        cursor.execute("BEGIN")
+        for sql in archive_schema_sql:
+            cursor.execute(sql)
+        # Stale copies of the tasks that have been copied back:
+        for table, task_id_column, _ in reversed(archive_tables):
+            cursor.execute(f"DELETE FROM archive.{table} WHERE {task_id_column} IN "
+                           "(SELECT archived.id FROM archive.task AS archived JOIN main.task AS live USING (id))")
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS archive_batch (task_id INTEGER PRIMARY KEY)")
+        cursor.execute("DELETE FROM temp.archive_batch")
+        cursor.execute("INSERT INTO temp.archive_batch " + archive_due_sql, params)
+        for table, task_id_column, columns in archive_tables:
+            cursor.execute(f"INSERT INTO archive.{table} ({columns}) SELECT {columns} FROM main.{table} "
+                           f"WHERE {task_id_column} IN (SELECT task_id FROM temp.archive_batch)")
+
+    # Deleting (children first; `task_stats`, `note_tag` and the search indexes follow by trigger):
+    with transaction() as cursor:
+        cursor.execute("BEGIN IMMEDIATE")
+        # Tasks written to (e.g. re-opened) since they were copied stay live:
+        cursor.execute(f"DELETE FROM temp.archive_batch WHERE task_id NOT IN ({archive_due_sql})", params)
+        num_archived = cursor.execute("SELECT COUNT(*) FROM temp.archive_batch").fetchone()[0]
+        for table in ("note", "break", "work", "task"):
+            task_id_column = "id" if table == "task" else "task_id"
+            cursor.execute(f"DELETE FROM main.{table} "
+                           f"WHERE {task_id_column} IN (SELECT task_id FROM temp.archive_batch)")
+        cursor.execute("DELETE FROM temp.archive_batch")
+
+    _task_trie = None
+    model_caches_clear()
+    return num_archived
+
+
+def archive_insert(sql, params, task_id, cursor):
+    # Runs the INSERT `sql` of a row of task `task_id`, first copying the task back if it is archived. That is only
+    # looked into when the insert fails (on its foreign key, the task being missing from the live tables), so writes to
+    # live tasks cost no extra query.
+    try:
+        cursor.execute(sql, params)
+    except sqlite3.IntegrityError:
+        if not archive_restore(task_id, cursor):
+            raise
+        cursor.execute(sql, params)
+
+
+def archive_restore(task_id, cursor):
+    # Copies task `task_id` back to the live tables if it is archived (but only there). Returns whether it was.
+    if not archive_attached(cursor) or cursor.execute("SELECT 1 FROM main.task WHERE id=?", (task_id,)).fetchone():
+        return False
+    if not cursor.execute("SELECT 1 FROM archive.task WHERE id=?", (task_id,)).fetchone():
+        return False
+
+    # (`task_stats` is recomputed by the triggers as the rows go in.)
+    for table, task_id_column, columns in archive_tables:
+        if table != "task_stats":
+            cursor.execute(f"INSERT INTO main.{table} ({columns}) SELECT {columns} FROM archive.{table} "
+                           f"WHERE {task_id_column}=? ORDER BY id", (task_id,))
+    res = cursor.execute("SELECT id, user_text FROM main.note WHERE task_id=? AND user_text LIKE '%#%'", (task_id,))
+    cursor.executemany("INSERT INTO note_tag (tag, task_id, note_id) VALUES (?,?,?)",
+                       [tag_row for note_id, user_text in res.fetchall()
+                        for tag_row in note_tag_rows(note_id, task_id, user_text)])
+
+    if _task_trie is not None:
+        _task_trie.add(Task.get(task_id, cursor))
+    return True
+
+
+#
+# Sync: `sync_pull` applies to one replica, in one transaction, the changes another has logged since the last pull from
+# it (its watermark, in `sync_peer`); `sync` pulls both ways between two DB files. Only the change log past the
+# watermark is read, so a pull costs time in proportion to the changes rather than to the DB. Changes that came from the
+# replica pulling are skipped, so nothing echoes back, while those from third replicas are passed on. Conflicts resolve
+# the same way whatever order the replicas sync in:
+#   - a new task whose name is taken is the same task (created on both replicas), which then has two global ids;
+#   - of two versions of a work session, the longer (later-ending) one wins, as sessions only ever grow;
+#   - otherwise (e.g. a task's status), the later change wins, ties going to the higher replica id.
+#
+
+class SyncError(Exception):
+    pass
+
+
+def sync_connect(file_path):
+    # A connection to the replica at `file_path` (with its archive, if any).
+    connection = sqlite3.connect(file_path)
+    connection.execute("PRAGMA foreign_keys=ON")
+    if path.exists(archive_path(file_path)):
+        archive_attach(connection, main_db_path=file_path)
+    return connection
+
+
+def sync_replica_id(cursor):
+    return cursor.execute("SELECT id FROM sync_replica").fetchone()[0]
+
+
+def sync_guid_sql(table, row_id_sql):
+    # The global id sent for a row: the first one it was given.
+    return f"(SELECT guid FROM sync_guid WHERE tbl = '{table}' AND row_id = {row_id_sql} ORDER BY rowid LIMIT 1)"
+
+
+def sync_changes(table, foreign_keys, columns, after_seq, until_seq, dst_id, cursor):
+    # Yields `(change_dt, origin, guid, *values)` for each row of `table` logged in `(after_seq, until_seq]` (in log
+    # order), with foreign keys as global ids, for replica `dst_id`. Archived rows are read from the archive.
+    # The changes that came from `dst_id` are echoes, and skipped, unless `dst_id` may not know the row's global id:
+    # that of a task created on two replicas is one of the two.
+    values_sql = ", ".join(sync_guid_sql(foreign_keys[column], f"t.{column}") if column in foreign_keys
+                           else f"t.{column}" for column in columns)
+    for schema in ("main", "archive") if archive_attached(cursor) else ("main",):
+        sql = (f"SELECT c.change_dt, c.origin, {sync_guid_sql(table, 'c.row_id')} AS guid, {values_sql} "
+               f"FROM changelog AS c JOIN {schema}.{table} AS t ON t.id = c.row_id "
+               f"WHERE c.tbl = :table AND c.seq > :after_seq AND c.seq <= :until_seq "
+               f"AND (c.origin != :dst_id OR instr(guid, :dst_id || ':') != 1)")
+        if schema == "archive":
+            sql += f" AND NOT EXISTS (SELECT 1 FROM main.{table} WHERE id = c.row_id)"
+        params = {"table": table, "after_seq": after_seq, "until_seq": until_seq, "dst_id": dst_id}
+        yield from fetch_iter(cursor.execute(sql + " ORDER BY c.seq", params))
+
+
+def sync_row_id(table, guid, cursor):
+    row = cursor.execute("SELECT row_id FROM sync_guid WHERE tbl=? AND guid=?", (table, guid)).fetchone()
+    return row[0] if row else None
+
+
+def sync_apply(table, foreign_keys, columns, change, cursor):
+    # Applies one change read by `sync_changes`, unless the local version wins. Returns whether it was applied.
+    change_dt, origin, guid, *values = change
+    if table == "task" and not task_name_validator(values[0]):
+        raise SyncError(f"The task {guid} has the invalid name {repr(values[0])}.")
+    for i, column in enumerate(columns):
+        if column in foreign_keys and values[i] is not None:
+            parent_guid = values[i]
+            values[i] = sync_row_id(foreign_keys[column], parent_guid, cursor)
+            if values[i] is None:
+                raise SyncError(f"The {table} {guid} refers to the unknown {foreign_keys[column]} {parent_guid}.")
+
+    row_id = sync_row_id(table, guid, cursor)
+    if row_id is None and table == "task":
+        task = Task.get_by_name(values[0], cursor)
+        if task:
+            row_id = task.id
+            cursor.execute("INSERT INTO sync_guid (tbl, row_id, guid) VALUES (?,?,?)", (table, row_id, guid))
+
+    if row_id is not None:
+        remote_version = (change_dt, origin)
+        local_version = cursor.execute("SELECT change_dt, origin FROM changelog WHERE tbl=? AND row_id=?",
+                                       (table, row_id)).fetchone()
+        if table == "work":
+            remote_version = (values[2], values[3]) + remote_version
+            local_version = fetchone_or_archived("SELECT cache_end_dt, cache_duration_sec FROM {schema}.work "
+                                                 "WHERE id=?", (row_id,), cursor) + local_version
+        if table == "task":
+            # A task created on both replicas began when the first of the two did, whichever change is later: only
+            # its status follows the later change.
+            (local_beg_dt,) = fetchone_or_archived("SELECT cache_beg_dt FROM {schema}.task WHERE id=?", (row_id,),
+                                                   cursor)
+            values[1] = min(local_beg_dt, values[1])
+            if remote_version <= local_version:
+                if values[1] == local_beg_dt:
+                    return False
+                archive_restore(row_id, cursor)
+                cursor.execute("UPDATE task SET cache_beg_dt=? WHERE id=?", (values[1], row_id))
+                return True
+        if remote_version <= local_version:
+            return False
+
+    archive_restore(row_id if table == "task" else values[columns.index("task_id")], cursor)
+    if row_id is None:
+        cursor.execute(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", values)
+        row_id = cursor.lastrowid
+        cursor.execute("INSERT INTO sync_guid (tbl, row_id, guid) VALUES (?,?,?)", (table, row_id, guid))
+    elif table == "task":
+        cursor.execute("UPDATE task SET cache_beg_dt=?, cache_status_code=? WHERE id=?", (*values[1:], row_id))
+    else:
+        cursor.execute(f"UPDATE {table} SET {', '.join(f'{column}=?' for column in columns)} WHERE id=?",
+                       (*values, row_id))
+    if table == "note":
+        # (The tags aren't kept by triggers: see `note_tag_sql`.)
+        cursor.execute("DELETE FROM note_tag WHERE note_id=?", (row_id,))
+        cursor.executemany("INSERT INTO note_tag (tag, task_id, note_id) VALUES (?,?,?)",
+                           note_tag_rows(row_id, values[1], values[3]))
+    cursor.execute("INSERT OR REPLACE INTO changelog (tbl, row_id, change_dt, origin) VALUES (?,?,?,?)",
+                   (table, row_id, change_dt, origin))
+    return True
+
+
+def sync_pull(src_connection, dst_connection):
+    # Applies to `dst_connection`'s replica the changes logged by `src_connection`'s since `dst_connection`'s last pull
+    # from it. Returns the number of changes applied.
+    src_cursor = src_connection.cursor()
+    dst_cursor = dst_connection.cursor()
+    src_id, dst_id = sync_replica_id(src_cursor), sync_replica_id(dst_cursor)
+    if src_id == dst_id:
+        raise SyncError(f"Both DBs are replica {src_id}: one is a copy of the other, and they can't be synced.")
+
+    num_applied = 0
+    with dst_connection:
+        dst_cursor.execute("BEGIN IMMEDIATE")
+        # (Reading the source from a single snapshot:)
+        src_cursor.execute("BEGIN")
+        try:
+            row = dst_cursor.execute("SELECT pulled_seq FROM sync_peer WHERE replica_id=?", (src_id,)).fetchone()
+            after_seq = row[0] if row else 0
+            until_seq = src_cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM changelog").fetchone()[0]
+
+            dst_cursor.execute("UPDATE sync_replica SET applying = 1")
+            # Parents first (each table's rows being referenced only by the tables after it):
+            for table, foreign_keys, columns in sync_tables:
+                for change in sync_changes(table, foreign_keys, columns, after_seq, until_seq, dst_id, src_cursor):
+                    num_applied += sync_apply(table, foreign_keys, columns, change, dst_cursor)
+            dst_cursor.execute("UPDATE sync_replica SET applying = 0")
+            dst_cursor.execute("INSERT OR REPLACE INTO sync_peer (replica_id, pulled_seq) VALUES (?,?)",
+                               (src_id, until_seq))
+        finally:
+            src_connection.rollback()
+    return num_applied
+
+
+def sync(file_path):
+    # Pulls from the replica at `file_path`, then pushes to it. Returns `(num_pulled, num_pushed)`.
+    global _task_trie
+
+    connection = connect()
+    other_connection = sync_connect(file_path)
+    try:
+        version = db_schema_version(connection.cursor())
+        other_version = db_schema_version(other_connection.cursor())
+        if version != other_version:
+            raise SyncError(f"{repr(file_path)} is at schema version {other_version}, not {version}. "
+                            f"(Run this version of flow on it once first.)")
+        num_pulled = sync_pull(other_connection, connection)
+        num_pushed = sync_pull(connection, other_connection)
+    finally:
+        other_connection.close()
+        _task_trie = None
+        model_caches_clear()
+    return num_pulled, num_pushed
+
+
+#
+# Analytics: work and break intervals are loaded once into columnar arrays of epoch seconds (naive local time, i.e. the
+# stored text read as if it were UTC). Per-bucket totals come from a coverage function evaluated at bucket boundaries
+# over sorted endpoints and their prefix sums, so the cost is one sort plus O(log n) per bucket, and no Python-level
+# loop ever runs per interval.
+#
+
+sec_per_hour = 60 * 60
+sec_per_day = 24 * sec_per_hour
+sec_per_week = 7 * sec_per_day
+
+
+class IntervalSet(object):
+    def __init__(self, begs, ends):
+        super().__init__()
+        self.begs = array.array("q", sorted(begs))
+        self.ends = array.array("q", sorted(ends))
+        self.beg_sums = array.array("q", itertools.accumulate(self.begs, initial=0))
+        self.end_sums = array.array("q", itertools.accumulate(self.ends, initial=0))
+
+    def __len__(self):
+        return len(self.begs)
+
+    def span(self):
+        if self.begs:
+            return self.begs[0], self.ends[-1]
+        else:
+            return None
+
+    def coverage(self, t):
+        # Total seconds covered by the intervals before `t`: sum of max(t - beg, 0) - max(t - end, 0).
+        i = bisect.bisect_left(self.begs, t)
+        j = bisect.bisect_left(self.ends, t)
+        return (i * t - self.beg_sums[i]) - (j * t - self.end_sums[j])
+
+    def bucket_totals(self, beg, width, num_buckets):
+        coverages = list(map(self.coverage, range(beg, beg + width * (num_buckets + 1), width)))
+        return list(map(operator.sub, coverages[1:], coverages[:-1]))
+
+
+class TimeAnalytics(object):
+    def __init__(self, work, breaks):
+        super().__init__()
+        self.work = work
+        self.breaks = breaks
+
+    @staticmethod
+    def load(cursor, prefix=None):
+        if prefix:
+            lo, hi = task_name_prefix_bounds(prefix)
+            join_sql = (" JOIN task_all AS task ON task.id = task_id "
+                        "WHERE (task.name=? OR (task.name >= ? AND task.name < ?)) AND ")
+            params = (prefix, lo, hi)
+        else:
+            join_sql = " WHERE "
+            params = ()
+
+        def _load(table):
+            # (As in `Timeline.load`, rows without both ends, e.g. with date-times SQLite can't read, are left out.)
+            rows = cursor.execute(f"SELECT {table}.beg_epoch, {table}.end_epoch FROM {table}_all AS {table}" +
+                                  join_sql + f"{table}.beg_epoch IS NOT NULL AND {table}.end_epoch IS NOT NULL",
+                                  params).fetchall()
+            begs, ends = zip(*rows) if rows else ((), ())
+            return IntervalSet(begs, ends)
+
+        work = _load("work")
+        breaks = _load("break")
+        return TimeAnalytics(work, breaks)
+
+    def bucket_totals(self, beg, width, num_buckets):
+        # Seconds worked (breaks excluded) in each of `num_buckets` buckets of `width` seconds from `beg`.
+        work_totals = self.work.bucket_totals(beg, width, num_buckets)
+        break_totals = self.breaks.bucket_totals(beg, width, num_buckets)
+        return list(map(operator.sub, work_totals, break_totals))
+
+    def _aligned_totals(self, width, offset=0):
+        span = self.work.span()
+        if not span:
+            return None, []
+        beg = ((span[0] - offset) // width) * width + offset
+        num_buckets = (span[1] - beg) // width + 1
+        return epoch_to_dt(beg), self.bucket_totals(beg, width, num_buckets)
+
+    def by_day(self):
+        # Returns `(first_day_dt, per_day_totals)`.
+        return self._aligned_totals(sec_per_day)
+
+    def by_week(self):
+        # Returns `(first_monday_dt, per_week_totals)`. (The epoch fell on a Thursday.)
+        return self._aligned_totals(sec_per_week, offset=-3 * sec_per_day)
+
+    def by_hour_of_day(self):
+        _, hourly_totals = self._aligned_totals(sec_per_hour)
+        first_hour = epoch_to_dt(self.work.span()[0]).hour if hourly_totals else 0
+        totals = [0] * 24
+        for i in range(24):
+            totals[(first_hour + i) % 24] = sum(hourly_totals[i::24])
+        return totals
+
+    @staticmethod
+    def by_prefix(level, cursor, prefix=None):
+        # Seconds worked per task-name prefix of `level` chunks, e.g. level 2 groups 'ucla.f19.cs35l.task-1' into
+        # 'ucla.f19'. Read from the materialized per-task totals.
+        if prefix:
+            lo, hi = task_name_prefix_bounds(prefix)
+            where_sql = " WHERE task.name=? OR (task.name >= ? AND task.name < ?)"
+            params = (prefix, lo, hi)
+        else:
+            where_sql = ""
+            params = ()
+        rows = cursor.execute("SELECT task.name, net_duration_sec - break_duration_sec FROM task_all AS task" +
+                              where_sql, params).fetchall()
+        totals = collections.Counter()
+        for name, work_duration_sec in rows:
+            totals[".".join(name.split(".", level)[:level])] += work_duration_sec or 0
+        return totals
+
+    @staticmethod
+    def rolling_average(totals, window):
+        sums = list(itertools.accumulate(totals, initial=0))
+        return [(sums[i] - sums[max(0, i - window)]) / min(i, window) for i in range(1, len(sums))]
+
+
+#
+# Timeline: the time actually worked, as segments (work sessions minus their breaks) in epoch seconds, held in arrays
+# sorted by start and indexed by a static centered interval tree. "What was I doing at t" (a stabbing query) walks one
+# root-to-leaf path, bisecting each node's lists, so it costs O(log n + k); a range query is the stabbing query at its
+# start plus a bisected slice of the segments starting inside it. Overlaps, gaps and a day's merged timeline are built
+# from range queries, so they too only ever look at the segments in range.
+#
+
+class TimelineNode(object):
+    # The segments containing `center`, by start (ascending) and by end (descending, stored negated for `bisect`).
+    __slots__ = ("center", "begs", "by_beg", "neg_ends", "by_end", "left", "right")
+
+
+class Timeline(object):
+    def __init__(self, segments):
+        # `segments` are `(beg, end, task_id, work_id)`, each non-empty and half-open.
+        super().__init__()
+        segments = sorted(segments)
+        self.begs = array.array("q", (segment[0] for segment in segments))
+        self.ends = array.array("q", (segment[1] for segment in segments))
+        self.task_ids = array.array("q", (segment[2] for segment in segments))
+        self.work_ids = array.array("q", (segment[3] for segment in segments))
+        self.root = self._build(range(len(segments)))
+
+    def __len__(self):
+        return len(self.begs)
+
+    def _build(self, indices):
+        # `indices` are in start order, and so stay in every partition.
+        if not indices:
+            return None
+        center = self.begs[indices[len(indices) // 2]]
+        left, here, right = [], [], []
+        for i in indices:
+            if self.ends[i] <= center:
+                left.append(i)
+            elif self.begs[i] > center:
+                right.append(i)
+            else:
+                here.append(i)
+        node = TimelineNode()
+        node.center = center
+        node.by_beg = here
+        node.begs = [self.begs[i] for i in here]
+        node.by_end = sorted(here, key=self.ends.__getitem__, reverse=True)
+        node.neg_ends = [-self.ends[i] for i in node.by_end]
+        node.left = self._build(left)
+        node.right = self._build(right)
+        return node
+
+    @staticmethod
+    def subtract(beg, end, breaks):
+        # The parts of `[beg, end)` outside the `breaks` (sorted by start; possibly overlapping or out of bounds).
+        parts = []
+        for break_beg, break_end in breaks:
+            break_beg, break_end = max(break_beg, beg), min(break_end, end)
+            if break_beg >= break_end:
+                continue
+            if break_beg > beg:
+                parts.append((beg, break_beg))
+            beg = break_end
+        if beg < end:
+            parts.append((beg, end))
+        return parts
+
+    @staticmethod
+    def load(cursor, prefix=None):
+        if prefix:
+            lo, hi = task_name_prefix_bounds(prefix)
+            join_sql = (" JOIN task_all AS task ON task.id = task_id "
+                        "WHERE task.name=? OR (task.name >= ? AND task.name < ?)")
+            params = (prefix, lo, hi)
+        else:
+            join_sql = ""
+            params = ()
+
+        breaks = collections.defaultdict(list)
+        res = cursor.execute("SELECT break.work_id, break.beg_epoch, break.end_epoch FROM break_all AS break" +
+                             join_sql + " ORDER BY break.work_id, break.beg_epoch", params)
+        for work_id, beg, end in fetch_iter(res):
+            if beg is not None and end is not None:
+                breaks[work_id].append((beg, end))
+
+        segments = []
+        res = cursor.execute("SELECT work.id, work.task_id, work.beg_epoch, work.end_epoch FROM work_all AS work" +
+                             join_sql, params)
+        for work_id, task_id, beg, end in fetch_iter(res):
+            if beg is not None and end is not None:
+                segments.extend((part_beg, part_end, task_id, work_id)
+                                for part_beg, part_end in Timeline.subtract(beg, end, breaks.get(work_id, ())))
+        return Timeline(segments)
+
+    def segment(self, i):
+        return self.begs[i], self.ends[i], self.task_ids[i], self.work_ids[i]
+
+    def _stab(self, t):
+        found = []
+        node = self.root
+        while node is not None:
+            if t < node.center:
+                # Every segment here ends after `t`; those starting by `t` contain it.
+                found.extend(node.by_beg[:bisect.bisect_right(node.begs, t)])
+                node = node.left
+            else:
+                # Every segment here starts by `t`; those ending after it contain it.
+                found.extend(node.by_end[:bisect.bisect_left(node.neg_ends, -t)])
+                node = node.right
+        return found
+
+    def _between(self, beg, end):
+        # Indices of the segments overlapping `[beg, end)`, in start order.
+        found = sorted(self._stab(beg))
+        found.extend(range(bisect.bisect_right(self.begs, beg), bisect.bisect_left(self.begs, end)))
+        return found
+
+    def at(self, t):
+        # The segments containing the instant `t`.
+        return [self.segment(i) for i in sorted(self._stab(t))]
+
+    def between(self, beg, end):
+        return [self.segment(i) for i in self._between(beg, end)]
+
+    def overlaps(self, beg, end):
+        # Pairs of segments of different work sessions that overlap within `[beg, end)`, as `(overlap_beg,
+        # overlap_end, segment, other_segment)`. A sweep in start order over the segments in range, keeping the
+        # ones still running in a heap by end.
+        import heapq
+
+        found = []
+        running = []
+        for i in self._between(beg, end):
+            seg_beg = self.begs[i]
+            while running and running[0][0] <= seg_beg:
+                heapq.heappop(running)
+            for other_end, j in running:
+                if self.work_ids[j] != self.work_ids[i]:
+                    overlap_beg, overlap_end = max(seg_beg, beg), min(other_end, self.ends[i], end)
+                    if overlap_beg < overlap_end:
+                        found.append((overlap_beg, overlap_end, self.segment(j), self.segment(i)))
+            heapq.heappush(running, (self.ends[i], i))
+        return found
+
+    def gaps(self, beg, end, min_sec=0):
+        # The stretches of `[beg, end)` with no work, at least `min_sec` long, as `(gap_beg, gap_end)`.
+        found = []
+        covered_until = beg
+        for i in self._between(beg, end):
+            if self.begs[i] - covered_until >= max(min_sec, 1):
+                found.append((covered_until, self.begs[i]))
+            covered_until = max(covered_until, self.ends[i])
+        if end - covered_until >= max(min_sec, 1):
+            found.append((covered_until, end))
+        return found
+
+    def merged(self, beg, end):
+        # `[beg, end)` cut into runs by what was being worked on: `(run_beg, run_end, task_ids)`, with a tuple of
+        # several task ids where sessions overlap. Idle time is left out.
+        events = []
+        for i in self._between(beg, end):
+            events.append((max(self.begs[i], beg), 1, self.task_ids[i]))
+            events.append((min(self.ends[i], end), -1, self.task_ids[i]))
+        events.sort()
+
+        runs = []
+        active = collections.Counter()
+        for t, group in itertools.groupby(events, key=operator.itemgetter(0)):
+            for _, delta, task_id in group:
+                active[task_id] += delta
+                if not active[task_id]:
+                    del active[task_id]
+            task_ids = tuple(sorted(active))
+            if runs and runs[-1][1] is None:
+                if runs[-1][2] == task_ids:
+                    continue
+                runs[-1][1] = t
+            if task_ids:
+                runs.append([t, None, task_ids])
+        return [tuple(run) for run in runs]
+
+    def day(self, day_dt):
+        # The merged timeline of the (local) day `day_dt` falls on.
+        day_beg = dt_to_epoch(datetime.datetime(day_dt.year, day_dt.month, day_dt.day))
+        return self.merged(day_beg, day_beg + sec_per_day)
+
+
+#
+# Local HTTP API (`flow serve`): read-only JSON endpoints over tasks, their totals, notes and work sessions, per-prefix
+# totals and reminders, for dashboards to poll. Requests are served by threads, each borrowing one of a fixed pool of
+# read-only connections (opened with `mode=ro`; in WAL mode they never block, nor are blocked by, a work session saving)
+# and reading from a single snapshot. Responses carry an ETag: a generation number, bumped whenever a watcher
+# connection's `PRAGMA data_version` shows another connection has committed, along with a per-run id, so a poll
+# repeating an unchanged request's ETag in If-None-Match gets an empty 304 without any query being run. Lists are paged
+# by key: a full page comes with the key to pass on for the next one.
+#
+
+api_host = "127.0.0.1"
+api_port = 8765
+api_pool_size = 4
+api_page_limit = 100
+api_max_page_limit = 1000
+
+
+class ApiError(Exception):
+    def __init__(self, status, msg):
+        super().__init__(msg)
+        self.status = status
+
+
+def api_int(query, key, default):
+    values = query.get(key)
+    if not values:
+        return default
+    try:
+        return int(values[-1])
+    except ValueError:
+        raise ApiError(400, f"'{key}' must be an integer.")
+
+
+def api_str(query, key, default=None):
+    values = query.get(key)
+    return values[-1] if values else default
+
+
+def api_limit(query):
+    return max(1, min(api_int(query, "limit", api_page_limit), api_max_page_limit))
+
+
+def api_get_task(task_id, cursor):
+    task = Task.get(int(task_id), cursor)
+    if task is None:
+        raise ApiError(404, f"No task with id {task_id} exists.")
+    return task
+
+
+def api_task_dict(task):
+    return {"id": task.id, "name": task.name, "beg_dt": dt_to_str(task.beg_dt), "status": task.status,
+            "status_str": task.status_str()}
+
+
+def api_tasks(query, cursor):
+    # ?prefix=ucla.f19 &open=1 &after=<name> &limit=N, by name.
+    prefix = api_str(query, "prefix")
+    limit = api_limit(query)
+    where_sqls = ["name > ?"]
+    params = [api_str(query, "after", "")]
+    if prefix:
+        lo, hi = task_name_prefix_bounds(prefix)
+        where_sqls.append("(name=? OR (name >= ? AND name < ?))")
+        params += [prefix, lo, hi]
+    if api_int(query, "open", 0):
+        where_sqls.append("cache_status_code=?")
+        params.append(IN_PROGRESS_TASK_STATUS)
+    res = cursor.execute("SELECT id, name, cache_beg_dt, cache_status_code, "
+                         "net_duration_sec - break_duration_sec, last_activity_dt FROM task_all "
+                         f"WHERE {' AND '.join(where_sqls)} ORDER BY name LIMIT ?",
+                         params + [limit])
+    tasks = [{"id": id_, "name": name, "beg_dt": beg_dt, "status": status, "work_sec": work_sec or 0,
+              "last_activity_dt": last_activity_dt}
+             for id_, name, beg_dt, status, work_sec, last_activity_dt in res.fetchall()]
+    return {"tasks": tasks, "next_after": tasks[-1]["name"] if len(tasks) == limit else None}
+
+
+def api_task(query, cursor, task_id):
+    task = api_get_task(task_id, cursor)
+    net_duration_sec, num_breaks, break_duration_sec = task.get_totals(cursor)
+    return {**api_task_dict(task), "work_sec": net_duration_sec - break_duration_sec,
+            "net_duration_sec": net_duration_sec, "num_breaks": num_breaks, "break_duration_sec": break_duration_sec}
+
+
+def api_task_notes(query, cursor, task_id):
+    # ?before=<timestamp>,<id> &limit=N, most recent first.
+    task = api_get_task(task_id, cursor)
+    schema = task_schema(task.id, cursor)
+    limit = api_limit(query)
+    before = api_str(query, "before")
+    before_sql = ""
+    params = [task.id]
+    if before:
+        timestamp, _, note_id = before.rpartition(",")
+        if not note_id.isdigit():
+            raise ApiError(400, "'before' must be '<timestamp>,<id>'.")
+        before_sql = "AND (timestamp, id) < (?, ?) "
+        params += [timestamp, int(note_id)]
+    res = cursor.execute("SELECT id, timestamp, opt_work_id, user_text, flow_text "
+                         f"FROM {schema}.note WHERE task_id=? {before_sql}"
+                         "ORDER BY timestamp DESC, id DESC LIMIT ?",
+                         params + [limit])
+    notes = [{"id": note_id, "timestamp": timestamp, "work_id": opt_work_id, "user_text": user_text,
+              "flow_text": flow_text}
+             for note_id, timestamp, opt_work_id, user_text, flow_text in res.fetchall()]
+    next_before = f"{notes[-1]['timestamp']},{notes[-1]['id']}" if len(notes) == limit else None
+    return {"task_id": task.id, "notes": notes, "next_before": next_before}
+
+
+def api_task_work(query, cursor, task_id):
+    # ?after=<beg_dt>,<id> &limit=N, oldest first, each session with its breaks.
+    task = api_get_task(task_id, cursor)
+    schema = task_schema(task.id, cursor)
+    limit = api_limit(query)
+    after = api_str(query, "after")
+    after_sql = ""
+    params = [task.id]
+    if after:
+        beg_dt, _, work_id = after.rpartition(",")
+        if not work_id.isdigit():
+            raise ApiError(400, "'after' must be '<beg_dt>,<id>'.")
+        after_sql = "AND (cache_beg_dt, id) > (?, ?) "
+        params += [beg_dt, int(work_id)]
+    res = cursor.execute("SELECT id, cache_beg_dt, cache_end_dt, cache_duration_sec "
+                         f"FROM {schema}.work WHERE task_id=? {after_sql}"
+                         "ORDER BY cache_beg_dt, id LIMIT ?",
+                         params + [limit])
+    sessions = [{"id": work_id, "beg_dt": beg_dt, "end_dt": end_dt, "net_duration_sec": duration_sec, "breaks": []}
+                for work_id, beg_dt, end_dt, duration_sec in res.fetchall()]
+
+    by_id = {session["id"]: session for session in sessions}
+    res = cursor.execute("SELECT work_id, id, beg_dt, end_dt, duration_sec "
+                         f"FROM {schema}.break WHERE work_id IN ({', '.join('?' * len(by_id))}) "
+                         "ORDER BY work_id, beg_dt",
+                         list(by_id))
+    for work_id, break_id, beg_dt, end_dt, duration_sec in res.fetchall():
+        by_id[work_id]["breaks"].append({"id": break_id, "beg_dt": beg_dt, "end_dt": end_dt,
+                                         "duration_sec": duration_sec})
+    next_after = f"{sessions[-1]['beg_dt']},{sessions[-1]['id']}" if len(sessions) == limit else None
+    return {"task_id": task.id, "work": sessions, "next_after": next_after}
+
+
+def api_totals(query, cursor):
+    # ?level=N &prefix=ucla.f19: seconds worked per task-name prefix of N chunks.
+    by_prefix = TimeAnalytics.by_prefix(api_int(query, "level", 2), cursor, api_str(query, "prefix"))
+    return {"by_prefix": dict(by_prefix.most_common())}
+
+
+def api_reminders(query, cursor):
+    # ?after=<task id> &limit=N, most recently created first.
+    limit = api_limit(query)
+    tasks = Task.tag_search_page(note_tag_reminder, api_int(query, "after", None), limit, cursor)
+    return {"tasks": [api_task_dict(task) for task in tasks],
+            "next_after": tasks[-1].id if len(tasks) == limit else None}
+
+
+api_routes = tuple((re.compile(pattern), handler) for pattern, handler in (
+    (r"/api/tasks", api_tasks),
+    (r"/api/tasks/(\d+)", api_task),
+    (r"/api/tasks/(\d+)/notes", api_task_notes),
+    (r"/api/tasks/(\d+)/work", api_task_work),
+    (r"/api/totals", api_totals),
+    (r"/api/reminders", api_reminders),
+))
+
+
+class ApiServer(object):
+    def __init__(self, pool_size=api_pool_size):
+        super().__init__()
+        import queue
+        import threading
+
+        # (Connections are handed between the request threads, one at a time.)
+        self.pool = queue.LifoQueue()
+        for _ in range(pool_size):
+            self.pool.put(connect_read_only(check_same_thread=False))
+        self.watcher = connect_read_only(check_same_thread=False)
+        self.watcher_lock = threading.Lock()
+        self.data_version_sqls = ["PRAGMA main.data_version"]
+        if archive_attached(self.watcher.cursor()):
+            self.data_version_sqls.append("PRAGMA archive.data_version")
+        self.data_versions = None
+        self.generation = 0
+        self.run_id = os.urandom(4).hex()
+
+    def etag(self):
+        with self.watcher_lock:
+            data_versions = [self.watcher.execute(sql).fetchone()[0] for sql in self.data_version_sqls]
+            if data_versions != self.data_versions:
+                self.data_versions = data_versions
+                self.generation += 1
+            return f'"{self.run_id}-{self.generation}"'
+
+    @staticmethod
+    def route(url_path):
+        for pattern, handler in api_routes:
+            match = pattern.fullmatch(url_path.rstrip("/"))
+            if match:
+                return handler, match.groups()
+        raise ApiError(404, f"No endpoint at {url_path}. Try: {', '.join(p.pattern for p, _ in api_routes)}")
+
+    def get(self, handler, args, query):
+        connection = self.pool.get()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("BEGIN")
+            try:
+                return handler(query, cursor, *args)
+            finally:
+                connection.rollback()
+        finally:
+            self.pool.put(connection)
+
+    def close(self):
+        while not self.pool.empty():
+            self.pool.get().close()
+        self.watcher.close()
+
+
+def api_http_server(api, host=api_host, port=api_port):
+    # An HTTP server (not yet serving) answering from `api`, an `ApiServer`. Port 0 picks a free one.
+    import http.server
+    import urllib.parse
+
+    class ApiRequestHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            etag = None
+            try:
+                handler, args = api.route(url.path)
+                # (The ETag is taken before the snapshot is, so it never claims data newer than what is sent.)
+                etag = api.etag()
+                if_none_match = self.headers.get("If-None-Match", "")
+                if etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                status, data = 200, api.get(handler, args, urllib.parse.parse_qs(url.query))
+            except ApiError as e:
+                status, data = e.status, {"error": str(e)}
+            except Exception as e:
+                # (E.g. the DB being locked.) Answered like any other error, rather than by dropping the connection.
+                import traceback
+
+                self.log_error("Failed to serve %s:\n%s", self.path, traceback.format_exc().rstrip())
+                status, data = 500, {"error": f"Internal error: {type(e).__name__}: {e}"}
+
+            body = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Cache-Control", "no-cache")
+            if status == 200:
+                self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+    return http.server.ThreadingHTTPServer((host, port), ApiRequestHandler)
+
+
+def api_serve(host=api_host, port=api_port, pool_size=api_pool_size):
+    api = ApiServer(pool_size)
+    server = api_http_server(api, host, port)
+    print(f"Serving the API at http://{host}:{server.server_port}/api/tasks (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        api.close()
+
+
 #
 # UI - Shared
 #
 
 
-# TODO: Write curses functions to support wipe, print, richer input, [and async stuff if possible!]
+# Front ends: all terminal I/O that is not a plain `print` goes through `ui`. `PlainUi` is the classic line-based
+# terminal; `CursesUi` (see `tui_main`) is a full-screen front end. The menus below work unchanged on either.
+
+class PlainUi(object):
+    pause_hint = "[Ctrl+C or Return to pause]"
+
+    def wipe(self):
+        # (Writing the escape sequence ourselves rather than forking `clear` for every screen.)
+        if sys.stdout.isatty():
+            sys.stdout.write("\033[H\033[2J")
+            sys.stdout.flush()
+
+    def input(self, prompt):
+        return input(prompt)
+
+    def show_status(self, text):
+        print(f"\r{text}", end=" ", flush=True)
+
+    def end_status(self):
+        print()
+
+    def watch_keys(self, loop, on_pause):
+        # Pauses on [Return]; returns a callable that stops watching.
+        fd = sys.stdin.fileno()
+
+        def _on_input():
+            if not sys.stdin.readline():
+                loop.remove_reader(fd)
+            on_pause()
+
+        try:
+            loop.add_reader(fd, _on_input)
+        except (OSError, ValueError):
+            # (e.g. stdin is a regular file, which cannot be polled; Ctrl+C still pauses.)
+            pass
+        return lambda: loop.remove_reader(fd)
+
+
+class CursesUi(object):
+    # Printed text goes to a scroll-back log (`sys.stdout` is redirected here), shown above an optional status line
+    # (e.g. the live timer) and the input line. Redraws are damage-tracked: only rows whose text changed are rewritten,
+    # and curses then sends only the changed cells, which keeps the UI responsive over slow links.
+    pause_hint = "[p/Space/Return to pause]"
+    pause_keys = (ord("p"), ord("P"), ord(" "), ord("\n"), ord("\r"))
+    max_log_lines = 1000
+
+    def __init__(self, stdscr):
+        super().__init__()
+        self.stdscr = stdscr
+        self.log = []
+        self.partial_line = ""
+        self.status = None
+        self.drawn_rows = []
+        stdscr.keypad(True)
+
+    # File-like interface, for `print`:
+
+    def write(self, text):
+        lines = (self.partial_line + text).split("\n")
+        self.partial_line = lines.pop()
+        if "\r" in self.partial_line:
+            self.partial_line = self.partial_line.rsplit("\r", 1)[1]
+        self.log.extend(line.rsplit("\r", 1)[-1] for line in lines)
+        del self.log[:-self.max_log_lines]
+        return len(text)
+
+    def flush(self):
+        self.render()
+
+    # Drawing:
+
+    def render(self, input_line=None):
+        import curses
+
+        height, width = self.stdscr.getmaxyx()
+        bottom_rows = [row for row in (self.status, input_line) if row is not None]
+        log_rows = self.log + ([self.partial_line] if self.partial_line and input_line is None else [])
+        num_log_rows = max(0, height - len(bottom_rows))
+        rows = log_rows[max(0, len(log_rows) - num_log_rows):] if num_log_rows else []
+        rows = rows + [""] * (num_log_rows - len(rows)) + bottom_rows
+
+        for y, row in enumerate(rows[:height]):
+            row = row[:width - 1]
+            if y < len(self.drawn_rows) and self.drawn_rows[y] == row:
+                continue
+            try:
+                self.stdscr.addstr(y, 0, row)
+                self.stdscr.clrtoeol()
+            except curses.error:
+                pass
+        self.drawn_rows = [row[:width - 1] for row in rows[:height]]
+
+        if input_line is not None:
+            self.stdscr.move(min(height, len(rows)) - 1, min(len(input_line), width - 1))
+        self.stdscr.noutrefresh()
+        curses.doupdate()
+
+    def repaint(self):
+        self.stdscr.clear()
+        self.drawn_rows = []
+        self.render()
+
+    # Front-end interface:
+
+    def wipe(self):
+        self.log = []
+        self.partial_line = ""
+        self.render()
+
+    def input(self, prompt):
+        import curses
+
+        prompt = self.partial_line + prompt
+        self.partial_line = ""
+        text = ""
+        while True:
+            self.render(input_line=prompt + text)
+            ch = self.stdscr.get_wch()
+            if ch in ("\n", "\r", curses.KEY_ENTER):
+                break
+            elif ch in ("\b", "\x7f", curses.KEY_BACKSPACE):
+                text = text[:-1]
+            elif ch == curses.KEY_RESIZE:
+                self.repaint()
+            elif isinstance(ch, str) and ch.isprintable():
+                text += ch
+        self.write(prompt + text + "\n")
+        return text
+
+    def show_status(self, text):
+        self.status = text
+        self.render()
+
+    def end_status(self):
+        self.status = None
+        self.render()
+
+    def watch_keys(self, loop, on_pause):
+        import curses
+
+        fd = sys.stdin.fileno()
+        self.stdscr.nodelay(True)
+
+        def _on_keys():
+            while True:
+                ch = self.stdscr.getch()
+                if ch == -1:
+                    return
+                elif ch in self.pause_keys:
+                    on_pause()
+                elif ch == curses.KEY_RESIZE:
+                    self.repaint()
+
+        def _unwatch():
+            loop.remove_reader(fd)
+            self.stdscr.nodelay(False)
+
+        loop.add_reader(fd, _on_keys)
+        return _unwatch
+
+
+ui = PlainUi()
+
+
+def tui_main():
+    # Runs the interactive UI in the full-screen (curses) front end, or in the plain one where curses can't run: not on
+    # a terminal, on one curses doesn't know, or without the `curses` module (e.g. on Windows).
+    try:
+        import curses
+    except ImportError:
+        curses = None
+    if curses is None:
+        fallback_reason = "no curses module"
+    elif not (sys.stdin.isatty() and sys.stdout.isatty()):
+        fallback_reason = "not a terminal"
+    else:
+        try:
+            curses.setupterm(fd=sys.stdout.fileno())
+            fallback_reason = None
+        except curses.error as e:
+            fallback_reason = str(e)
+    if fallback_reason:
+        print(f"flow: Running the plain UI: can't run the full-screen one ({fallback_reason}).", file=sys.stderr)
+        main()
+        return
+
+    def _run(stdscr):
+        global ui
+        stdout = sys.stdout
+        ui = sys.stdout = CursesUi(stdscr)
+        try:
+            main()
+        finally:
+            ui = PlainUi()
+            sys.stdout = stdout
+
+    curses.wrapper(_run)
 
 
 def wipe():
-    # FIXME: Hacky
-    subprocess.run("clear")
+    ui.wipe()
 
 
 def wipe_print(*args, **kwargs):
@@ -506,7 +3445,7 @@ def wipe_print(*args, **kwargs):
 
 def line_input_text(prompt, validator=default_validator):
     assert validator
-    text = input(prompt).strip()
+    text = ui.input(prompt).strip()
     validation = validator(text)
     assert isinstance(validation, Result)
     if validation.ok:
@@ -517,7 +3456,8 @@ def line_input_text(prompt, validator=default_validator):
         return line_input_text(prompt, validator=validator)
 
 
-def combo_input(title, option_tuples, default_key=None):
+def combo_input(title, option_tuples, default_key=None, hidden_option_tuples=()):
+    # `hidden_option_tuples` are `(input_str, key)` pairs accepted (on a single page) but never listed.
     assert option_tuples
 
     invalid_selection_msg = "Invalid selection. Please try again."
@@ -533,6 +3473,7 @@ def combo_input(title, option_tuples, default_key=None):
     # Single page-output:
     if num_pages == 1:
         choice_chars = choice_chars[:len(key_list)]
+        hidden_options = dict(hidden_option_tuples)
 
         # Pre-computing the input text from the default provided:
         if default_key is not None:
@@ -548,10 +3489,12 @@ def combo_input(title, option_tuples, default_key=None):
                 print(f"Enter [{choice_char}] to {page}")
             print(f"Enter [~] to Repaint.")
 
-            choice_str = input(input_text).strip()
+            choice_str = ui.input(input_text).strip()
             if not choice_str:
                 # Returning the 'default key' specified and printed, which, by default, is None (indicating 'no choice')
                 return default_key
+            elif choice_str in hidden_options:
+                return hidden_options[choice_str]
             else:
                 choice_char = choice_str[0]
                 if choice_char == '~':
@@ -572,15 +3515,105 @@ def combo_input(title, option_tuples, default_key=None):
 
     # Multi-page output:
     else:
-        # TODO: paginated output; switching to curses.
         assert num_pages > 1
-        pages = []
-        for i_page in range(num_pages):
-            page_beg_index = i_page * page_length
-            page_end_index = (i_page * page_length) + page_length
-            pages.append(prompt_list[page_beg_index:page_end_index])
 
-        raise NotImplementedError
+        def _fetch_page(after, limit, _inclusive):
+            beg_index = 0 if after is None else after + 1
+            return [(prompt_list[i], key_list[i], i) for i in range(beg_index, min(beg_index + limit, num_options))]
+
+        return paged_combo_input(title, _fetch_page, default_key=default_key)
+
+
+def paged_combo_input(title, fetch_page, fixed_option_tuples=(), default_key=None, jump_key=None):
+    # Like `combo_input`, but the options are fetched a page at a time: `fetch_page(after, limit, inclusive)` returns
+    # up to `limit` `(prompt, key, seek)` rows that follow the row whose `seek` is `after` (or start at it, if
+    # `inclusive`), or start from the beginning when `after` is None. `fixed_option_tuples` are listed on every page.
+    # If given, `jump_key(text, first_seek)` maps a [/text] entry to the `seek` to jump to.
+    invalid_selection_msg = "Invalid selection. Please try again."
+    choice_chars = "0123456789abcdefghijklmnopqrstuvwxyz"
+    page_length = len(choice_chars) - len(fixed_option_tuples)
+    assert page_length > 0
+
+    # The `(after, inclusive)` each page shown so far was fetched with, for [<]:
+    page_starts = [(None, False)]
+    rows = fetch_page(None, page_length + 1, False)
+    while True:
+        has_next_page = len(rows) > page_length
+        page_rows = rows[:page_length]
+        option_tuples = [(prompt, key) for prompt, key, _ in page_rows] + list(fixed_option_tuples)
+        _, key_list = zip(*option_tuples) if option_tuples else ((), ())
+
+        print(title)
+        print(f"(Page {len(page_starts)})")
+        for choice_char, (prompt, _) in zip(choice_chars, option_tuples):
+            print(f"Enter [{choice_char}] to {prompt}")
+        if has_next_page:
+            print("Enter [>] for the next page.")
+        if len(page_starts) > 1:
+            print("Enter [<] for the previous page.")
+        if jump_key:
+            print("Enter [/<text>] to jump to <text>.")
+        print(f"Enter [~] to Repaint.")
+
+        if default_key is not None and default_key in key_list:
+            input_text = f"Your choice (default: {choice_chars[key_list.index(default_key)]}): "
+        else:
+            input_text = f"Your choice: "
+
+        choice_str = ui.input(input_text).strip()
+        if not choice_str:
+            return default_key
+
+        choice_char = choice_str[0]
+        if choice_char == '~':
+            wipe()
+            continue
+        elif choice_char == '>' and has_next_page:
+            page_starts.append((page_rows[-1][2], False))
+        elif choice_char == '<' and len(page_starts) > 1:
+            page_starts.pop()
+        elif choice_char == '/' and jump_key:
+            first_seek = page_rows[0][2] if page_rows else None
+            page_starts.append((jump_key(choice_str[1:].strip(), first_seek), True))
+        elif choice_char in choice_chars[:len(option_tuples)]:
+            return key_list[choice_chars.index(choice_char)]
+        else:
+            print(invalid_selection_msg)
+            continue
+
+        after, inclusive = page_starts[-1]
+        rows = fetch_page(after, page_length + 1, inclusive)
+
+
+search_window_num_pages = 4
+
+
+def windowed_fetch_page(fetch_page, num_pages=search_window_num_pages):
+    # Wraps a `paged_combo_input` `fetch_page` to fetch `num_pages` pages' worth of rows at a time, and serve the pages
+    # that follow from them, for queries that cost about as much for a window as for a page (see
+    # `Task.name_search_page`). Only the last window is kept.
+    window_from = None
+    window = []
+    window_seeks = {}
+    window_complete = False
+
+    def _fetch_page(after, limit, inclusive):
+        nonlocal window_from, window, window_seeks, window_complete
+        if (after, inclusive) == window_from:
+            beg_index = 0
+        elif after in window_seeks:
+            beg_index = window_seeks[after] + (0 if inclusive else 1)
+        else:
+            beg_index = None
+        if beg_index is None or (beg_index + limit > len(window) and not window_complete):
+            window_from = (after, inclusive)
+            window = fetch_page(after, limit * num_pages, inclusive)
+            window_seeks = {seek: i for i, (_, _, seek) in enumerate(window)}
+            window_complete = len(window) < limit * num_pages
+            beg_index = 0
+        return window[beg_index:beg_index + limit]
+
+    return _fetch_page
 
 
 def date_time_input(title):
@@ -597,13 +3630,13 @@ def int_input(title):
 def notify(message=None):
     if message:
         print(message)
-    input("Hit [Return] to continue...")
+    ui.input("Hit [Return] to continue...")
 
 
-def confirm(message, default: "Union[str, bool]" = True):
+def confirm(message, default: "typing.Union[str, bool]" = True):
     default_char = 'Y' if default else 'N'
     other_char = 'n' if default else 'y'
-    input_text = input(f"{message} [{default_char}/{other_char}]: ").strip()
+    input_text = ui.input(f"{message} [{default_char}/{other_char}]: ").strip()
     if input_text:
         return input_text[0] in ('y', 'Y')
     else:
@@ -611,31 +3644,96 @@ def confirm(message, default: "Union[str, bool]" = True):
 
 
 def task_select(desc, only_open=False):
-    with connect() as connection:
-        cursor = connection.cursor()
+    max_num_completions = 8
+    next_search_str = None
+    with transaction() as cursor:
         while True:
             wipe_print(desc)
-            search_str = line_input_text("= TASK SEARCH =\nEnter a task-name search string fragment: ")
-            result_task_list = list(Task.name_search(search_str, only_open, cursor))
-            if not result_task_list:
+            # (The transaction stays open across the user's inputs, while other processes may commit.)
+            model_caches_sync(cursor.connection)
+            trie = task_trie(cursor)
+            if next_search_str is None:
+                search_str = line_input_text("= TASK SEARCH =\n"
+                                             "Enter a task-name search string fragment (end with '.' to browse): ")
+            else:
+                search_str = next_search_str
+                next_search_str = None
+                print(f"= TASK SEARCH =\nBrowsing '{search_str}'")
+
+            if search_str.endswith("."):
+                # Browsing: the tree already holds the tasks, in name order.
+                browse_task_list = list(trie.iter_tasks(search_str[:-1], only_open))
+                completions = trie.complete(search_str)
+
+                def _fetch_page(after, limit, inclusive):
+                    beg_index = 0 if after is None else (after if inclusive else after + 1)
+                    return [(task.name, task, i) for i, task in
+                            enumerate(browse_task_list[beg_index:beg_index + limit], start=beg_index)]
+
+                def _jump_key(text, _):
+                    return bisect.bisect_left([task.name for task in browse_task_list], search_str + text)
+
+                has_results = bool(browse_task_list)
+            else:
+                completions = trie.complete(search_str) if search_str else []
+
+                @windowed_fetch_page
+                def _fetch_page(after, limit, inclusive):
+                    return [(task.name, task, key) for task, key in
+                            Task.name_search_page(search_str, only_open, after, limit, cursor, inclusive)]
+
+                def _jump_key(text, first_key):
+                    return first_key[0] if first_key else 0, text
+
+                has_results = bool(_fetch_page(None, 1, False))
+            completions = [(prefix, num_tasks) for prefix, num_tasks in completions if trie.find(prefix).children]
+            has_archived = not only_open and bool(Task.archived_page(search_str, None, 1, cursor))
+
+            if not has_results and not completions and not has_archived:
                 cb = confirm("No results found! Continue searching? ", default=True)
                 if not cb:
                     # In these cases, we want to pop to the previous menu.
                     return "return"
             else:
-                result_tuples_iter = map(lambda p: (p.name, p), result_task_list)
-                result_tuples = list((*result_tuples_iter, ("return to the previous menu.", "return")))
-                task_input = combo_input("= SEARCH RESULTS =\nSelect a task to work on [default = continue searching]:",
-                                         result_tuples)
+                completion_tuples = [(f"browse '{prefix}.' ({num_tasks} tasks, "
+                                      f"{sec_to_hms_str(trie.subtree_work_sec(prefix, cursor))})",
+                                      ("browse", f"{prefix}."))
+                                     for prefix, num_tasks in completions[:max_num_completions]]
+                if has_archived:
+                    # (Archived tasks are all closed, and kept out of the search index and the trie.)
+                    completion_tuples.append((f"list the archived tasks matching '{search_str}'.",
+                                              ("archived", search_str)))
+                fixed_tuples = (*completion_tuples, ("return to the previous menu.", "return"))
+                task_input = paged_combo_input("= SEARCH RESULTS =\n"
+                                               "Select a task to work on [default = continue searching]:",
+                                               _fetch_page, fixed_tuples, jump_key=_jump_key)
+                if isinstance(task_input, tuple) and task_input[0] == "archived":
+                    task_input = archived_task_select(task_input[1], cursor)
                 if task_input is None:
                     return None
                 elif task_input == "return":
                     return "return"
+                elif isinstance(task_input, tuple):
+                    _, next_search_str = task_input
                 else:
                     assert isinstance(task_input, Task)
                     return task_input
 
 
+def archived_task_select(search_str, cursor):
+    # Returns the selected archived task, or None to search again.
+    def _fetch_page(after, limit, inclusive):
+        return [(f"{task.name} (archived)", task, name)
+                for task, name in Task.archived_page(search_str, after, limit, cursor, inclusive)]
+
+    def _jump_key(text, _):
+        return text
+
+    return paged_combo_input(f"= ARCHIVED TASKS matching '{search_str}' =\n"
+                             f"Select a task (it is restored when written to) [default = continue searching]:",
+                             _fetch_page, (("continue searching.", None),), jump_key=_jump_key)
+
+
 #
 # UI - Work
 #
@@ -653,51 +3751,133 @@ def work_main():
                 break
 
 
-def work_screen(task):
-    auto_save_msg = ""
+# How often a running session writes its end time to the DB. (A crash of the process loses at most a second of tracked
+# time regardless, thanks to the session journal's heartbeats; this bounds the loss should the journal be lost too.)
+work_save_interval_sec = 30
+
+
+class WorkSession(object):
+    # The running timer: an asyncio loop with separate tasks for the display tick, key input and a write-behind saver.
+    # DB writes go through a single worker thread, so a slow disk never stalls the display. `run` returns whenever the
+    # user pauses or the process is signalled, with the work row saved up to that moment.
+
+    def __init__(self, task, work, save_interval_sec=work_save_interval_sec):
+        super().__init__()
+        self.task = task
+        self.work = work
+        self.save_interval_sec = save_interval_sec
+        self.cum_break_sec = 0
+        self.status_msg = ""
+        import concurrent.futures
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.journal = SessionJournal(work.id)
+        self.journal.start(work.beg_dt)
+
+    def close(self, end_dt):
+        self.executor.shutdown()
+        self.journal.end(end_dt)
+
+    def net_elapsed_sec(self, now_dt):
+        return round_sec_to_int((now_dt - self.work.beg_dt).total_seconds()) - self.cum_break_sec
+
+    def add_break(self, break_start_time, break_end_time, cursor):
+        break_duration_sec = round_sec_to_int((break_end_time - break_start_time).total_seconds())
+        self.cum_break_sec += break_duration_sec
+        Work.add_break(self.task.id, self.work.id, break_start_time, break_end_time, break_duration_sec, cursor)
+        self.journal.resume(break_end_time)
+
+    def _save(self, save_dt):
+        with transaction() as cursor:
+            self.work.save(save_dt, cursor)
+        self.status_msg = f"[Last auto-saved at {dt_to_str(save_dt)}]"
+
+    async def _flush(self, save_dt):
+        import asyncio
+
+        # Only the latest end time matters, so each flush supersedes (coalesces) everything before it.
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._save, save_dt)
+
+    async def _display(self):
+        import asyncio
+
+        while True:
+            now_dt = datetime.datetime.now()
+            time_str = sec_to_hms_str(self.net_elapsed_sec(now_dt))
+            ui.show_status(f"Working on {repr(self.task.name)} for... {time_str} {ui.pause_hint} {self.status_msg}")
+            self.journal.heartbeat(now_dt)
+            if self.journal.sync_due():
+                asyncio.get_running_loop().run_in_executor(self.executor, self.journal.sync)
+            await asyncio.sleep(1 - now_dt.microsecond / 1e6)
+
+    async def _saver(self):
+        import asyncio
+
+        while True:
+            await asyncio.sleep(self.save_interval_sec)
+            await self._flush(datetime.datetime.now())
+
+    async def run(self):
+        import asyncio
+        import signal
+
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+
+        def _finish(reason):
+            if not done.done():
+                done.set_result((reason, datetime.datetime.now()))
+
+        loop.add_signal_handler(signal.SIGINT, _finish, "pause")
+        loop.add_signal_handler(signal.SIGTERM, _finish, "signal")
+        loop.add_signal_handler(signal.SIGHUP, _finish, "signal")
+        unwatch_keys = ui.watch_keys(loop, lambda: _finish("pause"))
+
+        tasks = [asyncio.create_task(self._display()), asyncio.create_task(self._saver())]
+        try:
+            reason, end_dt = await done
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            unwatch_keys()
+            for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+                loop.remove_signal_handler(sig)
+
+        await self._flush(end_dt)
+        self.journal.pause(end_dt)
+        ui.end_status()
+        return reason, end_dt
+
+
+def work_screen(task, save_interval_sec=work_save_interval_sec):
+    import asyncio
 
-    cum_break_sec = 0
-    auto_save_interval_sec = 30
-    net_elapsed_sec_when_next_auto_save = auto_save_interval_sec
     work_start_time = datetime.datetime.now()
 
-    with connect() as connection:
-        cursor = connection.cursor()
+    with transaction() as cursor:
         new_work = Work.new(task.id, work_start_time, cursor)
 
-    while True:
-        try:
-            # Auto-saving:
-            raw_net_elapsed_sec = (datetime.datetime.now() - work_start_time).total_seconds()
-            net_elapsed_sec = round_sec_to_int(raw_net_elapsed_sec) - cum_break_sec
-            if net_elapsed_sec > net_elapsed_sec_when_next_auto_save:
-                net_elapsed_sec_when_next_auto_save = net_elapsed_sec + auto_save_interval_sec
-                with connect() as connection:
-                    cursor = connection.cursor()
-                    now_dt = datetime.datetime.now()
-                    new_work.save(now_dt, cursor)
-
-                    auto_save_dt_text = new_work.end_dt.strftime(dt_fmt_str)
-                    auto_save_msg = f"[Last auto-saved at {auto_save_dt_text}]"
-
-            time_str = sec_to_hms_str(net_elapsed_sec)
-            print(
-                f"\rWorking on {repr(task.name)} for... {time_str} [Ctrl+C to pause] "
-                f"{auto_save_msg}", end=" ")
-            time.sleep(1)
+    session = WorkSession(task, new_work, save_interval_sec)
+    work_end_time = work_start_time
+    try:
+        while True:
+            reason, work_end_time = asyncio.run(session.run())
+            if reason == "signal":
+                with transaction() as cursor:
+                    Note.new(task.id, new_work.id, work_end_time, "Work session ended by a signal.", "end-work",
+                             cursor)
+                sys.exit(f"\n{sec_to_hms_str(new_work.duration_sec)} of work has been saved under the task "
+                         f"{repr(task.name)}")
 
-        except KeyboardInterrupt:
-            work_end_time = datetime.datetime.now()
             break_start_time = work_end_time
-
             options = [
                 ("Add Note", "an"),
                 ("Continue Work.", "c"),
                 ("Stop Work.", "s")
             ]
             choice = combo_input(f"Working on {repr(task.name)}: PAUSED", options, default_key='c')
-            with connect() as connection:
-                cursor = connection.cursor()
+            with transaction() as cursor:
                 if choice == "an":
                     note_text = line_input_text("Enter a note to add: ", non_empty_validator)
                     dt = datetime.datetime.now()
@@ -705,20 +3885,17 @@ def work_screen(task):
                     assert new_note.id
                     notify("Note added successfully!")
                 if choice == 'c':
-                    break_end_time = datetime.datetime.now()
-                    raw_break_duration_sec = (break_end_time - break_start_time).total_seconds()
-                    break_duration_sec = round_sec_to_int(raw_break_duration_sec)
-                    cum_break_sec += break_duration_sec
-                    Work.add_break(task.id, new_work.id, break_start_time, break_end_time, break_duration_sec, cursor)
+                    session.add_break(break_start_time, datetime.datetime.now(), cursor)
                     continue
                 elif choice == 's':
                     if confirm("Are you sure you want to end this session?"):
                         break
+    finally:
+        session.close(work_end_time)
 
     user_note = line_input_text("Enter a short note to commemorate this work session: ")
 
-    with connect() as connection:
-        cursor = connection.cursor()
+    with transaction() as cursor:
         Note.new(task.id, new_work.id, work_end_time, user_note, "end-work", cursor)
         new_work.save(work_end_time, cursor)
 
@@ -744,13 +3921,15 @@ def search_task_main():
 def view_task_main(selected_task):
     selected_task_id = selected_task.id
     while True:
-        with connect() as connection:
-            selected_task = Task.get(selected_task_id, connection)
+        with transaction() as cursor:
+            selected_task = Task.get(selected_task_id, cursor)
 
         print(f"Task '{selected_task.name}'")
 
         option_tuple = [
-            ("Print Record [HTML]", "pf")
+            ("Print Record [HTML]", "pf"),
+            ("Export Record [JSON Lines]", "pj"),
+            ("Export Record [CSV]", "pc"),
         ]
         info = None
         if selected_task.status == IN_PROGRESS_TASK_STATUS:
@@ -775,13 +3954,17 @@ def view_task_main(selected_task):
         if choice == "return":
             return
 
-        with connect() as connection:
-            cursor = connection.cursor()
+        with transaction() as cursor:
 
             if choice == "pf":
                 file_path = line_input_text("Enter a file-path for the generated HTML info file: ",
                                             validator=file_path_validator)
                 selected_task.print_to_html(file_path, cursor)
+            elif choice in ("pj", "pc"):
+                fmt = "jsonl" if choice == "pj" else "csv"
+                file_path = line_input_text(f"Enter a file-path for the generated {fmt.upper()} record file: ",
+                                            validator=file_path_validator)
+                selected_task.export(file_path, fmt, cursor)
             elif choice == "tc":
                 if confirm(f"Are you sure you want to mark '{selected_task.name}' as complete?"):
                     complete_msg = line_input_text("Enter a completion note (why? how? when? future?): ",
@@ -812,8 +3995,7 @@ def view_task_main(selected_task):
 
 
 def create_task_main():
-    with connect() as connection:
-        cursor = connection.cursor()
+    with transaction() as cursor:
         print("Enter [Ctrl + C] at any time to cancel this form.")
         try:
             new_task_name = line_input_text("Enter the new task's name: ",
@@ -838,14 +4020,23 @@ def create_task_main():
 def view_reminders_main():
 
     wipe_print("View Reminders")
-    with connect() as connection:
-        cursor = connection.cursor()
-        option_tuples = Task.search_reminders(cursor)
 
-    choice_task_id = combo_input("Select a reminder to view: ", option_tuples, default_key=option_tuples[0][1])
+    # Only the page shown is read, so this opens at once however many reminders (and notes) there are.
+    def _fetch_page(after, limit, inclusive):
+        with transaction() as cursor:
+            return [(f"[{task.beg_dt_str()}] {task.name}", task.id, task.id) for task in
+                    Task.tag_search_page(note_tag_reminder, after, limit, cursor, inclusive)]
+
+    first_rows = _fetch_page(None, 1, False)
+    if not first_rows:
+        notify("There are no reminders. (Tag a note with #reminder to add one.)")
+        return
+
+    choice_task_id = paged_combo_input("Select a reminder to view: ", _fetch_page, default_key=first_rows[0][1])
+    if choice_task_id is None:
+        return
 
-    with connect() as connection:
-        cursor = connection.cursor()
+    with transaction() as cursor:
         task = Task.get(choice_task_id, cursor)
 
     view_task_main(task)
@@ -854,6 +4045,55 @@ def view_reminders_main():
 # UI - Main
 #
 
+def search_notes_main():
+    wipe_print("Search Notes")
+    search_str = line_input_text("Enter the words to search for (end a word with '*' to match it as a prefix): ",
+                                 non_empty_validator)
+    prefix = line_input_text("Only search the notes of the tasks under this name prefix [default = all tasks]: ")
+    beg_dt_str = line_input_text("Only search notes written since this date (YYYY-MM-DD) [default = any]: ",
+                                 optional_date_validator)
+    end_dt_str = line_input_text("... and until this date (YYYY-MM-DD) [default = any]: ", optional_date_validator)
+
+    with transaction() as cursor:
+        rows = Note.search(search_str, prefix, note_search_dt_bound(beg_dt_str, False),
+                           note_search_dt_bound(end_dt_str, True), note_search_ui_limit, cursor)
+    if not rows:
+        notify("No notes matched.")
+        return
+
+    option_tuples = [(f"[{timestamp}] {task_name}: {snippet}", task_id)
+                     for _, timestamp, task_id, task_name, snippet, _ in rows]
+    option_tuples.append(("Return...", "return"))
+    choice = combo_input(f"= {len(rows)} BEST MATCHES =\nSelect a note to view its task:", option_tuples,
+                         default_key="return")
+    if choice == "return":
+        return
+
+    with transaction() as cursor:
+        task = Task.get(choice, cursor)
+    view_task_main(task)
+
+
+def debug_main():
+    # Hidden: the query-tracing report (see `QueryTracer`).
+    while True:
+        wipe_print("Debug: Query Tracing")
+        if _tracer is None:
+            notify("Tracing is off. Set FLOW_TRACE (e.g. FLOW_TRACE=trace.txt) before starting flow to turn it on.")
+            return
+        print("\n".join(_tracer.report_lines()))
+
+        choice = combo_input("Choose an action:", (("Refresh", "r"), ("Dump to a File", "d"), ("Return...", "return")),
+                             default_key="return")
+        if choice == "return":
+            return
+        elif choice == "d":
+            file_path = line_input_text("Enter a file-path for the trace report ('.json' for JSON): ",
+                                        validator=file_path_validator)
+            _tracer.dump(file_path)
+            notify(f"Wrote the trace report to '{file_path}'.")
+
+
 def main():
     db_init()
 
@@ -865,9 +4105,11 @@ def main():
                 ("View Tasks", 'vt'),
                 ("Create a Task", "tc"),
                 ("View Reminders", "vr"),
+                ("Search Notes", "sn"),
                 ("Quit", 'q')
             )
-            choice_id = combo_input("Select a context to navigate to:", choice_tuple, default_key='w')
+            choice_id = combo_input("Select a context to navigate to:", choice_tuple, default_key='w',
+                                    hidden_option_tuples=(("!", "dbg"),))
             if choice_id == 'w':
                 work_main()
             elif choice_id == 'vt':
@@ -876,6 +4118,10 @@ def main():
                 create_task_main()
             elif choice_id == "vr":
                 view_reminders_main()
+            elif choice_id == "sn":
+                search_notes_main()
+            elif choice_id == "dbg":
+                debug_main()
             else:
                 assert choice_id == 'q'
                 print("Bye-bye!")
@@ -886,12 +4132,478 @@ def main():
         return
 
 
+#
+# CLI: non-interactive sub-commands, for scripts. Running without arguments starts the interactive UI. Each handler
+# returns `(data, text)`: `data` is printed as JSON with `--json`, `text` otherwise. With `--batch`, every line of stdin
+# is one sub-command line, and all of them are applied in a single transaction (or none, on the first error).
+#
+
+class CliError(Exception):
+    pass
+
+
+def cli_get_task(name, cursor):
+    task = Task.get_by_name(name, cursor)
+    if task is None:
+        raise CliError(f"No task named {repr(name)} exists.")
+    return task
+
+
+def cli_task_dict(task):
+    return {"id": task.id, "name": task.name, "beg_dt": dt_to_str(task.beg_dt), "status": task.status}
+
+
+def cli_create(args, cursor):
+    res = new_task_name_validator(args.task, cursor)
+    if not res:
+        raise CliError(res.msg)
+    task = Task.new(args.task, args.message, cursor)
+    return cli_task_dict(task), f"Task '{task.name}' successfully added with ID {task.id}."
+
+
+def cli_work_start(args, cursor):
+    task = cli_get_task(args.task, cursor)
+    if task.status != IN_PROGRESS_TASK_STATUS:
+        raise CliError(f"Task '{task.name}' is not open.")
+    start_dt = datetime.datetime.now()
+    work = Work.new(task.id, start_dt, cursor)
+    after_commit(lambda: SessionJournal(work.id, pid=session_journal_detached_pid).start(start_dt))
+    return ({"task": task.name, "work_id": work.id, "beg_dt": dt_to_str(start_dt)},
+            f"Started working on '{task.name}' (work ID {work.id}).")
+
+
+def cli_work_stop(args, cursor):
+    task = cli_get_task(args.task, cursor) if args.task else None
+    end_dt = datetime.datetime.now()
+    stopped = []
+    for work_id, (pid, _, _) in session_journal_read().items():
+        if pid != session_journal_detached_pid:
+            continue
+        work = Work.get(work_id, cursor)
+        if work and (task is None or work.task_id == task.id):
+            work.save(end_dt, cursor)
+            Note.new(work.task_id, work.id, end_dt, args.note, "end-work", cursor)
+            stopped.append({"work_id": work.id, "task_id": work.task_id, "duration_sec": work.duration_sec})
+        elif work:
+            continue
+        after_commit(lambda work_id=work_id: SessionJournal(work_id, pid=session_journal_detached_pid).end(end_dt))
+
+    if not stopped:
+        raise CliError("There is no work session to stop" + (f" on '{task.name}'." if task else "."))
+    text = "\n".join(f"Stopped work {d['work_id']} after {sec_to_hms_str(d['duration_sec'])}." for d in stopped)
+    return stopped, text
+
+
+def cli_work_status(args, cursor):
+    now_dt = datetime.datetime.now()
+    sessions = []
+    for work_id, (pid, kind, _) in session_journal_read().items():
+        work = Work.get(work_id, cursor)
+        if work:
+            task = Task.get(work.task_id, cursor)
+            sessions.append({"work_id": work.id, "task": task.name, "beg_dt": dt_to_str(work.beg_dt),
+                             "elapsed_sec": round_sec_to_int((now_dt - work.beg_dt).total_seconds()),
+                             "detached": pid == session_journal_detached_pid, "paused": kind == "P"})
+    text = "\n".join(f"Work {d['work_id']} on '{d['task']}' for {sec_to_hms_str(d['elapsed_sec'])}"
+                     f"{' (paused)' if d['paused'] else ''}" for d in sessions)
+    return sessions, text or "No work sessions are running."
+
+
+def cli_note(args, cursor):
+    task = cli_get_task(args.task, cursor)
+    note = Note.new(task.id, None, None, args.text, "cli-note", cursor)
+    return {"task": task.name, "note_id": note.id}, f"Note {note.id} added to '{task.name}'."
+
+
+def cli_complete(args, cursor):
+    task = cli_get_task(args.task, cursor)
+    if task.status != IN_PROGRESS_TASK_STATUS:
+        raise CliError(f"Task '{task.name}' is already closed.")
+    task.set_status(ABANDONED_TASK_STATUS if args.abandon else COMPLETE_TASK_STATUS, args.message, cursor)
+    return cli_task_dict(task), f"Marked task '{task.name}' as {task.status_str()}."
+
+
+def cli_reopen(args, cursor):
+    task = cli_get_task(args.task, cursor)
+    if task.status == IN_PROGRESS_TASK_STATUS:
+        raise CliError(f"Task '{task.name}' is already open.")
+    task.set_status(IN_PROGRESS_TASK_STATUS, args.message, cursor)
+    return cli_task_dict(task), f"Marked task '{task.name}' as {task.status_str()}."
+
+
+def cli_list(args, cursor):
+    where_sqls = []
+    params = []
+    if args.prefix:
+        lo, hi = task_name_prefix_bounds(args.prefix)
+        where_sqls.append("(name=? OR (name >= ? AND name < ?))")
+        params += [args.prefix, lo, hi]
+    if args.open:
+        where_sqls.append("cache_status_code=?")
+        params.append(IN_PROGRESS_TASK_STATUS)
+    where_sql = f"WHERE {' AND '.join(where_sqls)} " if where_sqls else ""
+    res = cursor.execute("SELECT id, name, cache_beg_dt, cache_status_code, "
+                         "net_duration_sec - break_duration_sec, last_activity_dt FROM task_all "
+                         f"{where_sql}ORDER BY name",
+                         params)
+    tasks = [{"id": id_, "name": name, "beg_dt": beg_dt, "status": status, "work_sec": work_sec or 0,
+              "last_activity_dt": last_activity_dt}
+             for id_, name, beg_dt, status, work_sec, last_activity_dt in fetch_iter(res)]
+    text = "\n".join(f"{d['name']}\t{Task(d['id'], d['name'], None, d['status']).status_str()}\t"
+                     f"{sec_to_hms_str(d['work_sec'])}" for d in tasks)
+    return tasks, text
+
+
+def cli_search(args, cursor):
+    tasks = list(itertools.islice(Task.name_search(args.fragment, args.open, cursor), args.limit))
+    return [cli_task_dict(task) for task in tasks], "\n".join(task.name for task in tasks)
+
+
+def cli_search_notes(args, cursor):
+    try:
+        beg_dt_str = note_search_dt_bound(args.since, False)
+        end_dt_str = note_search_dt_bound(args.until, True)
+    except ValueError as e:
+        raise CliError(str(e))
+    rows = Note.search(args.words, args.prefix, beg_dt_str, end_dt_str, args.limit, cursor)
+    data = [{"note_id": note_id, "timestamp": timestamp, "task_id": task_id, "task": task_name, "snippet": snippet,
+             "score": score}
+            for note_id, timestamp, task_id, task_name, snippet, score in rows]
+    text = "\n".join(f"[{timestamp}] {task_name}: {snippet}" for _, timestamp, _, task_name, snippet, _ in rows)
+    return data, text or "No notes matched."
+
+
+def cli_export(args, cursor):
+    task = cli_get_task(args.task, cursor)
+    task.export(args.file_path, args.fmt, cursor)
+    return {"task": task.name, "file_path": args.file_path}, f"Exported '{task.name}' to '{args.file_path}'."
+
+
+def cli_export_all(args, _):
+    try:
+        num_exported = bulk_export(args.prefix, args.dir_path, args.fmt, args.workers)
+    except BulkExportError as e:
+        raise CliError(str(e))
+    return {"num_exported": num_exported}, f"Exported {num_exported} task(s) to '{args.dir_path}'."
+
+
+def cli_import(args, _):
+    try:
+        counts = bulk_import(args.file_path, args.fmt, args.defer_indexes, args.batch_size)
+    except DataImportError as e:
+        raise CliError(f"{e} Nothing was imported.")
+    text = ", ".join(f"{counts.get(table, 0)} {table}(s)" for table in ("task", "work", "break", "note"))
+    return counts, f"Imported {text} from '{args.file_path}'."
+
+
+def cli_archive(args, _):
+    before_dt = datetime.datetime.now() - datetime.timedelta(days=args.days)
+    num_archived = archive_tasks(dt_to_str(before_dt))
+    return ({"num_archived": num_archived, "archive_path": archive_path()},
+            f"Archived {num_archived} task(s) to '{archive_path()}'.")
+
+
+def cli_sync(args, _):
+    if not path.isfile(args.file_path):
+        raise CliError(f"No DB file {repr(args.file_path)} exists.")
+    try:
+        num_pulled, num_pushed = sync(args.file_path)
+    except SyncError as e:
+        raise CliError(str(e))
+    return ({"num_pulled": num_pulled, "num_pushed": num_pushed},
+            f"Pulled {num_pulled} change(s) from '{args.file_path}' and pushed {num_pushed} to it.")
+
+
+def cli_stats(args, cursor):
+    if args.rebuild:
+        task_stats_rebuild(cursor)
+        return {"rebuilt": True}, "Rebuilt the per-task totals."
+
+    bad_task_ids = task_stats_verify(cursor)
+    if bad_task_ids:
+        raise CliError(f"The totals of {len(bad_task_ids)} task(s) are out of date: {bad_task_ids}\n"
+                       f"Run 'flow stats --rebuild' to fix them.")
+    return {"bad_task_ids": []}, "The per-task totals are up to date."
+
+
+def cli_analytics(args, cursor):
+    analytics = TimeAnalytics.load(cursor, args.prefix)
+    by_prefix = TimeAnalytics.by_prefix(args.level, cursor, args.prefix)
+    first_day_dt, by_day = analytics.by_day()
+    first_week_dt, by_week = analytics.by_week()
+    by_hour = analytics.by_hour_of_day()
+    rolling = TimeAnalytics.rolling_average(by_day, args.window)
+
+    data = {
+        "by_prefix": dict(by_prefix.most_common()),
+        "first_day": dt_to_str(first_day_dt) if first_day_dt else None,
+        "by_day": by_day,
+        "rolling_average": rolling,
+        "first_week": dt_to_str(first_week_dt) if first_week_dt else None,
+        "by_week": by_week,
+        "by_hour_of_day": by_hour,
+    }
+
+    lines = [f"= Time per prefix (level {args.level}) ="]
+    for prefix, sec in by_prefix.most_common():
+        lines.append(f"{prefix}: {sec_to_hms_str(sec)}")
+    lines.append(f"= Last {args.days} days ({args.window}-day rolling average) =")
+    for i in range(max(0, len(by_day) - args.days), len(by_day)):
+        day_str = (first_day_dt + datetime.timedelta(days=i)).strftime("%Y-%m-%d")
+        lines.append(f"{day_str}: {sec_to_hms_str(by_day[i])} ({sec_to_hms_str(rolling[i])})")
+    lines.append("= Hour of day =")
+    for hour, sec in enumerate(by_hour):
+        lines.append(f"{hour:02}:00: {sec_to_hms_str(sec)}")
+    return data, "\n".join(lines)
+
+
+def cli_epoch(s, is_end, default=None):
+    try:
+        dt_str = note_search_dt_bound(s, is_end)
+    except ValueError as e:
+        raise CliError(str(e))
+    return default if dt_str is None else dt_to_epoch(str_to_dt(dt_str))
+
+
+def cli_timeline_segment_dict(beg, end, task_id, work_id, cursor):
+    return {"beg_dt": dt_to_str(epoch_to_dt(beg)), "end_dt": dt_to_str(epoch_to_dt(end)), "task_id": task_id,
+            "task": Task.get(task_id, cursor).name, "work_id": work_id}
+
+
+def cli_timeline_at(args, cursor):
+    timeline = Timeline.load(cursor, args.prefix)
+    data = [cli_timeline_segment_dict(*segment, cursor) for segment in timeline.at(cli_epoch(args.dt, False))]
+    text = "\n".join(f"{d['task']} (work {d['work_id']}, {d['beg_dt']} to {d['end_dt']})" for d in data)
+    return data, text or "Nothing was being worked on then."
+
+
+def cli_timeline_day(args, cursor):
+    timeline = Timeline.load(cursor, args.prefix)
+    runs = timeline.day(epoch_to_dt(cli_epoch(args.date, False)))
+    data = [{"beg_dt": dt_to_str(epoch_to_dt(beg)), "end_dt": dt_to_str(epoch_to_dt(end)),
+             "tasks": [Task.get(task_id, cursor).name for task_id in task_ids]} for beg, end, task_ids in runs]
+    text = "\n".join(f"{d['beg_dt'][11:]} - {d['end_dt'][11:]}  {', '.join(d['tasks'])}" for d in data)
+    return data, text or "Nothing was worked on that day."
+
+
+def cli_timeline_overlaps(args, cursor):
+    timeline = Timeline.load(cursor, args.prefix)
+    overlaps = timeline.overlaps(cli_epoch(args.since, False, 0), cli_epoch(args.until, True, 1 << 62))
+    data = [{"beg_dt": dt_to_str(epoch_to_dt(beg)), "end_dt": dt_to_str(epoch_to_dt(end)),
+             "segments": [cli_timeline_segment_dict(*segment, cursor) for segment in segments]}
+            for beg, end, *segments in overlaps]
+    text = "\n".join(f"{d['beg_dt']} - {d['end_dt']}  {' & '.join(s['task'] for s in d['segments'])}" for d in data)
+    return data, text or "No work sessions overlap."
+
+
+def cli_timeline_gaps(args, cursor):
+    timeline = Timeline.load(cursor, args.prefix)
+    day_beg = cli_epoch(args.date, False)
+    gaps = timeline.gaps(day_beg, day_beg + sec_per_day, args.min_minutes * 60)
+    data = [{"beg_dt": dt_to_str(epoch_to_dt(beg)), "end_dt": dt_to_str(epoch_to_dt(end)), "sec": end - beg}
+            for beg, end in gaps]
+    text = "\n".join(f"{d['beg_dt'][11:]} - {d['end_dt'][11:]}  ({sec_to_hms_str(d['sec'])})" for d in data)
+    return data, text or "There are no gaps that long."
+
+
+def cli_serve(args, _):
+    # NOTE: The process-wide connection isn't used while serving; closing it leaves the DB to the read-only pool.
+    disconnect()
+    api_serve(args.host, args.port, args.pool_size)
+    return None, None
+
+
+def cli_tui(args, _):
+    tui_main()
+    return None, None
+
+
+def cli_parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="flow", description="Run without arguments for the interactive UI.")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--trace", default=None, metavar="FILE",
+                        help="trace the SQL run and write the report to FILE at exit (as JSON if it ends in '.json')")
+    parser.add_argument("--batch", dest="batch_mode", action="store_true",
+                        help="read one sub-command per line from stdin and apply them all in one transaction")
+    subparsers = parser.add_subparsers(dest="command")
+
+    # NOTE: `transactional` sub-commands run inside a single transaction and may be batched.
+    def add_parser(name, handler, transactional=True, **kwargs):
+        sub_parser = subparsers.add_parser(name, **kwargs)
+        sub_parser.set_defaults(handler=handler, transactional=transactional)
+        return sub_parser
+
+    create_parser = add_parser("create", cli_create, help="create a task")
+    create_parser.add_argument("task", help=f"the new task's name, e.g. {task_name_re_readable_eg}")
+    create_parser.add_argument("message", help="the task's first note")
+
+    work_parser = subparsers.add_parser("work", help="start, stop or list detached work sessions")
+    work_subparsers = work_parser.add_subparsers(dest="work_command", required=True)
+    work_start_parser = work_subparsers.add_parser("start", help="start working on a task")
+    work_start_parser.set_defaults(handler=cli_work_start, transactional=True)
+    work_start_parser.add_argument("task")
+    work_stop_parser = work_subparsers.add_parser("stop", help="stop the running (detached) work session(s)")
+    work_stop_parser.set_defaults(handler=cli_work_stop, transactional=True)
+    work_stop_parser.add_argument("task", nargs="?", default=None, help="only stop the sessions on this task")
+    work_stop_parser.add_argument("--note", default="", help="a note to commemorate the session")
+    work_status_parser = work_subparsers.add_parser("status", help="list the running work sessions")
+    work_status_parser.set_defaults(handler=cli_work_status, transactional=True)
+
+    note_parser = add_parser("note", cli_note, help="add a note to a task")
+    note_parser.add_argument("task")
+    note_parser.add_argument("text")
+
+    complete_parser = add_parser("complete", cli_complete, help="mark a task as complete (or abandoned)")
+    complete_parser.add_argument("task")
+    complete_parser.add_argument("message", help="a completion note (why? how? when? future?)")
+    complete_parser.add_argument("--abandon", action="store_true", help="mark the task as abandoned instead")
+
+    reopen_parser = add_parser("reopen", cli_reopen, help="re-open a closed (or archived) task")
+    reopen_parser.add_argument("task")
+    reopen_parser.add_argument("message", help="a reopening note (why? how? when? future?)")
+
+    list_parser = add_parser("list", cli_list, help="list tasks, with the time worked on each")
+    list_parser.add_argument("prefix", nargs="?", default=None, help="only list tasks under this task-name prefix")
+    list_parser.add_argument("--open", action="store_true", help="only list open tasks")
+
+    search_parser = add_parser("search", cli_search, help="search task names")
+    search_parser.add_argument("fragment")
+    search_parser.add_argument("--open", action="store_true", help="only list open tasks")
+    search_parser.add_argument("--limit", type=int, default=20)
+
+    search_notes_parser = add_parser("search-notes", cli_search_notes, help="full-text search of the notes")
+    search_notes_parser.add_argument("words", help="words to match (all of them); end one with '*' to match a prefix")
+    search_notes_parser.add_argument("--prefix", default=None, help="only search tasks under this task-name prefix")
+    search_notes_parser.add_argument("--since", default="", help="only notes written since this date (YYYY-MM-DD)")
+    search_notes_parser.add_argument("--until", default="", help="only notes written until this date (inclusive)")
+    search_notes_parser.add_argument("--limit", type=int, default=20)
+
+    export_parser = add_parser("export", cli_export, help="export one task's record to a file")
+    export_parser.add_argument("task")
+    export_parser.add_argument("file_path")
+    export_parser.add_argument("--format", dest="fmt", choices=sorted(report_writers), default="html")
+
+    export_all_parser = add_parser("export-all", cli_export_all, transactional=False,
+                                   help="export every task under a name prefix to a directory")
+    export_all_parser.add_argument("prefix", help="task-name prefix, e.g. 'ucla.f19' (use '' for every task)")
+    export_all_parser.add_argument("dir_path", help="directory to write the reports and index.html into")
+    export_all_parser.add_argument("--format", dest="fmt", choices=sorted(report_writers), default="html")
+    export_all_parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+
+    import_parser = add_parser("import", cli_import, transactional=False,
+                               help="import tasks, work sessions, breaks and notes from a CSV or JSON Lines file")
+    import_parser.add_argument("file_path")
+    import_parser.add_argument("--format", dest="fmt", choices=("csv", "jsonl"), default=None,
+                               help="the file's format (default: from its extension)")
+    import_parser.add_argument("--defer-indexes", action="store_true",
+                               help="drop the indexes and triggers during the load, then rebuild (for large files)")
+    import_parser.add_argument("--batch-size", type=int, default=import_batch_size, help="rows per executemany")
+
+    archive_parser = add_parser("archive", cli_archive, transactional=False,
+                                help="move closed tasks with no recent activity to the archive database")
+    archive_parser.add_argument("--days", type=int, default=archive_after_days,
+                                help="archive the tasks with no activity in this many days")
+
+    sync_parser = add_parser("sync", cli_sync, transactional=False,
+                             help="exchange the changes made since the last sync with another flow DB file")
+    sync_parser.add_argument("file_path", help="the other replica's flow.db")
+
+    stats_parser = add_parser("stats", cli_stats, help="verify (or rebuild) the materialized per-task totals")
+    stats_parser.add_argument("--rebuild", action="store_true", help="recompute every task's totals from scratch")
+
+    analytics_parser = add_parser("analytics", cli_analytics, help="time spent per prefix, day, week and hour of day")
+    analytics_parser.add_argument("--prefix", default=None, help="only count tasks under this task-name prefix")
+    analytics_parser.add_argument("--level", type=int, default=2, help="task-name chunks to group totals by")
+    analytics_parser.add_argument("--days", type=int, default=14, help="number of recent days to list")
+    analytics_parser.add_argument("--window", type=int, default=7, help="rolling-average window, in days")
+
+    timeline_parser = subparsers.add_parser("timeline", help="what was worked on when: instants, days, overlaps, gaps")
+    timeline_subparsers = timeline_parser.add_subparsers(dest="timeline_command", required=True)
+    timeline_at_parser = timeline_subparsers.add_parser("at", help="what was being worked on at a date-time")
+    timeline_at_parser.set_defaults(handler=cli_timeline_at, transactional=True)
+    timeline_at_parser.add_argument("dt", help=f"e.g. '{dt_to_str(datetime.datetime(1999, 2, 4, 0, 15))}'")
+    timeline_day_parser = timeline_subparsers.add_parser("day", help="a day's timeline, merged across sessions")
+    timeline_day_parser.set_defaults(handler=cli_timeline_day, transactional=True)
+    timeline_day_parser.add_argument("date", help="YYYY-MM-DD")
+    timeline_overlaps_parser = timeline_subparsers.add_parser("overlaps", help="list overlapping work sessions")
+    timeline_overlaps_parser.set_defaults(handler=cli_timeline_overlaps, transactional=True)
+    timeline_overlaps_parser.add_argument("--since", default="", help="only overlaps since this date (YYYY-MM-DD)")
+    timeline_overlaps_parser.add_argument("--until", default="", help="only overlaps until this date (inclusive)")
+    timeline_gaps_parser = timeline_subparsers.add_parser("gaps", help="list a day's stretches with no work")
+    timeline_gaps_parser.set_defaults(handler=cli_timeline_gaps, transactional=True)
+    timeline_gaps_parser.add_argument("date", help="YYYY-MM-DD")
+    timeline_gaps_parser.add_argument("--min-minutes", type=int, default=15, help="shortest gap to list")
+    for sub_parser in (timeline_at_parser, timeline_day_parser, timeline_overlaps_parser, timeline_gaps_parser):
+        sub_parser.add_argument("--prefix", default=None, help="only count tasks under this task-name prefix")
+
+    serve_parser = add_parser("serve", cli_serve, transactional=False,
+                              help="serve tasks, totals, notes, work sessions and reminders as a read-only JSON API")
+    serve_parser.add_argument("--host", default=api_host)
+    serve_parser.add_argument("--port", type=int, default=api_port)
+    serve_parser.add_argument("--pool-size", type=int, default=api_pool_size, help="read-only DB connections")
+
+    add_parser("tui", cli_tui, transactional=False, help="run the interactive UI full-screen (curses)")
+
+    return parser
+
+
+def cli_print(as_json, data, text):
+    if as_json:
+        print(json.dumps(data))
+    elif text:
+        print(text)
+
+
+def cli_main(argv):
+    parser = cli_parser()
+    args = parser.parse_args(argv)
+    if not args.batch_mode and not args.command:
+        parser.error("a sub-command (or --batch) is required")
+
+    if args.trace:
+        trace_enable(args.trace)
+    db_init()
+    try:
+        if args.batch_mode:
+            import shlex
+
+            results = []
+            with transaction() as cursor:
+                for line_num, line in enumerate(sys.stdin, start=1):
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    op_args = parser.parse_args(shlex.split(line))
+                    if not op_args.command or not op_args.transactional:
+                        raise CliError(f"Line {line_num}: {repr(line)} cannot be batched. Nothing was applied.")
+                    try:
+                        results.append(op_args.handler(op_args, cursor))
+                    except CliError as e:
+                        raise CliError(f"Line {line_num}: {e} Nothing was applied.")
+            for data, text in results:
+                cli_print(args.json, data, text)
+        elif args.transactional:
+            with transaction() as cursor:
+                data, text = args.handler(args, cursor)
+            cli_print(args.json, data, text)
+        else:
+            data, text = args.handler(args, None)
+            cli_print(args.json, data, text)
+    except CliError as e:
+        sys.exit(f"flow: {e}")
+
+
 def hack():
-    with connect() as connection:
-        cursor = connection.cursor()
+    with transaction() as cursor:
         Task.search_reminders(cursor)
 
 
 if __name__ == "__main__":
-    main()
+    trace_enable_from_env()
+    if len(sys.argv) > 1:
+        cli_main(sys.argv[1:])
+    else:
+        main()
     # hack()
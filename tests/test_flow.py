@@ -0,0 +1,1422 @@
+import asyncio
+import contextlib
+import csv
+import datetime
+import http.client
+import io
+import itertools
+import json
+import os
+import random
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+import unittest.mock
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import flow  # noqa: E402
+
+
+class FlowTestCase(unittest.TestCase):
+    # Each test gets a fresh DB (and journal, and archive) in a temporary directory.
+
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.saved_paths = flow.db_path, flow.db_reset_sql_path
+        flow.disconnect()
+        flow.db_reset_sql_path = path.join(path.dirname(flow.__file__), "_db", "reset.sql")
+        flow.db_path = path.join(self.dir_path, "flow.db")
+        flow._task_trie = None
+        flow.model_caches_clear()
+        flow.db_init()
+
+    def tearDown(self):
+        flow.disconnect()
+        flow._task_trie = None
+        flow.model_caches_clear()
+        flow.db_path, flow.db_reset_sql_path = self.saved_paths
+        shutil.rmtree(self.dir_path)
+
+    def ui_run(self, fn, *inputs):
+        # Runs `fn` in the plain UI, answering its prompts with `inputs`; returns its result.
+        ui = unittest.mock.Mock(wraps=flow.PlainUi())
+        ui.input.side_effect = list(inputs)
+        with unittest.mock.patch.object(flow, "ui", ui), contextlib.redirect_stdout(io.StringIO()):
+            return fn()
+
+    def cli(self, *argv, stdin=""):
+        # Runs the CLI; returns its output, or raises `SystemExit` as it does on error.
+        out = io.StringIO()
+        saved_stdin = sys.stdin
+        sys.stdin = io.StringIO(stdin)
+        try:
+            with contextlib.redirect_stdout(out):
+                flow.cli_main(list(argv))
+        finally:
+            sys.stdin = saved_stdin
+        return out.getvalue()
+
+    def journal_kinds(self):
+        with open(flow.session_journal_path(), encoding="utf-8") as f:
+            return [line.split()[0] for line in f]
+
+    def add_work(self, task, beg_dt, end_dt):
+        with flow.transaction() as cursor:
+            work = flow.Work.new(task.id, beg_dt, cursor)
+            work.save(end_dt, cursor)
+        return work
+
+    @contextlib.contextmanager
+    def replica(self, dir_name):
+        # Switches to (and, the first time, makes) another replica, in its own directory; yields its DB path.
+        saved_db_path = flow.db_path
+        flow.disconnect()
+        flow.model_caches_clear()
+        flow.db_path = path.join(self.dir_path, dir_name, "flow.db")
+        os.makedirs(path.dirname(flow.db_path), exist_ok=True)
+        try:
+            flow.db_init()
+            yield flow.db_path
+        finally:
+            flow.disconnect()
+            flow._task_trie = None
+            flow.model_caches_clear()
+            flow.db_path = saved_db_path
+
+    def make_base_db(self, dir_name, *inserts):
+        # Makes a DB at the base schema (version 0), as made before migrations existed, with the rows of the
+        # `(sql, params)` `inserts`; returns its path.
+        db_path = path.join(self.dir_path, dir_name, "flow.db")
+        os.makedirs(path.dirname(db_path))
+        with open(flow.db_reset_sql_path) as db_reset:
+            init_sql = db_reset.read()
+        connection = sqlite3.connect(db_path)
+        with connection:
+            for command in init_sql.split(";"):
+                connection.execute(command)
+            for sql, params in inserts:
+                connection.execute(sql, params)
+        connection.close()
+        return db_path
+
+    def archive_task(self, name):
+        # Closes task `name`, then archives it (and every other closed task).
+        with flow.transaction() as cursor:
+            task = flow.Task.get_by_name(name, cursor)
+            task.set_status(flow.COMPLETE_TASK_STATUS, "done", cursor)
+        before_dt = datetime.datetime.now() + datetime.timedelta(days=1)
+        self.assertEqual(flow.archive_tasks(flow.dt_to_str(before_dt)), 1)
+
+
+class ConnectionTest(FlowTestCase):
+    def test_one_tuned_connection(self):
+        with flow.transaction() as cursor:
+            connection = cursor.connection
+        self.assertIs(flow.connect(), connection)
+        with flow.transaction() as cursor:
+            self.assertIs(cursor.connection, connection)
+        self.assertEqual(connection.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        self.assertEqual(connection.execute("PRAGMA synchronous").fetchone()[0], 1)
+        self.assertEqual(connection.execute("PRAGMA foreign_keys").fetchone()[0], 1)
+        self.assertEqual(connection.execute("PRAGMA cache_size").fetchone()[0], -flow.db_cache_size_kib)
+
+    def test_reader_during_write(self):
+        # WAL: another connection reads the last commit while a write is in progress.
+        with flow.transaction() as cursor:
+            flow.Task.new("a", "first", cursor)
+        reader = flow.connect_read_only()
+        try:
+            with flow.transaction() as cursor:
+                flow.Task.new("b", "first", cursor)
+                self.assertEqual(reader.execute("SELECT name FROM task").fetchall(), [("a",)])
+            self.assertEqual(reader.execute("SELECT name FROM task ORDER BY name").fetchall(), [("a",), ("b",)])
+        finally:
+            reader.close()
+
+    def test_rollback_on_error(self):
+        with self.assertRaises(ZeroDivisionError):
+            with flow.transaction() as cursor:
+                flow.Task.new("a", "first", cursor)
+                1 / 0
+        with flow.transaction() as cursor:
+            self.assertEqual(cursor.execute("SELECT COUNT(*) FROM task").fetchone()[0], 0)
+
+
+class MigrationTest(FlowTestCase):
+    def setUp(self):
+        super().setUp()
+        self.base_db_path = self.make_base_db("base")
+
+    def applied_versions(self):
+        connection = sqlite3.connect(self.base_db_path)
+        try:
+            return [version for version, in connection.execute("SELECT version FROM schema_version ORDER BY 1")]
+        finally:
+            connection.close()
+
+    def test_migrates_to_latest(self):
+        with self.replica("base"):
+            flow.db_migrate()  # (Already done by `db_init`: a no-op.)
+            with flow.transaction() as cursor:
+                self.assertEqual(flow.db_schema_version(cursor), len(flow.db_migrations))
+        self.assertEqual(self.applied_versions(), list(range(1, len(flow.db_migrations) + 1)))
+
+    def test_concurrent_migrations(self):
+        script = (f"import sys; sys.path.insert(0, {repr(path.dirname(flow.__file__))}); import flow; "
+                  f"flow.db_path = {repr(self.base_db_path)}; flow.db_migrate()")
+        processes = [subprocess.Popen([sys.executable, "-c", script], stderr=subprocess.PIPE) for _ in range(4)]
+        for process in processes:
+            _, stderr = process.communicate(timeout=60)
+            self.assertEqual(process.returncode, 0, stderr.decode())
+        self.assertEqual(self.applied_versions(), list(range(1, len(flow.db_migrations) + 1)))
+
+
+class SessionRecoveryTest(FlowTestCase):
+    def setUp(self):
+        super().setUp()
+        with flow.transaction() as cursor:
+            self.task = flow.Task.new("a.b", "first", cursor)
+        self.beg_dt = datetime.datetime(2024, 1, 10, 10)
+        # The pid of a process that has exited:
+        process = subprocess.Popen([sys.executable, "-c", ""])
+        process.wait()
+        self.dead_pid = process.pid
+
+    def start_work(self):
+        with flow.transaction() as cursor:
+            return flow.Work.new(self.task.id, self.beg_dt, cursor)
+
+    def write_journal(self, *lines):
+        with open(flow.session_journal_path(), "a", encoding="utf-8") as f:
+            f.writelines(line + "\n" for line in lines)
+
+    def test_running_session_ends_at_last_heartbeat(self):
+        work = self.start_work()
+        self.write_journal(f"S {work.id} {self.dead_pid} 2024-01-10 10:00:00",
+                           f"H {work.id} {self.dead_pid} 2024-01-10 10:20:00",
+                           f"H {work.id} {self.dead_pid} 2024-01-10 10:20:01",
+                           f"H {work.id} {self.dead_pid} 2024-01-10 1")  # (Cut short by the crash.)
+        self.assertEqual(flow.session_journal_recover(), [work.id])
+
+        flow.model_caches_clear()
+        with flow.transaction() as cursor:
+            work = flow.Work.get(work.id, cursor)
+            self.assertEqual((work.end_dt, work.duration_sec), (datetime.datetime(2024, 1, 10, 10, 20, 1), 1201))
+            flow_texts = [flow_text for flow_text, in cursor.execute("SELECT flow_text FROM note WHERE opt_work_id=?",
+                                                                     (work.id,))]
+            self.assertEqual(flow_texts, ["recover-work,end-work"])
+        self.assertEqual(self.journal_kinds(), [])
+        self.assertEqual(flow.session_journal_recover(), [])
+
+    def test_paused_session_ends_at_pause(self):
+        work = self.start_work()
+        self.write_journal(f"S {work.id} {self.dead_pid} 2024-01-10 10:00:00",
+                           f"P {work.id} {self.dead_pid} 2024-01-10 10:05:00")
+        flow.db_init()
+        flow.model_caches_clear()
+        with flow.transaction() as cursor:
+            self.assertEqual(flow.Work.get(work.id, cursor).duration_sec, 300)
+
+    def test_live_sessions_are_kept(self):
+        work = self.start_work()
+        detached = self.start_work()
+        self.write_journal(f"S {work.id} {self.dead_pid} 2024-01-10 10:00:00",
+                           f"S 999 {os.getppid()} 2024-01-10 10:00:00",
+                           f"S {detached.id} {flow.session_journal_detached_pid} 2024-01-10 10:00:00",
+                           f"S 998 {os.getppid()} 2024-01-10 10:00:00",
+                           f"E 998 {os.getppid()} 2024-01-10 10:01:00")
+        self.assertEqual(flow.session_journal_recover(), [work.id])
+        with open(flow.session_journal_path(), encoding="utf-8") as f:
+            self.assertEqual([line.split()[:2] for line in f], [["S", "999"], ["S", str(detached.id)]])
+
+        # A session journaled after the compaction is appended to what is left:
+        journal = flow.SessionJournal(work.id)
+        journal.start(self.beg_dt)
+        journal.f.close()
+        self.assertEqual(self.journal_kinds(), ["S", "S", "S"])
+
+
+class WorkSessionTest(FlowTestCase):
+    def setUp(self):
+        super().setUp()
+        with flow.transaction() as cursor:
+            self.task = flow.Task.new("a.b", "first", cursor)
+
+    @contextlib.contextmanager
+    def pausing_ui(self, *inputs, after_sec=0.0):
+        # The plain UI, answering prompts with `inputs`, and pausing each running session `after_sec` in.
+        ui = unittest.mock.Mock(wraps=flow.PlainUi())
+        ui.pause_hint = flow.PlainUi.pause_hint
+        ui.input.side_effect = list(inputs)
+
+        def _watch_keys(loop, on_pause):
+            handle = loop.call_later(after_sec, on_pause)
+            return handle.cancel
+
+        ui.watch_keys.side_effect = _watch_keys
+        with unittest.mock.patch.object(flow, "ui", ui), contextlib.redirect_stdout(io.StringIO()):
+            yield ui
+
+    def db_work(self, work_id):
+        with flow.transaction() as cursor:
+            return cursor.execute("SELECT cache_end_dt, cache_duration_sec FROM work WHERE id=?", (work_id,)).fetchone()
+
+    def test_timer_saves_and_pauses(self):
+        beg_dt = datetime.datetime.now()
+        with flow.transaction() as cursor:
+            work = flow.Work.new(self.task.id, beg_dt, cursor)
+        session = flow.WorkSession(self.task, work, save_interval_sec=0.05)
+        with self.pausing_ui(after_sec=0.3) as ui:
+            reason, end_dt = asyncio.run(session.run())
+        self.assertEqual(reason, "pause")
+        self.assertGreaterEqual(end_dt - beg_dt, datetime.timedelta(seconds=0.3))
+        # The saver ran while the timer was showing, and the pause flushed the end time:
+        self.assertTrue(session.status_msg.startswith("[Last auto-saved at "), session.status_msg)
+        self.assertTrue(ui.show_status.called)
+        ui.end_status.assert_called_once_with()
+        self.assertEqual(self.db_work(work.id)[0], flow.dt_to_str(end_dt))
+
+        with flow.transaction() as cursor:
+            session.add_break(end_dt, end_dt + datetime.timedelta(minutes=5), cursor)
+        self.assertEqual(session.cum_break_sec, 300)
+        self.assertEqual(session.net_elapsed_sec(end_dt + datetime.timedelta(minutes=10)), 600 - 300)
+        session.close(end_dt)
+        kinds = self.journal_kinds()
+        self.assertEqual((kinds[0], kinds[-3:]), ("S", ["P", "R", "E"]))
+        self.assertIn("H", kinds)
+
+    def test_signal_ends_the_run(self):
+        with flow.transaction() as cursor:
+            work = flow.Work.new(self.task.id, datetime.datetime.now(), cursor)
+        session = flow.WorkSession(self.task, work)
+        with self.pausing_ui(after_sec=60) as ui:
+            def _watch_keys(loop, on_pause):
+                handle = loop.call_later(0.1, os.kill, os.getpid(), signal.SIGTERM)
+                return handle.cancel
+
+            ui.watch_keys.side_effect = _watch_keys
+            reason, end_dt = asyncio.run(session.run())
+        session.close(end_dt)
+        self.assertEqual(reason, "signal")
+        self.assertEqual(self.db_work(work.id)[0], flow.dt_to_str(end_dt))
+
+    def test_work_screen_transitions(self):
+        # Pause, add a note (and dismiss the notice), resume; pause, continue (a break), resume; pause, stop, confirm,
+        # commemorate (and dismiss the notice).
+        with self.pausing_ui("0", "a note", "", "1", "2", "y", "done", "", after_sec=0.05):
+            flow.work_screen(self.task, save_interval_sec=60)
+        with flow.transaction() as cursor:
+            work_id, end_dt_str, duration_sec = cursor.execute(
+                "SELECT id, cache_end_dt, cache_duration_sec FROM work WHERE task_id=?", (self.task.id,)).fetchone()
+            notes = cursor.execute("SELECT user_text, flow_text FROM note WHERE opt_work_id=? ORDER BY id",
+                                   (work_id,)).fetchall()
+            num_breaks, = cursor.execute("SELECT COUNT(*) FROM break WHERE work_id=?", (work_id,)).fetchone()
+        self.assertEqual(notes, [("a note", "work-note"), ("done", "end-work")])
+        self.assertEqual(num_breaks, 1)
+        self.assertIsNotNone(end_dt_str)
+        self.assertEqual(self.journal_kinds().count("P"), 3)
+        self.assertEqual(self.journal_kinds()[-1], "E")
+
+
+class TaskStatsTest(FlowTestCase):
+    def setUp(self):
+        super().setUp()
+        with flow.transaction() as cursor:
+            self.ab = flow.Task.new("a.b", "first", cursor)
+            self.cd = flow.Task.new("c.d", "first", cursor)
+
+    def assert_verified(self, sql, params=()):
+        with flow.transaction() as cursor:
+            cursor.execute(sql, params)
+            self.assertEqual(flow.task_stats_verify(cursor), [], sql)
+
+    def stats(self, task_id):
+        with flow.transaction() as cursor:
+            return cursor.execute("SELECT net_duration_sec, num_sessions, num_breaks, break_duration_sec "
+                                  "FROM task_stats WHERE task_id=?", (task_id,)).fetchone()
+
+    def test_triggers_follow_writes(self):
+        work_sql = "INSERT INTO work (id, task_id, cache_beg_dt, cache_end_dt, cache_duration_sec) VALUES (?,?,?,?,?)"
+        break_sql = "INSERT INTO break (id, task_id, work_id, beg_dt, end_dt, duration_sec) VALUES (?,?,?,?,?,?)"
+        self.assert_verified(work_sql, (1, self.ab.id, "2024-01-10 10:00:00", "2024-01-10 11:00:00", 3600))
+        self.assert_verified(work_sql, (2, self.ab.id, "2024-01-11 10:00:00", "2024-01-11 10:30:00", 1800))
+        self.assert_verified(break_sql, (1, self.ab.id, 1, "2024-01-10 10:10:00", "2024-01-10 10:20:00", 600))
+        self.assert_verified(break_sql, (2, self.ab.id, 2, "2024-01-11 10:10:00", "2024-01-11 10:15:00", 300))
+        self.assertEqual(self.stats(self.ab.id), (5400, 2, 2, 900))
+
+        # Sessions grow, and move between tasks; breaks change and go:
+        self.assert_verified("UPDATE work SET cache_end_dt='2024-01-11 12:00:00', cache_duration_sec=7200 WHERE id=2")
+        self.assert_verified("UPDATE break SET duration_sec=120, end_dt='2024-01-10 10:12:00' WHERE id=1")
+        self.assert_verified("UPDATE break SET task_id=?, work_id=? WHERE id=2", (self.cd.id, 2))
+        self.assert_verified("UPDATE work SET task_id=? WHERE id=2", (self.cd.id,))
+        self.assertEqual(self.stats(self.ab.id), (3600, 1, 1, 120))
+        self.assertEqual(self.stats(self.cd.id), (7200, 1, 1, 300))
+
+        self.assert_verified("DELETE FROM break WHERE id=1")
+        self.assert_verified("DELETE FROM break WHERE id=2")
+        self.assert_verified("DELETE FROM work WHERE id=2")
+        self.assertEqual(self.stats(self.cd.id), (0, 0, 0, 0))
+        self.assertEqual(self.stats(self.ab.id), (3600, 1, 0, 0))
+
+    def test_model_writes(self):
+        beg_dt = datetime.datetime(2024, 1, 10, 10)
+        work = self.add_work(self.ab, beg_dt, beg_dt + datetime.timedelta(hours=1))
+        with flow.transaction() as cursor:
+            flow.Work.add_break(self.ab.id, work.id, beg_dt, beg_dt + datetime.timedelta(minutes=5), 300, cursor)
+            flow.Note.new(self.ab.id, work.id, beg_dt + datetime.timedelta(days=2), "later", "", cursor)
+            self.assertEqual(flow.task_stats_verify(cursor), [])
+        self.assertEqual(self.stats(self.ab.id), (3600, 1, 1, 300))
+
+    def test_rebuild_repairs(self):
+        self.add_work(self.ab, datetime.datetime(2024, 1, 10, 10), datetime.datetime(2024, 1, 10, 11))
+        with flow.transaction() as cursor:
+            cursor.execute("UPDATE task_stats SET net_duration_sec=5, num_sessions=9 WHERE task_id=?", (self.ab.id,))
+            cursor.execute("DELETE FROM task_stats WHERE task_id=?", (self.cd.id,))
+            self.assertEqual(flow.task_stats_verify(cursor), [self.ab.id, self.cd.id])
+            flow.task_stats_rebuild(cursor)
+            self.assertEqual(flow.task_stats_verify(cursor), [])
+        self.assertEqual(self.stats(self.ab.id), (3600, 1, 0, 0))
+
+
+class NoteTagTest(FlowTestCase):
+    def setUp(self):
+        super().setUp()
+        with flow.transaction() as cursor:
+            self.ab = flow.Task.new("a.b", "first", cursor)
+            self.cd = flow.Task.new("c.d", "first", cursor)
+            self.ef = flow.Task.new("e.f", "first", cursor)
+            self.notes = [flow.Note.new(task.id, None, None, text, "", cursor) for task, text in (
+                (self.ab, "#reminder call back"),
+                (self.cd, "Call back, #Reminder #urgent"),
+                (self.ef, "#reminders are not #reminder-like tags, nor is &#reminder"),
+            )]
+
+    def tags(self):
+        with flow.transaction() as cursor:
+            return sorted(cursor.execute("SELECT tag, task_id, note_id FROM note_tag"))
+
+    def test_tags(self):
+        ab_note, cd_note, ef_note = self.notes
+        self.assertEqual(self.tags(), sorted([
+            ("reminder", self.ab.id, ab_note.id), ("reminder", self.cd.id, cd_note.id),
+            ("urgent", self.cd.id, cd_note.id), ("reminders", self.ef.id, ef_note.id),
+            ("reminder-like", self.ef.id, ef_note.id),
+        ]))
+
+    def test_reminders(self):
+        with flow.transaction() as cursor:
+            self.assertEqual([task_id for _, task_id in flow.Task.search_reminders(cursor)], [self.cd.id, self.ab.id])
+            self.assertEqual([task.id for task in flow.Task.tag_search_page("reminder", self.cd.id, 10, cursor)],
+                             [self.ab.id])
+
+    def test_delete_and_rebuild(self):
+        with flow.transaction() as cursor:
+            cursor.execute("DELETE FROM note WHERE id=?", (self.notes[1].id,))
+        self.assertNotIn(self.cd.id, [task_id for _, task_id, _ in self.tags()])
+        expected = self.tags()
+        with flow.transaction() as cursor:
+            flow.note_tag_rebuild(cursor)
+        self.assertEqual(self.tags(), expected)
+
+    def test_migration_backfills(self):
+        self.make_base_db(
+            "base",
+            ("INSERT INTO task (id, name, cache_beg_dt) VALUES (?,?,?)", (1, "a.b", "2024-01-10 10:00:00")),
+            ("INSERT INTO note (task_id, timestamp, user_text, flow_text) VALUES (?,?,?,?)",
+             (1, "2024-01-10 10:00:00", "#reminder #x", "new-task")),
+            ("INSERT INTO note (task_id, timestamp, user_text, flow_text) VALUES (?,?,?,?)",
+             (1, "2024-01-10 10:05:00", None, "")))
+        with self.replica("base"):
+            self.assertEqual(self.tags(), [("reminder", 1, 1), ("x", 1, 1)])
+
+
+class BatchJournalTest(FlowTestCase):
+    def test_rolled_back_start_leaves_no_journal_line(self):
+        self.cli("create", "a.b", "first")
+        with self.assertRaises(SystemExit):
+            self.cli("--batch", stdin="work start a.b\nnote no.such-task oops\n")
+        self.assertFalse(path.exists(flow.session_journal_path()) and self.journal_kinds())
+        with flow.transaction() as cursor:
+            self.assertEqual(cursor.execute("SELECT COUNT(*) FROM work").fetchone()[0], 0)
+
+    def test_rolled_back_stop_leaves_session_running(self):
+        self.cli("create", "a.b", "first")
+        self.cli("work", "start", "a.b")
+        with self.assertRaises(SystemExit):
+            self.cli("--batch", stdin="work stop\nnote no.such-task oops\n")
+        self.assertEqual(self.journal_kinds(), ["S"])
+
+        # The session can still be stopped, and saves its duration:
+        self.assertIn("Stopped work", self.cli("work", "stop"))
+        self.assertEqual(self.journal_kinds(), ["S", "E"])
+        self.assertIn("No work sessions are running.", self.cli("work", "status"))
+
+
+class ArchivedReadsTest(FlowTestCase):
+    # An archived task still counts in every listing and total.
+
+    def setUp(self):
+        super().setUp()
+        self.cli("create", "a.old", "archived")
+        self.cli("create", "a.new", "live")
+        self.beg_dt = datetime.datetime(2024, 1, 10, 10)
+        with flow.transaction() as cursor:
+            old = flow.Task.get_by_name("a.old", cursor)
+            new = flow.Task.get_by_name("a.new", cursor)
+        self.add_work(old, self.beg_dt, self.beg_dt + datetime.timedelta(hours=1))
+        self.add_work(new, self.beg_dt + datetime.timedelta(hours=2), self.beg_dt + datetime.timedelta(hours=3))
+        self.old_id = old.id
+        self.archive_task("a.old")
+
+    def test_list(self):
+        lines = self.cli("list", "a").splitlines()
+        self.assertEqual([line.split("\t")[0] for line in lines], ["a.new", "a.old"])
+        self.assertIn("1h 0m 0s", lines[1])
+
+    def test_by_prefix(self):
+        with flow.transaction() as cursor:
+            self.assertEqual(flow.TimeAnalytics.by_prefix(1, cursor), {"a": 2 * 3600})
+            self.assertEqual(flow.TimeAnalytics.by_prefix(2, cursor, "a.old"), {"a.old": 3600})
+
+    def test_analytics(self):
+        with flow.transaction() as cursor:
+            _, by_day = flow.TimeAnalytics.load(cursor).by_day()
+            self.assertEqual(sum(by_day), 2 * 3600)
+            _, by_day = flow.TimeAnalytics.load(cursor, "a.old").by_day()
+            self.assertEqual(sum(by_day), 3600)
+
+    def test_timeline(self):
+        at_epoch = flow.dt_to_epoch(self.beg_dt + datetime.timedelta(minutes=30))
+        with flow.transaction() as cursor:
+            for prefix in (None, "a.old"):
+                segments = flow.Timeline.load(cursor, prefix).at(at_epoch)
+                self.assertEqual([segment[2] for segment in segments], [self.old_id])
+
+    def test_export_all(self):
+        dir_path = path.join(self.dir_path, "export")
+        self.assertIn("Exported 2 task(s)", self.cli("export-all", "", dir_path, "--workers", "1"))
+        self.assertEqual(len(os.listdir(dir_path)), 3)
+
+    def test_api(self):
+        connection = flow.connect_read_only()
+        try:
+            cursor = connection.cursor()
+            tasks = flow.api_tasks({}, cursor)["tasks"]
+            self.assertEqual([(task["name"], task["work_sec"]) for task in tasks], [("a.new", 3600), ("a.old", 3600)])
+            self.assertEqual(flow.api_totals({"level": ["1"]}, cursor), {"by_prefix": {"a": 2 * 3600}})
+        finally:
+            connection.close()
+
+
+    def test_import_to_archived_task(self):
+        file_path = path.join(self.dir_path, "work.jsonl")
+        with open(file_path, "w", encoding="utf-8") as f:
+            f.write('{"type": "task", "name": "a.old"}\n')
+            f.write('{"type": "work", "task": "a.old", "beg_dt": "2024-02-01 10:00:00", "duration_sec": 600}\n')
+        self.assertEqual(flow.bulk_import(file_path), {"work": 1})
+        with flow.transaction() as cursor:
+            self.assertEqual(cursor.execute("SELECT id FROM main.task WHERE name='a.old'").fetchall(), [(self.old_id,)])
+            self.assertEqual(flow.TimeAnalytics.by_prefix(2, cursor, "a.old"), {"a.old": 3600 + 600})
+            flow.Task.get(self.old_id, cursor).set_status(flow.IN_PROGRESS_TASK_STATUS, "again", cursor)
+
+
+class EpochColumnTest(FlowTestCase):
+    dt_strs = ("2024-01-10 10:00:00", "2024-02-29 23:59:59", "1999-12-31 23:59:59", "1969-07-20 20:17:40")
+
+    def assert_epochs(self, cursor):
+        for table, epoch_column, dt_column in (
+                ("task", "beg_epoch", "cache_beg_dt"), ("work", "beg_epoch", "cache_beg_dt"),
+                ("work", "end_epoch", "cache_end_dt"), ("break", "beg_epoch", "beg_dt"),
+                ("break", "end_epoch", "end_dt"), ("note", "epoch", "timestamp")):
+            rows = cursor.execute(f"SELECT {epoch_column}, {dt_column} FROM {table}").fetchall()
+            self.assertTrue(rows, table)
+            for epoch, dt_str in rows:
+                self.assertEqual(epoch, flow.dt_to_epoch(flow.str_to_dt(dt_str)), (table, dt_str))
+                self.assertEqual(flow.db_dt(epoch, dt_str), flow.str_to_dt(dt_str))
+
+    def test_match_str_to_dt(self):
+        with flow.transaction() as cursor:
+            task = flow.Task.new("a.b", "first", cursor)
+            for dt_str in self.dt_strs:
+                work = flow.Work.new(task.id, flow.str_to_dt(dt_str), cursor)
+                flow.Work.add_break(task.id, work.id, work.beg_dt, work.beg_dt, 0, cursor)
+                flow.Note.new(task.id, work.id, work.beg_dt, "note", "", cursor)
+            self.assert_epochs(cursor)
+
+    def test_migration_on_existing_data(self):
+        inserts = [("INSERT INTO task (id, name, cache_beg_dt) VALUES (1, 'a.b', ?)", (self.dt_strs[0],))]
+        for i, dt_str in enumerate(self.dt_strs, start=1):
+            inserts += [
+                ("INSERT INTO work (id, task_id, cache_beg_dt, cache_end_dt, cache_duration_sec) VALUES (?,1,?,?,0)",
+                 (i, dt_str, dt_str)),
+                ("INSERT INTO break (task_id, work_id, beg_dt, end_dt, duration_sec) VALUES (1,?,?,?,0)",
+                 (i, dt_str, dt_str)),
+                ("INSERT INTO note (task_id, timestamp, user_text, flow_text) VALUES (1,?,'note','')", (dt_str,)),
+            ]
+        self.make_base_db("base", *inserts)
+        with self.replica("base"):
+            with flow.transaction() as cursor:
+                self.assert_epochs(cursor)
+                self.assertEqual(len(flow.Timeline.load(cursor)), 0)  # (All zero-length.)
+
+    def test_unreadable_date_times_are_skipped(self):
+        with flow.transaction() as cursor:
+            task = flow.Task.new("a.b", "first", cursor)
+        self.add_work(task, datetime.datetime(2024, 1, 10, 10), datetime.datetime(2024, 1, 10, 11))
+        with flow.transaction() as cursor:
+            cursor.execute("INSERT INTO work (task_id, cache_beg_dt, cache_end_dt, cache_duration_sec) "
+                           "VALUES (?, '2024-01-10 12:00:00', NULL, 0)", (task.id,))
+            cursor.execute("INSERT INTO work (task_id, cache_beg_dt, cache_end_dt, cache_duration_sec) "
+                           "VALUES (?, 'yesterday', '2024-01-10 13:00:00', 0)", (task.id,))
+            for prefix in (None, "a"):
+                analytics = flow.TimeAnalytics.load(cursor, prefix)
+                self.assertEqual((len(analytics.work), sum(analytics.by_day()[1])), (1, 3600))
+                self.assertEqual(len(flow.Timeline.load(cursor, prefix)), 1)
+
+
+class QueryTracerTest(unittest.TestCase):
+    def setUp(self):
+        self.tracer = flow.QueryTracer()
+        patcher = unittest.mock.patch.object(flow, "_tracer", self.tracer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.connection = sqlite3.connect(":memory:", factory=flow.TracedConnection)
+        self.addCleanup(self.connection.close)
+        self.tracer.attach(self.connection)
+        self.connection.execute("CREATE TABLE t (x INTEGER, s TEXT)")
+
+    def test_normalize_sql(self):
+        self.assertEqual(flow.trace_normalize_sql("SELECT *  FROM t\n WHERE x = -12 AND s = 'it''s' OR s IS NULL"),
+                         "SELECT * FROM t WHERE x = ? AND s = ? OR s IS ?")
+
+    def test_statements_and_calls(self):
+        def insert_all(n):
+            for i in range(n):
+                self.connection.execute("INSERT INTO t (x, s) VALUES (?,?)", (i, str(i)))
+
+        traced_insert_all = self.tracer.wrap("Test.insert_all", insert_all)
+        traced_insert_all(3)
+        traced_insert_all(5)
+
+        entry = self.tracer.statements["INSERT INTO t (x, s) VALUES (?,?)"]
+        self.assertEqual((entry.num_statements, entry.latency.count), (8, 8))
+        calls = self.tracer.calls["Test.insert_all"]
+        self.assertEqual((calls.latency.count, calls.num_statements), (2, 8))
+
+        report = self.tracer.to_dict()
+        self.assertEqual(report["calls"]["Test.insert_all"]["statements"], 8)
+        self.assertTrue(any("Test.insert_all" in line for line in self.tracer.report_lines()))
+
+    def test_slow_queries(self):
+        with unittest.mock.patch.object(flow, "trace_slow_query_ms", 0):
+            self.tracer.wrap("Test.count", lambda: self.connection.execute("SELECT COUNT(*) FROM t").fetchone())()
+        _, _, sql, call = self.tracer.slow_queries[-1]
+        self.assertEqual((sql, call), ("SELECT COUNT(*) FROM t", "Test.count"))
+
+    def test_histogram(self):
+        histogram = flow.LatencyHistogram()
+        for sec in (0.000001, 0.000003, 0.0005, 0.002):
+            histogram.add(sec)
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.percentile_ms(0.5), 0.004)
+        self.assertEqual(histogram.percentile_ms(1.0), 2.048)
+        self.assertAlmostEqual(histogram.to_dict()["max_ms"], 2.0)
+
+
+class TimeAnalyticsTest(unittest.TestCase):
+    def epoch(self, *args):
+        return flow.dt_to_epoch(datetime.datetime(*args))
+
+    def test_bucket_totals_match_brute_force(self):
+        rng = random.Random(8)
+        intervals = []
+        for _ in range(200):
+            beg = rng.randrange(0, 10000)
+            intervals.append((beg, beg + rng.randrange(0, 500)))
+        interval_set = flow.IntervalSet(*zip(*intervals))
+        for beg, width, num_buckets in ((0, 100, 105), (-50, 37, 300), (2000, 1, 50), (20000, 10, 3)):
+            expected = [sum(max(0, min(end, bucket_beg + width) - max(beg_, bucket_beg)) for beg_, end in intervals)
+                        for bucket_beg in range(beg, beg + width * num_buckets, width)]
+            self.assertEqual(interval_set.bucket_totals(beg, width, num_buckets), expected, (beg, width))
+
+    def test_empty(self):
+        analytics = flow.TimeAnalytics(flow.IntervalSet((), ()), flow.IntervalSet((), ()))
+        self.assertEqual(analytics.by_day(), (None, []))
+        self.assertEqual(analytics.by_hour_of_day(), [0] * 24)
+
+    def test_day_and_week_boundaries(self):
+        # Sunday 2024-01-07 23:00 to Monday 01:00, with a break across midnight, then Monday 2024-01-15 10:00-11:00.
+        work = flow.IntervalSet((self.epoch(2024, 1, 7, 23), self.epoch(2024, 1, 15, 10)),
+                                (self.epoch(2024, 1, 8, 1), self.epoch(2024, 1, 15, 11)))
+        breaks = flow.IntervalSet((self.epoch(2024, 1, 7, 23, 50),), (self.epoch(2024, 1, 8, 0, 20),))
+        analytics = flow.TimeAnalytics(work, breaks)
+
+        first_day_dt, by_day = analytics.by_day()
+        self.assertEqual(first_day_dt, datetime.datetime(2024, 1, 7))
+        self.assertEqual(by_day, [50 * 60, 40 * 60, 0, 0, 0, 0, 0, 0, 3600])
+
+        first_monday_dt, by_week = analytics.by_week()
+        self.assertEqual(first_monday_dt, datetime.datetime(2024, 1, 1))
+        self.assertEqual(first_monday_dt.weekday(), 0)
+        self.assertEqual(by_week, [50 * 60, 40 * 60, 3600])
+
+    def test_hour_of_day_wraps(self):
+        # 22:30 to 01:30 on two days, so the hours wrap past midnight and both days fall into the same hours.
+        begs = (self.epoch(2024, 1, 7, 22, 30), self.epoch(2024, 1, 8, 22, 30))
+        ends = (self.epoch(2024, 1, 8, 1, 30), self.epoch(2024, 1, 9, 1, 30))
+        by_hour = flow.TimeAnalytics(flow.IntervalSet(begs, ends), flow.IntervalSet((), ())).by_hour_of_day()
+        expected = [0] * 24
+        expected[22], expected[23], expected[0], expected[1] = 2 * 1800, 2 * 3600, 2 * 3600, 2 * 1800
+        self.assertEqual(by_hour, expected)
+
+    def test_rolling_average(self):
+        self.assertEqual(flow.TimeAnalytics.rolling_average([2, 4, 6, 8], 2), [2, 3, 5, 7])
+
+
+class TimelineTest(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(22)
+        self.segments = []
+        for work_id in range(1, 81):
+            beg = rng.randrange(0, 1000)
+            self.segments.append((beg, beg + rng.randrange(1, 60), rng.randrange(1, 5), work_id))
+        self.segments.sort()
+        self.timeline = flow.Timeline(self.segments)
+        self.ranges = [(0, 1100), (-10, 5), (250, 251), (300, 420), (990, 1200), (500, 500)]
+
+    def active(self, t):
+        return [segment for segment in self.segments if segment[0] <= t < segment[1]]
+
+    def test_at(self):
+        for t in range(-5, 1070, 7):
+            self.assertEqual(self.timeline.at(t), self.active(t), t)
+
+    def test_between(self):
+        for beg, end in self.ranges:
+            expected = [segment for segment in self.segments if segment[0] < end and segment[1] > beg]
+            self.assertEqual(self.timeline.between(beg, end), expected, (beg, end))
+
+    def test_gaps(self):
+        for beg, end in self.ranges:
+            for min_sec in (0, 3):
+                expected = []
+                for idle, run in itertools.groupby(range(beg, end), key=lambda t: not self.active(t)):
+                    run = list(run)
+                    if idle and len(run) >= max(min_sec, 1):
+                        expected.append((run[0], run[-1] + 1))
+                self.assertEqual(self.timeline.gaps(beg, end, min_sec), expected, (beg, end, min_sec))
+
+    def test_overlaps(self):
+        for beg, end in self.ranges:
+            expected = []
+            for i, segment in enumerate(self.segments):
+                for other in self.segments[:i]:
+                    overlap_beg, overlap_end = max(segment[0], other[0], beg), min(segment[1], other[1], end)
+                    if overlap_beg < overlap_end:
+                        expected.append((overlap_beg, overlap_end, other, segment))
+            self.assertEqual(sorted(self.timeline.overlaps(beg, end)), sorted(expected), (beg, end))
+
+    def test_merged(self):
+        for beg, end in self.ranges:
+            expected = []
+            for task_ids, run in itertools.groupby(
+                    range(beg, end), key=lambda t: tuple(sorted({segment[2] for segment in self.active(t)}))):
+                run = list(run)
+                if task_ids:
+                    expected.append((run[0], run[-1] + 1, task_ids))
+            self.assertEqual(self.timeline.merged(beg, end), expected, (beg, end))
+
+    def test_empty(self):
+        timeline = flow.Timeline(())
+        self.assertEqual((len(timeline), timeline.at(5), timeline.between(0, 10)), (0, [], []))
+        self.assertEqual(timeline.gaps(0, 10), [(0, 10)])
+        self.assertEqual(timeline.merged(0, 10), [])
+
+    def test_subtract(self):
+        self.assertEqual(flow.Timeline.subtract(0, 100, [(-5, 10), (20, 30), (25, 40), (90, 200)]),
+                         [(10, 20), (40, 90)])
+        self.assertEqual(flow.Timeline.subtract(0, 100, [(0, 100)]), [])
+        self.assertEqual(flow.Timeline.subtract(0, 100, []), [(0, 100)])
+
+
+class TimelineLoadTest(FlowTestCase):
+    def test_breaks_split_sessions(self):
+        beg_dt = datetime.datetime(2024, 1, 10, 10)
+        with flow.transaction() as cursor:
+            ab = flow.Task.new("a.b", "first", cursor)
+            cd = flow.Task.new("c.d", "first", cursor)
+        work = self.add_work(ab, beg_dt, beg_dt + datetime.timedelta(hours=2))
+        self.add_work(cd, beg_dt + datetime.timedelta(hours=3), beg_dt + datetime.timedelta(hours=4))
+        with flow.transaction() as cursor:
+            cursor.execute("INSERT INTO break (task_id, work_id, beg_dt, end_dt, duration_sec) VALUES (?,?,?,?,?)",
+                           (ab.id, work.id, "2024-01-10 10:30:00", "2024-01-10 11:00:00", 1800))
+
+        epoch = flow.dt_to_epoch(beg_dt)
+        with flow.transaction() as cursor:
+            timeline = flow.Timeline.load(cursor)
+            self.assertEqual(timeline.between(epoch, epoch + 5 * 3600), [
+                (epoch, epoch + 1800, ab.id, work.id),
+                (epoch + 3600, epoch + 2 * 3600, ab.id, work.id),
+                (epoch + 3 * 3600, epoch + 4 * 3600, cd.id, work.id + 1),
+            ])
+            self.assertEqual(timeline.gaps(epoch, epoch + 4 * 3600), [(epoch + 1800, epoch + 3600),
+                                                                      (epoch + 2 * 3600, epoch + 3 * 3600)])
+            self.assertEqual(len(flow.Timeline.load(cursor, "c")), 1)
+
+
+class ApiTest(FlowTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cli("create", "a.b", "first")
+        self.api = flow.ApiServer(pool_size=1)
+        self.server = flow.api_http_server(self.api, port=0)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.api.close()
+        super().tearDown()
+
+    def get(self, url_path, headers=None):
+        connection = http.client.HTTPConnection(*self.server.server_address, timeout=10)
+        try:
+            connection.request("GET", url_path, headers=headers or {})
+            response = connection.getresponse()
+            body = response.read()
+            return response.status, response.getheader("ETag"), json.loads(body) if body else None
+        finally:
+            connection.close()
+
+    def test_etag(self):
+        status, etag, data = self.get("/api/tasks")
+        self.assertEqual((status, [task["name"] for task in data["tasks"]]), (200, ["a.b"]))
+        self.assertEqual(self.get("/api/tasks", {"If-None-Match": etag}), (304, etag, None))
+
+        # A write from another connection makes the ETag stale:
+        self.cli("create", "a.c", "first")
+        status, new_etag, data = self.get("/api/tasks", {"If-None-Match": etag})
+        self.assertEqual((status, [task["name"] for task in data["tasks"]]), (200, ["a.b", "a.c"]))
+        self.assertNotEqual(new_etag, etag)
+
+    def test_errors(self):
+        status, etag, data = self.get("/api/nope")
+        self.assertEqual((status, etag), (404, None))
+        self.assertIn("error", data)
+
+        def locked(query, cursor):
+            raise sqlite3.OperationalError("database is locked")
+
+        with unittest.mock.patch.object(flow, "api_routes", ((flow.re.compile("/api/tasks"), locked),)):
+            with contextlib.redirect_stderr(io.StringIO()) as stderr:
+                status, etag, data = self.get("/api/tasks")
+        self.assertEqual((status, etag), (500, None))
+        self.assertIn("database is locked", data["error"])
+        self.assertIn("OperationalError", stderr.getvalue())
+
+
+class ArchiveWriteTest(FlowTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cli("create", "a.old", "archived")
+        self.cli("create", "a.new", "live")
+        with flow.transaction() as cursor:
+            self.old_id = flow.Task.get_by_name("a.old", cursor).id
+            self.new_id = flow.Task.get_by_name("a.new", cursor).id
+        self.archive_task("a.old")
+
+    def test_note_restores_archived_task(self):
+        with flow.transaction() as cursor:
+            flow.Note.new(self.old_id, None, None, "later #tag", "", cursor)
+            self.assertEqual(flow.task_schema(self.old_id, cursor), "main")
+            self.assertEqual(cursor.execute("SELECT COUNT(*) FROM main.note WHERE task_id=?", (self.old_id,))
+                             .fetchone()[0], 3)
+
+    def test_work_restores_archived_task(self):
+        with flow.transaction() as cursor:
+            flow.Work.new(self.old_id, datetime.datetime(2024, 1, 10, 10), cursor)
+            self.assertEqual(flow.task_schema(self.old_id, cursor), "main")
+
+    def test_task_select_lists_archived_tasks(self):
+        task = self.ui_run(lambda: flow.task_select("Pick:"), "old", "0", "0")
+        self.assertEqual((task.id, task.name), (self.old_id, "a.old"))
+        self.assertEqual(self.ui_run(lambda: flow.task_select("Pick:", only_open=True), "old", "n"), "return")
+
+    def test_live_note_skips_archive_lookup(self):
+        statements = []
+        connection = flow.connect()
+        connection.set_trace_callback(statements.append)
+        try:
+            with flow.transaction() as cursor:
+                flow.Note.new(self.new_id, None, None, "hi", "", cursor)
+        finally:
+            connection.set_trace_callback(None)
+        self.assertFalse([sql for sql in statements if "archive" in sql or "pragma_database_list" in sql])
+
+
+class TaskNameTest(FlowTestCase):
+    bad_names = ("a.x/../../escaped", "a.b\n", "a.b c")
+
+    def test_validator_matches_whole_name(self):
+        self.assertTrue(flow.task_name_validator("a.b-c_1.d"))
+        for name in self.bad_names:
+            self.assertFalse(flow.task_name_validator(name), name)
+
+    def test_import_rejects_bad_name(self):
+        for name in self.bad_names:
+            file_path = path.join(self.dir_path, "tasks.jsonl")
+            with open(file_path, "w", encoding="utf-8") as f:
+                f.write('{"type": "task", "name": "a.ok"}\n')
+                f.write(json.dumps({"type": "task", "name": name}) + "\n")
+            with self.assertRaisesRegex(flow.DataImportError, "^Line 2: "):
+                flow.bulk_import(file_path)
+        with flow.transaction() as cursor:
+            self.assertEqual(cursor.execute("SELECT COUNT(*) FROM task").fetchone()[0], 0)
+
+    def test_sync_rejects_bad_name(self):
+        with self.replica("other") as other_path:
+            with flow.transaction() as cursor:
+                cursor.execute("INSERT INTO task (name, cache_beg_dt, cache_status_code) VALUES (?,?,?)",
+                               (self.bad_names[0], "2024-01-10 10:00:00", flow.IN_PROGRESS_TASK_STATUS))
+        with self.assertRaisesRegex(flow.SyncError, "invalid name"):
+            flow.sync(other_path)
+        with flow.transaction() as cursor:
+            self.assertIsNone(flow.Task.get_by_name(self.bad_names[0], cursor))
+
+
+class TaskSearchTest(FlowTestCase):
+    names = ("ab", "ab.x", "x.ab", "x.ab.y", "x.abc", "xab.y", "zab", "q.r")
+
+    def setUp(self):
+        super().setUp()
+        with flow.transaction() as cursor:
+            for name in self.names:
+                flow.Task.new(name, "first", cursor)
+
+    def search(self, search_str, only_open=False):
+        with flow.transaction() as cursor:
+            return [task.name for task in flow.Task.name_search(search_str, only_open, cursor)]
+
+    def test_ranking(self):
+        # Whole name, then whole chunk(s), then chunk prefix, then anywhere; most recent first within each.
+        expected = ["ab", "x.ab.y", "x.ab", "ab.x", "x.abc", "zab", "xab.y"]
+        self.assertEqual(self.search("ab"), expected)
+        self.assertEqual(self.search("AB"), expected)
+        self.assertEqual(self.search("ab.y"), ["x.ab.y", "xab.y"])
+
+    def test_short_and_odd_fragments(self):
+        # Fragments under `task_search_min_fts_len` characters go through LIKE, with its wildcards escaped.
+        self.assertEqual(self.search("b."), ["xab.y", "x.ab.y", "ab.x"])
+        self.assertEqual(self.search("q"), ["q.r"])
+        for search_str in ("%", "_b", '"ab', "ab*", "a OR b"):
+            self.assertEqual(self.search(search_str), [], search_str)
+
+    def test_only_open(self):
+        with flow.transaction() as cursor:
+            flow.Task.get_by_name("x.ab", cursor).set_status(flow.COMPLETE_TASK_STATUS, "done", cursor)
+        self.assertNotIn("x.ab", self.search("ab", only_open=True))
+        self.assertIn("x.ab", self.search("ab"))
+
+    def pages(self, search_str, limit, windowed, calls=None):
+        # Every page, as task names, each following the previous page's last key.
+        with flow.transaction() as cursor:
+            def fetch_page(after, limit, inclusive):
+                if calls is not None:
+                    calls.append(limit)
+                return [(task.name, task, key) for task, key in
+                        flow.Task.name_search_page(search_str, False, after, limit, cursor, inclusive)]
+
+            fetch_page = flow.windowed_fetch_page(fetch_page) if windowed else fetch_page
+            pages, after = [], None
+            while True:
+                page = fetch_page(after, limit, False)
+                if not page:
+                    return pages
+                pages.append([name for name, _, _ in page])
+                after = page[-1][2]
+
+    def test_pages(self):
+        for search_str in ("ab", "abc", "b.y", ""):
+            expected = self.pages(search_str, 100, False)
+            for limit in (1, 2, 3):
+                for windowed in (False, True):
+                    pages = self.pages(search_str, limit, windowed)
+                    self.assertTrue(all(len(page) <= limit for page in pages))
+                    self.assertEqual(sum(pages, []), sum(expected, []), (search_str, limit, windowed))
+
+    def test_window_queries(self):
+        # "ab" matches 7 tasks: in pages of 1, a window of 4 pages takes 2 queries, each of one window.
+        calls = []
+        self.pages("ab", 1, True, calls)
+        self.assertEqual(calls, [flow.search_window_num_pages] * 2)
+
+    def test_page_from_key(self):
+        with flow.transaction() as cursor:
+            page = flow.Task.name_search_page("ab", False, (1, "x.ab"), 2, cursor, inclusive=True)
+            self.assertEqual([key for _, key in page], [(1, "x.ab"), (1, "x.ab.y")])
+
+            # A window serves a jump to a key inside it without another query.
+            calls = []
+
+            def fetch_page(after, limit, inclusive):
+                calls.append((after, inclusive))
+                return [(task.name, task, key) for task, key in
+                        flow.Task.name_search_page("ab", False, after, limit, cursor, inclusive)]
+
+            fetch_page = flow.windowed_fetch_page(fetch_page)
+            fetch_page(None, 2, False)
+            page = fetch_page((1, "x.ab"), 2, True)
+            self.assertEqual([key for _, _, key in page], [(1, "x.ab"), (1, "x.ab.y")])
+            self.assertEqual(calls, [(None, False)])
+
+
+class NoteSearchTest(FlowTestCase):
+    def setUp(self):
+        super().setUp()
+        with flow.transaction() as cursor:
+            self.ab = flow.Task.new("a.b", "first", cursor)
+            self.cd = flow.Task.new("c.d", "first", cursor)
+            self.note_ids = [flow.Note.new(task.id, None, datetime.datetime(2024, 1, day, 12), text, "", cursor).id
+                             for task, day, text in (
+                                 (self.ab, 10, "Deploy the server, then deploy the client. Deploy!"),
+                                 (self.ab, 11, "Fixed the parser; the deployment went out and the release notes "
+                                               "were sent to everybody on the list"),
+                                 (self.cd, 12, "deploy c.d (with \"quotes\" and a #tag)"),
+                             )]
+
+    def search(self, search_str, prefix=None, beg_dt_str=None, end_dt_str=None, limit=10):
+        with flow.transaction() as cursor:
+            return flow.Note.search(search_str, prefix, beg_dt_str, end_dt_str, limit, cursor)
+
+    def test_ranked(self):
+        rows = self.search("deploy")
+        self.assertEqual([row[0] for row in rows], [self.note_ids[0], self.note_ids[2]])
+        self.assertEqual([row[3] for row in rows], ["a.b", "c.d"])
+        self.assertLessEqual(rows[0][5], rows[1][5])
+        self.assertIn("[Deploy]", rows[0][4])
+        self.assertEqual([row[0] for row in self.search("deploy", limit=1)], [self.note_ids[0]])
+
+    def test_prefix_stems_and_all_words(self):
+        self.assertEqual([row[0] for row in self.search("relea*")], [self.note_ids[1]])
+        self.assertEqual([row[0] for row in self.search("fixing deployments")], [self.note_ids[1]])
+        self.assertEqual(self.search("deploy parser"), [])
+
+    def test_filters(self):
+        self.assertEqual([row[0] for row in self.search("deploy", prefix="c")], [self.note_ids[2]])
+        self.assertEqual([row[0] for row in self.search("deploy", prefix="a.b")], [self.note_ids[0]])
+        self.assertEqual([row[0] for row in self.search("deploy", beg_dt_str="2024-01-11 00:00:00")],
+                         [self.note_ids[2]])
+        self.assertEqual([row[0] for row in self.search("deploy", end_dt_str="2024-01-12 00:00:00")],
+                         [self.note_ids[0]])
+
+    def test_query_syntax_is_literal(self):
+        for search_str in ('"quotes"', "c.d", "NOT", "(with", "#tag", "deploy OR", "*"):
+            self.search(search_str)
+        self.assertEqual([row[0] for row in self.search('"quotes" c.d')], [self.note_ids[2]])
+        self.assertEqual(self.search("   "), [])
+
+    def test_follows_edits(self):
+        with flow.transaction() as cursor:
+            cursor.execute("UPDATE note SET user_text='rewritten' WHERE id=?", (self.note_ids[2],))
+        self.assertEqual([row[0] for row in self.search("deploy")], [self.note_ids[0]])
+        self.assertEqual([row[0] for row in self.search("rewritten")], [self.note_ids[2]])
+
+
+class ImportTest(FlowTestCase):
+    def write_records(self, *records):
+        file_path = path.join(self.dir_path, "records.jsonl")
+        with open(file_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        return file_path
+
+    def test_note_before_its_work(self):
+        file_path = self.write_records(
+            {"type": "note", "task": "a.b", "timestamp": "2024-01-10 10:30:00", "user_text": "hi", "work_id": 7},
+            {"type": "work", "task": "a.b", "beg_dt": "2024-01-10 10:00:00", "duration_sec": 3600, "id": 7})
+        self.assertEqual(flow.bulk_import(file_path), {"task": 1, "work": 1, "note": 2})
+
+    def test_missing_work_record(self):
+        file_path = self.write_records(
+            {"type": "work", "task": "a.b", "beg_dt": "2024-01-10 10:00:00", "duration_sec": 3600, "id": 1},
+            {"type": "note", "task": "a.b", "timestamp": "2024-01-10 10:30:00", "user_text": "hi", "work_id": 8},
+            {"type": "break", "task": "a.b", "beg_dt": "2024-01-10 10:40:00", "duration_sec": 60, "work_id": 9})
+        with self.assertRaisesRegex(flow.DataImportError, "^Line 2: No 'work' record with id 8 "):
+            flow.bulk_import(file_path)
+        with self.assertRaises(SystemExit):
+            self.cli("import", file_path)
+        with flow.transaction() as cursor:
+            self.assertEqual(cursor.execute("SELECT COUNT(*) FROM task").fetchone()[0], 0)
+
+    def test_bad_breaks(self):
+        work = {"type": "work", "task": "a.b", "beg_dt": "2024-01-10 10:00:00", "duration_sec": 3600}
+        for breaks in ([1], 5, "x", [{"beg_dt": "2024-01-10 10:10:00", "duration_sec": 60}, None]):
+            file_path = self.write_records({"type": "task", "name": "a.b"}, dict(work, breaks=breaks))
+            with self.assertRaisesRegex(flow.DataImportError, "^Line 2: "):
+                flow.bulk_import(file_path)
+            with self.assertRaises(SystemExit):
+                self.cli("import", file_path)
+
+    def test_bad_flow_text(self):
+        for flow_text in (5, ["x"], {"a": 1}):
+            file_path = self.write_records({"type": "note", "task": "a.b", "timestamp": "2024-01-10 10:30:00",
+                                            "user_text": "hi", "flow_text": flow_text})
+            with self.assertRaisesRegex(flow.DataImportError, "^Line 1: 'flow_text'"):
+                flow.bulk_import(file_path)
+
+    def test_duplicate_work_record(self):
+        record = {"type": "work", "task": "a.b", "beg_dt": "2024-01-10 10:00:00", "duration_sec": 3600, "id": 1}
+        with self.assertRaisesRegex(flow.DataImportError, "^Line 2: "):
+            flow.bulk_import(self.write_records(record, record))
+
+
+class ReportTest(FlowTestCase):
+    user_text = "#todo<script>alert(1)</script> & <b>#x</b> &#reminder"
+
+    def setUp(self):
+        super().setUp()
+        beg_dt = datetime.datetime(2024, 1, 10, 10)
+        with flow.transaction() as cursor:
+            self.task = flow.Task.new("a.b", "first", cursor)
+        self.work = self.add_work(self.task, beg_dt, beg_dt + datetime.timedelta(hours=1))
+        with flow.transaction() as cursor:
+            flow.Work.add_break(self.task.id, self.work.id, beg_dt, beg_dt + datetime.timedelta(minutes=5), 300, cursor)
+            self.note = flow.Note.new(self.task.id, self.work.id, beg_dt, self.user_text, "<script>flow</script>",
+                                      cursor)
+
+    def export(self, fmt):
+        file_path = path.join(self.dir_path, f"report.{fmt}")
+        with flow.transaction() as cursor:
+            self.task.export(file_path, fmt, cursor)
+        with open(file_path, encoding="utf-8", newline="") as f:
+            return f.read()
+
+    def test_html_escapes_user_text(self):
+        self.assertEqual(flow.Note.html_print_user_text(self.user_text),
+                         "<sys><u>#todo</u></sys>&lt;script&gt;alert(1)&lt;/script&gt; &amp; "
+                         "&lt;b&gt;<sys><u>#x</u></sys>&lt;/b&gt; &amp;#reminder")
+        report = self.export("html")
+        self.assertNotIn("<script>", report)
+        self.assertIn("&lt;script&gt;flow&lt;/script&gt;", report)
+        self.assertIn("<sys><u>#todo</u></sys>", report)
+
+    def test_json_lines(self):
+        records = [json.loads(line) for line in self.export("jsonl").splitlines()]
+        self.assertEqual([record["type"] for record in records], ["task", "note", "note", "work"])
+        self.assertEqual((records[0]["name"], records[0]["net_duration_sec"], records[0]["break_duration_sec"]),
+                         ("a.b", 3600, 300))
+        note_record = next(record for record in records if record["type"] == "note" and record["id"] == self.note.id)
+        self.assertEqual((note_record["user_text"], note_record["work_id"]), (self.user_text, self.work.id))
+        self.assertEqual(records[3]["breaks"], [{"id": 1, "beg_dt": "2024-01-10 10:00:00", "duration_sec": 300}])
+
+    def test_csv(self):
+        rows = list(csv.DictReader(io.StringIO(self.export("csv"))))
+        self.assertEqual([row["record"] for row in rows], ["task", "note", "note", "work", "break"])
+        task_row = rows[0]
+        note_row = next(row for row in rows if row["record"] == "note" and row["id"] == str(self.note.id))
+        self.assertEqual((task_row["name"], task_row["status"], task_row["user_text"], task_row["flow_text"]),
+                         ("a.b", str(flow.IN_PROGRESS_TASK_STATUS), "", ""))
+        self.assertEqual((note_row["name"], note_row["user_text"], note_row["flow_text"]),
+                         ("", self.user_text, "<script>flow</script>"))
+        self.assertEqual((rows[4]["work_id"], rows[4]["duration_sec"]), (str(self.work.id), "300"))
+
+    def test_fixed_number_of_queries(self):
+        # A task with 6 sessions, each with 2 breaks and a note, takes as many queries to export as one with 1.
+        beg_dt = datetime.datetime(2024, 2, 1, 10)
+        with flow.transaction() as cursor:
+            task = flow.Task.new("a.c", "first", cursor)
+        for i in range(6):
+            work_beg_dt = beg_dt + datetime.timedelta(days=i)
+            work = self.add_work(task, work_beg_dt, work_beg_dt + datetime.timedelta(hours=1))
+            with flow.transaction() as cursor:
+                for j in range(2):
+                    break_beg_dt = work_beg_dt + datetime.timedelta(minutes=10 * (j + 1))
+                    flow.Work.add_break(task.id, work.id, break_beg_dt, break_beg_dt + datetime.timedelta(minutes=5),
+                                        300, cursor)
+                flow.Note.new(task.id, work.id, work_beg_dt, f"note {i}", "", cursor)
+
+        tracer = flow.QueryTracer()
+        with unittest.mock.patch.object(flow, "_tracer", tracer):
+            flow.disconnect()
+            try:
+                for fmt in flow.report_writers:
+                    num_statements = []
+                    for export_task in (self.task, task):
+                        file_path = path.join(self.dir_path, f"{export_task.name}.{fmt}")
+                        with flow.transaction() as cursor:
+                            beg_num_statements = tracer.num_statements
+                            export_task.export(file_path, fmt, cursor)
+                            num_statements.append(tracer.num_statements - beg_num_statements)
+                    self.assertGreater(num_statements[0], 0, fmt)
+                    self.assertEqual(num_statements[0], num_statements[1], fmt)
+            finally:
+                flow.disconnect()
+
+
+class BulkExportTest(FlowTestCase):
+    def test_names_stay_inside_the_directory(self):
+        # Such names no longer pass validation, but older DBs (and other replicas) may still hold them.
+        with flow.transaction() as cursor:
+            for name in ("a.x/../../escaped", "a.y/nested", ".."):
+                cursor.execute("INSERT INTO task (name, cache_beg_dt, cache_status_code) VALUES (?,?,?)",
+                               (name, "2024-01-10 10:00:00", flow.IN_PROGRESS_TASK_STATUS))
+        dir_path = path.join(self.dir_path, "export", "all")
+        self.assertEqual(flow.bulk_export("", dir_path, num_workers=1), 3)
+        file_names = sorted(os.listdir(dir_path))
+        self.assertEqual(file_names, ["...html", "a.x%2F..%2F..%2Fescaped.html", "a.y%2Fnested.html", "index.html"])
+        self.assertEqual(sorted(os.listdir(path.join(self.dir_path, "export"))), ["all"])
+        with open(path.join(dir_path, "index.html"), encoding="utf-8") as f:
+            self.assertIn('href="a.y%252Fnested.html"', f.read())
+
+    def test_worker_failure(self):
+        self.cli("create", "a.b", "first")
+        dir_path = path.join(self.dir_path, "export")
+        os.makedirs(path.join(dir_path, "a.b.html"))
+        with self.assertRaisesRegex(flow.BulkExportError, "^Exporting failed: "):
+            flow.bulk_export("", dir_path, num_workers=1)
+        with self.assertRaisesRegex(SystemExit, "^flow: Exporting failed: "):
+            self.cli("export-all", "", dir_path, "--workers", "1")
+
+
+class SyncTest(FlowTestCase):
+    def add_task(self, name, beg_dt_str, cursor):
+        cursor.execute("INSERT INTO task (name, cache_beg_dt, cache_status_code) VALUES (?,?,?)",
+                       (name, beg_dt_str, flow.IN_PROGRESS_TASK_STATUS))
+        return cursor.lastrowid
+
+    def task_row(self):
+        with flow.transaction() as cursor:
+            return cursor.execute("SELECT cache_beg_dt, cache_status_code FROM task WHERE name='a.b'").fetchone()
+
+    def test_task_created_on_both_keeps_first_beg_dt(self):
+        with flow.transaction() as cursor:
+            self.add_task("a.b", "2024-01-10 10:00:00", cursor)
+        with self.replica("other") as other_path:
+            with flow.transaction() as cursor:
+                task_id = self.add_task("a.b", "2024-02-01 10:00:00", cursor)
+                cursor.execute("UPDATE task SET cache_status_code=? WHERE id=?", (flow.COMPLETE_TASK_STATUS, task_id))
+        flow.sync(other_path)
+        expected = ("2024-01-10 10:00:00", flow.COMPLETE_TASK_STATUS)
+        self.assertEqual(self.task_row(), expected)
+        with self.replica("other"):
+            self.assertEqual(self.task_row(), expected)
+
+    def test_note_update_retags(self):
+        with self.replica("other") as other_path:
+            with flow.transaction() as cursor:
+                task_id = self.add_task("a.b", "2024-01-10 10:00:00", cursor)
+                cursor.execute("INSERT INTO note (timestamp, task_id, user_text, flow_text) VALUES (?,?,?,?)",
+                               ("2024-01-10 10:00:00", task_id, "#alpha", ""))
+        flow.sync(other_path)
+        with self.replica("other"):
+            with flow.transaction() as cursor:
+                cursor.execute("UPDATE note SET user_text='#beta #gamma'")
+        flow.sync(other_path)
+        with flow.transaction() as cursor:
+            self.assertEqual(sorted(tag for tag, in cursor.execute("SELECT tag FROM note_tag")), ["beta", "gamma"])
+
+
+class TaskTrieTest(FlowTestCase):
+    def setUp(self):
+        super().setUp()
+        beg_dt = datetime.datetime(2024, 1, 10, 10)
+        with flow.transaction() as cursor:
+            tasks = [flow.Task.new(name, "first", cursor) for name in ("a.b.c", "a.b.d", "a.e", "ab.f", "x.y")]
+        for i, task in enumerate(tasks):
+            self.add_work(task, beg_dt, beg_dt + datetime.timedelta(minutes=10 * (i + 1)))
+
+    def expected_work_sec(self, prefix, cursor):
+        lo, hi = flow.task_name_prefix_bounds(prefix)
+        sql = ("SELECT COALESCE(SUM(net_duration_sec - break_duration_sec), 0) FROM {schema}.task_stats "
+               "JOIN {schema}.task ON task.id = task_id WHERE name=? OR (name >= ? AND name < ?)")
+        schemas = ("main", "archive") if flow.archive_attached(cursor) else ("main",)
+        return sum(cursor.execute(sql.format(schema=schema), (prefix, lo, hi)).fetchone()[0] for schema in schemas)
+
+    def assert_sums(self):
+        with flow.transaction() as cursor:
+            trie = flow.task_trie(cursor)
+            for prefix in ("a", "a.b", "a.b.c", "a.e", "ab", "x", "nope"):
+                self.assertEqual(trie.subtree_work_sec(prefix, cursor), self.expected_work_sec(prefix, cursor),
+                                 prefix)
+
+    def test_matches_task_stats(self):
+        self.assert_sums()
+
+    def test_follows_new_work(self):
+        with flow.transaction() as cursor:
+            flow.task_trie(cursor).subtree_work_sec("a", cursor)
+            task = flow.Task.get_by_name("a.e", cursor)
+        beg_dt = datetime.datetime(2024, 1, 11, 10)
+        self.add_work(task, beg_dt, beg_dt + datetime.timedelta(hours=1))
+        self.assert_sums()
+
+    def test_counts_archived_tasks(self):
+        self.archive_task("a.b.d")
+        self.assert_sums()
+        with flow.transaction() as cursor:
+            trie = flow.task_trie(cursor)
+            self.assertEqual(trie.complete("a.b."), [("a.b.c", 1)])
+            self.assertGreater(trie.subtree_work_sec("a.b.d", cursor), 0)
+
+    def test_reads_only_the_subtree(self):
+        self.archive_task("a.b.d")
+        with flow.transaction() as cursor:
+            trie = flow.task_trie(cursor)
+            trie.subtree_work_sec("a.b", cursor)
+            statements = []
+            cursor.connection.set_trace_callback(statements.append)
+            try:
+                # Cached until a write:
+                trie.subtree_work_sec("a.b", cursor)
+                self.assertEqual(statements, [])
+                flow.Task.new("a.b.z", "first", cursor)
+                del statements[:]
+                trie.subtree_work_sec("a.b", cursor)
+            finally:
+                cursor.connection.set_trace_callback(None)
+            self.assertEqual(len(statements), 1)
+            plan = [row[3] for row in cursor.execute("EXPLAIN QUERY PLAN " + statements[0])]
+            # (Only the view's own rows, already filtered, are scanned.)
+            self.assertFalse([step for step in plan if step.startswith(("SCAN main.", "SCAN archive."))], plan)
+            self.assertIn("SEARCH archive.task USING INDEX sqlite_autoindex_task_1 (name>? AND name<?)", plan)
+
+
+class ModelCacheTest(FlowTestCase):
+    def test_other_connection_commit_refreshes(self):
+        beg_dt = datetime.datetime(2024, 1, 10, 10)
+        with flow.transaction() as cursor:
+            task = flow.Task.new("a.b", "first", cursor)
+        work = self.add_work(task, beg_dt, beg_dt + datetime.timedelta(hours=1))
+        with flow.transaction() as cursor:
+            self.assertIs(flow.Task.get(task.id, cursor), flow.Task.get(task.id, cursor))
+            self.assertIs(flow.Work.get(work.id, cursor), flow.Work.get(work.id, cursor))
+            flow.task_trie(cursor)
+
+        # Another process (here, another connection) commits:
+        other = sqlite3.connect(flow.db_path)
+        try:
+            with other:
+                other.execute("UPDATE task SET cache_status_code=? WHERE id=?", (flow.COMPLETE_TASK_STATUS, task.id))
+                other.execute("UPDATE work SET cache_end_dt='2024-01-10 12:00:00', cache_duration_sec=7200 "
+                              "WHERE id=?", (work.id,))
+        finally:
+            other.close()
+
+        with flow.transaction() as cursor:
+            self.assertEqual(flow.Task.get(task.id, cursor).status, flow.COMPLETE_TASK_STATUS)
+            self.assertEqual(flow.Task.get_by_name("a.b", cursor).status, flow.COMPLETE_TASK_STATUS)
+            work = flow.Work.get(work.id, cursor)
+            self.assertEqual((work.end_dt, work.duration_sec), (datetime.datetime(2024, 1, 10, 12), 7200))
+            self.assertEqual(flow.task_trie(cursor).get_task("a.b").status, flow.COMPLETE_TASK_STATUS)
+
+
+class UiTest(unittest.TestCase):
+    class TtyStringIO(io.StringIO):
+        def isatty(self):
+            return True
+
+    def test_plain_wipe(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            flow.PlainUi().wipe()
+        self.assertEqual(out.getvalue(), "")
+        out = self.TtyStringIO()
+        with contextlib.redirect_stdout(out):
+            flow.PlainUi().wipe()
+        self.assertEqual(out.getvalue(), "\033[H\033[2J")
+
+    def test_plain_watch_keys_on_a_file(self):
+        # A regular file can't be polled: only Ctrl+C pauses then, but the session still runs.
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        with tempfile.TemporaryFile("w+") as f, unittest.mock.patch.object(sys, "stdin", f):
+            unwatch = flow.PlainUi().watch_keys(loop, lambda: None)
+            unwatch()
+
+    def run_tui(self, **patches):
+        # Runs `flow tui` with `main` stubbed out; returns the type of `ui` it ran `main` with, and what went to stderr.
+        ui_types = []
+        err = io.StringIO()
+        with unittest.mock.patch.object(flow, "main", lambda: ui_types.append(type(flow.ui))), \
+                unittest.mock.patch.multiple(sys, stdin=io.StringIO(), stdout=io.StringIO(), stderr=err), \
+                unittest.mock.patch.dict(sys.modules, patches):
+            flow.tui_main()
+        return ui_types, err.getvalue()
+
+    def test_tui_falls_back_without_a_terminal(self):
+        ui_types, err = self.run_tui()
+        self.assertEqual(ui_types, [flow.PlainUi])
+        self.assertIn("(not a terminal)", err)
+
+    def test_tui_falls_back_without_curses(self):
+        ui_types, err = self.run_tui(curses=None)
+        self.assertEqual(ui_types, [flow.PlainUi])
+        self.assertIn("(no curses module)", err)
+
+    def curses_ui(self, height=4, width=20):
+        stdscr = unittest.mock.Mock()
+        stdscr.getmaxyx.return_value = (height, width)
+        patcher = unittest.mock.patch("curses.doupdate")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return flow.CursesUi(stdscr), stdscr
+
+    def drawn(self, stdscr):
+        # The `(row, text)` writes since the last call.
+        rows = [(args[0], args[2]) for args, _ in stdscr.addstr.call_args_list]
+        stdscr.addstr.reset_mock()
+        return rows
+
+    def test_curses_redraws_only_changed_rows(self):
+        curses_ui, stdscr = self.curses_ui()
+        print("one\ntwo", file=curses_ui, flush=True)
+        self.assertEqual(self.drawn(stdscr), [(0, "one"), (1, "two"), (2, ""), (3, "")])
+        curses_ui.render()
+        self.assertEqual(self.drawn(stdscr), [])
+        curses_ui.show_status("Working on 'a' for... 0:00:01")
+        self.assertEqual(self.drawn(stdscr), [(3, "Working on 'a' for.")])
+        curses_ui.show_status("Working on 'a' for... 0:00:02")
+        self.assertEqual(self.drawn(stdscr), [])
+        curses_ui.end_status()
+        self.assertEqual(self.drawn(stdscr), [(3, "")])
+        # The log scrolls, and `\r` rewrites its last line:
+        print("three\rTHREE\nfour\nfive", file=curses_ui, flush=True)
+        self.assertEqual(curses_ui.drawn_rows, ["two", "THREE", "four", "five"])
+
+    def test_curses_input(self):
+        import curses
+
+        curses_ui, stdscr = self.curses_ui()
+        stdscr.get_wch.side_effect = ["h", "i", "x", "\x7f", curses.KEY_RESIZE, "\t", "\n"]
+        print("Choose:", end="", file=curses_ui)
+        self.assertEqual(curses_ui.input(" > "), "hi")
+        stdscr.clear.assert_called_once_with()
+        self.assertEqual(curses_ui.log, ["Choose: > hi"])
+
+
+class RollbackTest(FlowTestCase):
+    def test_rollback_forgets_cached_writes(self):
+        with flow.transaction() as cursor:
+            task = flow.Task.new("a.b", "first", cursor)
+            flow.task_trie(cursor)
+        with self.assertRaises(ZeroDivisionError):
+            with flow.transaction() as cursor:
+                flow.Task.new("a.c", "first", cursor)
+                flow.Task.get(task.id, cursor).set_status(flow.COMPLETE_TASK_STATUS, "done", cursor)
+                1 / 0
+        with flow.transaction() as cursor:
+            trie = flow.task_trie(cursor)
+            self.assertIsNone(trie.get_task("a.c"))
+            self.assertEqual(trie.get_task("a.b").status, flow.IN_PROGRESS_TASK_STATUS)
+            self.assertEqual(flow.Task.get(task.id, cursor).status, flow.IN_PROGRESS_TASK_STATUS)
+
+
+if __name__ == "__main__":
+    unittest.main()